@@ -12,7 +12,9 @@ from frappe.utils import (
     add_days,
     time_diff_in_seconds,
     flt,
+    cint,
     add_to_date,
+    date_diff,
 )
 from frappe.model.mapper import get_mapped_doc
 from frappe import _
@@ -23,6 +25,9 @@ from healthcare.healthcare.doctype.healthcare_settings.healthcare_settings impor
     get_receivable_account,
     get_income_account,
 )
+from hms_tz.nhif.doctype.practitioner_availability_detail.practitioner_availability_detail import (
+    get_occurrences,
+)
 from hms_tz.hms_tz.utils import (
     check_fee_validity,
     get_service_item_and_practitioner_charge,
@@ -30,6 +35,12 @@ from hms_tz.hms_tz.utils import (
 )
 
 
+slot_plan_key = "practitioner_slot_plan"
+# cached slot plans of a date expire a day after they were built
+slot_plan_expiry = 24 * 60 * 60
+max_slot_range_days = 31
+
+
 class Maximumcapacityerror(frappe.ValidationError):
     pass
 
@@ -53,6 +64,30 @@ class PatientAppointment(Document):
         send_confirmation_msg(self)
         # make_insurance_claim(self)
 
+    def on_update(self):
+        slot_fields = [
+            "appointment_date",
+            "appointment_time",
+            "duration",
+            "status",
+            "practitioner",
+            "service_unit",
+        ]
+        doc_before_save = self.get_doc_before_save()
+        if doc_before_save and not any(
+            self.has_value_changed(field) for field in slot_fields
+        ):
+            return
+        clear_slot_plans(
+            [
+                self.appointment_date,
+                doc_before_save and doc_before_save.appointment_date,
+            ]
+        )
+
+    def on_trash(self):
+        clear_slot_plans([self.appointment_date])
+
     def set_title(self):
         self.title = _("{0} with {1}").format(
             self.patient_name or self.patient,
@@ -390,12 +425,9 @@ def get_availability_data(date, practitioner):
     practitioner_doc = frappe.get_doc("Healthcare Practitioner", practitioner)
 
     check_employee_wise_availability(date, practitioner_doc)
-    present_events = get_present_event(practitioner, date)
+    plan = get_day_slot_plan(practitioner_doc, date)
 
-    if practitioner_doc.practitioner_schedules or present_events:
-        slot_details = get_available_slots(practitioner_doc, date)
-        present_events = get_present_event_slots(present_events, date, practitioner)
-    else:
+    if not plan.get("has_schedule"):
         frappe.throw(
             _(
                 "{0} does not have a Healthcare Practitioner Schedule. Add it in Healthcare Practitioner master"
@@ -403,17 +435,70 @@ def get_availability_data(date, practitioner):
             title=_("Practitioner Schedule Not Found"),
         )
 
-    if not slot_details and not present_events:
+    if not plan["slot_details"] and not plan["present_events"]:
         # TODO: return available slots in nearby dates
         frappe.throw(
             _("Healthcare Practitioner not available on {0}").format(weekday),
             title=_("Not Available"),
         )
 
-    return {"slot_details": slot_details, "present_events": present_events}
+    return plan
+
+
+@frappe.whitelist()
+def get_practitioner_free_slots(practitioner, from_date, to_date=None):
+    """
+    Free slots of 'practitioner' for every date from 'from_date' to 'to_date'
+    :return: dict of date => {"unavailable": reason, "slots": list of free slots}
+    """
+    from_date = getdate(from_date)
+    to_date = getdate(to_date or from_date)
+    if date_diff(to_date, from_date) > max_slot_range_days:
+        frappe.throw(
+            _("Free slots can be fetched for at most {0} days at a time").format(
+                max_slot_range_days
+            )
+        )
+
+    practitioner_doc = frappe.get_doc("Healthcare Practitioner", practitioner)
+    free_slots = {}
+    date = from_date
+    while date <= to_date:
+        unavailable = get_employee_unavailability(date, practitioner_doc)
+        slots = []
+        if not unavailable:
+            plan = get_day_slot_plan(practitioner_doc, date)
+            for slot_group in plan["slot_details"] + plan["present_events"]:
+                for slot in slot_group["avail_slot"]:
+                    if slot["disabled"]:
+                        continue
+                    slots.append(
+                        {
+                            "slot_name": slot_group["slot_name"],
+                            "service_unit": slot_group["service_unit"],
+                            "availability": slot_group.get("availability"),
+                            "from_time": slot["from_time"],
+                            "to_time": slot["to_time"],
+                            "capacity_left": slot["capacity_left"],
+                        }
+                    )
+            if not slots:
+                unavailable = _("No free slots")
+
+        free_slots[str(date)] = {"unavailable": unavailable, "slots": slots}
+        date = add_days(date, 1)
+
+    return free_slots
 
 
 def check_employee_wise_availability(date, practitioner_doc):
+    unavailable = get_employee_unavailability(date, practitioner_doc)
+    if unavailable:
+        frappe.throw(unavailable, title=_("Not Available"))
+
+
+def get_employee_unavailability(date, practitioner_doc):
+    """Reason the practitioner's employee is not working on `date`, if any"""
     employee = None
     if practitioner_doc.employee:
         employee = practitioner_doc.employee
@@ -425,7 +510,7 @@ def check_employee_wise_availability(date, practitioner_doc):
     if employee:
         # check holiday
         if is_holiday(employee, date):
-            frappe.throw(_("{0} is a holiday".format(date)), title=_("Not Available"))
+            return _("{0} is a holiday".format(date))
 
         # check leave status
         leave_record = frappe.db.sql(
@@ -437,270 +522,320 @@ def check_employee_wise_availability(date, practitioner_doc):
         )
         if leave_record:
             if leave_record[0].half_day:
-                frappe.throw(
-                    _("{0} is on a Half day Leave on {1}").format(
-                        practitioner_doc.name, date
-                    ),
-                    title=_("Not Available"),
+                return _("{0} is on a Half day Leave on {1}").format(
+                    practitioner_doc.name, date
                 )
             else:
-                frappe.throw(
-                    _("{0} is on Leave on {1}").format(practitioner_doc.name, date),
-                    title=_("Not Available"),
-                )
-
+                return _("{0} is on Leave on {1}").format(practitioner_doc.name, date)
 
-def get_present_event(practitioner, date):
-    present_events = frappe.db.sql(
-        """
-		select
-			name, availability, from_time, to_time, from_date, to_date, duration, service_unit, repeat_this_event, repeat_on, repeat_till,
-			monday, tuesday, wednesday, thursday, friday, saturday, sunday
-		from
-			`tabPractitioner Availability`
-		where
-			practitioner = %(practitioner)s and present = 1 and
-			(
-				(repeat_this_event = 1 and (from_date<=%(date)s and ifnull(repeat_till, "3000-01-01")>=%(date)s))
-				or
-				(repeat_this_event != 1 and (from_date<=%(date)s and to_date>=%(date)s))
-			)
-		order by
-			from_date, from_time
-	""".format(),
-        {"practitioner": practitioner, "date": getdate(date)},
-        as_dict=True,
-    )
-    return present_events if present_events else ""
 
+def get_slot_plan_key(date):
+    return "{0}:{1}".format(slot_plan_key, getdate(date))
 
-def get_absent_event(practitioner, date):
-    # Absent events
-    absent_events = frappe.db.sql(
-        """
-		select
-			name, availability, from_time, to_time, from_date, to_date, duration, service_unit, service_unit, repeat_this_event, repeat_on, repeat_till,
-			monday, tuesday, wednesday, thursday, friday, saturday, sunday
-		from
-			`tabPractitioner Availability`
-		where
-			practitioner = %(practitioner)s and present != 1 and
-			(
-				(repeat_this_event = 1 and (from_date<=%(date)s and ifnull(repeat_till, "3000-01-01")>=%(date)s))
-				or
-				(repeat_this_event != 1 and (from_date<=%(date)s and to_date>=%(date)s))
-			)
-	""".format(),
-        {"practitioner": practitioner, "date": getdate(date)},
-        as_dict=True,
-    )
 
-    if absent_events:
-        remove_events, add_events = remove_events_by_repeat_on(absent_events, date)
-        for e in remove_events:
-            absent_events.remove(e)
-        absent_events = absent_events + add_events
-    return absent_events if absent_events else []
+def get_day_slot_plan(practitioner_doc, date):
+    """Slots of the practitioner on `date` with booked appointments and absences
+    applied, cached per day until an appointment of that day changes.
+    """
+    cache = frappe.cache()
+    key = get_slot_plan_key(date)
+    plan = cache.hget(key, practitioner_doc.name)
+    if plan is None:
+        plan = build_day_slot_plan(practitioner_doc, getdate(date))
+        cache.hset(key, practitioner_doc.name, plan)
+        cache.expire(cache.make_key(key), slot_plan_expiry)
+    return plan
 
 
-def get_available_slots(practitioner_doc, date):
-    available_slots = []
-    slot_details = []
-    weekday = date.strftime("%A")
+def build_day_slot_plan(practitioner_doc, date):
     practitioner = practitioner_doc.name
+    present_events = get_present_event(practitioner, date)
+
+    time_slots = get_schedule_time_slots(practitioner_doc, date)
+    service_units = {
+        schedule_entry.service_unit
+        for schedule_entry in practitioner_doc.practitioner_schedules
+        if schedule_entry.service_unit and time_slots.get(schedule_entry.schedule)
+    }
+    service_units.update(
+        event.service_unit for event in present_events or [] if event.service_unit
+    )
+
+    day_data = frappe._dict(
+        time_slots=time_slots,
+        service_units=get_service_unit_settings(service_units),
+        appointments=get_day_appointments(practitioner, date, service_units),
+        absent_events=get_absent_event(practitioner, date),
+    )
+    return {
+        "has_schedule": bool(practitioner_doc.practitioner_schedules or present_events),
+        "slot_details": get_available_slots(practitioner_doc, date, day_data),
+        "present_events": get_present_event_slots(
+            present_events, date, practitioner, day_data
+        ),
+    }
 
+
+def get_schedule_time_slots(practitioner_doc, date):
+    """Time slots of the practitioner's schedules on the weekday of `date`,
+    by schedule
+    """
+    schedules = []
     for schedule_entry in practitioner_doc.practitioner_schedules:
-        if schedule_entry.schedule:
-            practitioner_schedule = frappe.get_doc(
-                "Practitioner Schedule", schedule_entry.schedule
-            )
-        else:
+        if not schedule_entry.schedule:
             frappe.throw(
                 _(
                     "{0} does not have a Healthcare Practitioner Schedule. Add it in Healthcare Practitioner"
-                ).format(frappe.bold(practitioner)),
+                ).format(frappe.bold(practitioner_doc.name)),
                 title=_("Practitioner Schedule Not Found"),
             )
+        schedules.append(schedule_entry.schedule)
+
+    time_slots = {}
+    if not schedules:
+        return time_slots
+
+    for time_slot in frappe.get_all(
+        "Healthcare Schedule Time Slot",
+        filters={
+            "parenttype": "Practitioner Schedule",
+            "parent": ["in", schedules],
+            "day": date.strftime("%A"),
+        },
+        fields=["parent", "day", "from_time", "to_time"],
+        order_by="idx",
+    ):
+        time_slots.setdefault(time_slot.parent, []).append(time_slot)
+    return time_slots
+
+
+def get_service_unit_settings(service_units):
+    if not service_units:
+        return {}
+    return {
+        row.name: row
+        for row in frappe.get_all(
+            "Healthcare Service Unit",
+            filters={"name": ["in", list(service_units)]},
+            fields=["name", "overlap_appointments", "total_service_unit_capacity"],
+        )
+    }
 
-        if practitioner_schedule:
-            available_slots = []
-            for time_slot in practitioner_schedule.time_slots:
-                if weekday == time_slot.day:
-                    available_slots.append(time_slot)
-
-            if available_slots:
-                appointments = []
-                allow_overlap = 0
-                service_unit_capacity = 0
-                # fetch all appointments to practitioner by service unit
-                filters = {
-                    "practitioner": practitioner,
-                    "service_unit": schedule_entry.service_unit,
-                    "appointment_date": date,
-                    "status": ["not in", ["Cancelled"]],
-                }
-
-                if schedule_entry.service_unit:
-                    slot_name = (
-                        schedule_entry.schedule + " - " + schedule_entry.service_unit
-                    )
-                    allow_overlap, service_unit_capacity = frappe.get_value(
-                        "Healthcare Service Unit",
-                        schedule_entry.service_unit,
-                        ["overlap_appointments", "total_service_unit_capacity"],
-                    )
-                    if not allow_overlap:
-                        # fetch all appointments to service unit
-                        filters.pop("practitioner")
-                else:
-                    slot_name = schedule_entry.schedule
-                    # fetch all appointments to practitioner without service unit
-                    filters["practitioner"] = practitioner
-                    filters.pop("service_unit")
-
-                appointments = frappe.get_all(
-                    "Patient Appointment",
-                    filters=filters,
-                    fields=["name", "appointment_time", "duration", "status"],
-                )
 
-                absent_events = get_absent_event(practitioner, date)
-
-                slot_details.append(
-                    {
-                        "slot_name": slot_name,
-                        "service_unit": schedule_entry.service_unit,
-                        "absent_events": absent_events,
-                        "avail_slot": available_slots,
-                        "appointments": appointments,
-                        "allow_overlap": allow_overlap,
-                        "service_unit_capacity": service_unit_capacity,
-                    }
-                )
+def get_day_appointments(practitioner, date, service_units):
+    """Appointments of the practitioner and of the service units on `date`"""
+    or_filters = {"practitioner": practitioner}
+    if service_units:
+        or_filters["service_unit"] = ["in", list(service_units)]
+    return frappe.get_all(
+        "Patient Appointment",
+        filters={"appointment_date": date, "status": ["not in", ["Cancelled"]]},
+        or_filters=or_filters,
+        fields=[
+            "name",
+            "practitioner",
+            "service_unit",
+            "appointment_time",
+            "duration",
+            "status",
+        ],
+        order_by="appointment_date, appointment_time",
+    )
 
-    return slot_details
 
+def get_slot_group(
+    slot_name, service_unit, practitioner, avail_slot, day_data, availability=None
+):
+    allow_overlap = 0
+    service_unit_capacity = 0
+    if service_unit:
+        settings = day_data.service_units.get(service_unit) or {}
+        allow_overlap = settings.get("overlap_appointments") or 0
+        service_unit_capacity = settings.get("total_service_unit_capacity") or 0
+
+    appointments = []
+    for appointment in day_data.appointments:
+        if service_unit:
+            # without overlap every appointment of the service unit blocks it
+            if appointment.service_unit != service_unit:
+                continue
+            if allow_overlap and appointment.practitioner != practitioner:
+                continue
+        elif appointment.practitioner != practitioner:
+            continue
+        appointments.append(appointment)
+
+    slot_group = {
+        "slot_name": slot_name,
+        "service_unit": service_unit,
+        "absent_events": day_data.absent_events,
+        "avail_slot": avail_slot,
+        "appointments": appointments,
+        "allow_overlap": allow_overlap,
+        "service_unit_capacity": service_unit_capacity,
+    }
+    if availability:
+        slot_group["availability"] = availability
+    set_slot_status(slot_group)
+    return slot_group
+
+
+def get_seconds(value):
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    value = get_time(value)
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def set_slot_status(slot_group):
+    """Set booked count, capacity left and disabled on every slot of the group,
+    from its appointments and the absent events of the day.
+    """
+    allow_overlap = cint(slot_group["allow_overlap"])
+    capacity = cint(slot_group["service_unit_capacity"])
+    appointments = [
+        (get_seconds(appointment.appointment_time), flt(appointment.duration))
+        for appointment in slot_group["appointments"]
+        if appointment.appointment_time is not None
+    ]
+    absent_events = [
+        (get_seconds(event.from_time), get_seconds(event.to_time))
+        for event in slot_group["absent_events"]
+    ]
 
-def get_present_event_slots(present_events, date, practitioner):
-    present_events_details = []
-    if present_events:
-        remove_events, add_events = remove_events_by_repeat_on(present_events, date)
-        for e in remove_events:
-            present_events.remove(e)
-        present_events = present_events + add_events
-
-        for present_event in present_events:
-            event_available_slots = []
-            total_time_diff = (
-                time_diff_in_seconds(present_event.to_time, present_event.from_time)
-                / 60
+    for slot in slot_group["avail_slot"]:
+        slot_start = get_seconds(slot["from_time"])
+        slot_end = get_seconds(slot["to_time"])
+        booked = 0
+        disabled = False
+        for start, duration in appointments:
+            # 0 duration appointments block the slot they start in
+            if not duration and slot_start <= start < slot_end:
+                disabled = True
+                break
+            overlaps = slot_start < start + duration * 60 and slot_end > start
+            if not allow_overlap:
+                if overlaps:
+                    disabled = True
+                    break
+            else:
+                if overlaps:
+                    booked += 1
+                if booked >= capacity:
+                    disabled = True
+                    break
+
+        if not disabled:
+            disabled = any(
+                slot_start < to_time and slot_end > from_time
+                for from_time, to_time in absent_events
             )
-            from_time = present_event.from_time
-            slot_name = present_event.availability
-            for x in range(0, int(total_time_diff), present_event.duration):
-                to_time = from_time + datetime.timedelta(
-                    seconds=present_event.duration * 60
-                )
-                event_available_slots.append(
-                    {"from_time": from_time, "to_time": to_time}
-                )
-                from_time = to_time
-            appointments = []
-            if event_available_slots:
-                appointments = []
-                allow_overlap = 0
-                service_unit_capacity = 0
-                # fetch all appointments to practitioner by service unit
-                filters = {
-                    "practitioner": practitioner,
-                    "service_unit": present_event.service_unit,
-                    "appointment_date": date,
-                    "status": ["not in", ["Cancelled"]],
-                }
-
-                if present_event.service_unit:
-                    slot_name = slot_name + " - " + present_event.service_unit
-                    allow_overlap, service_unit_capacity = frappe.get_value(
-                        "Healthcare Service Unit",
-                        present_event.service_unit,
-                        ["overlap_appointments", "total_service_unit_capacity"],
-                    )
-                    if not allow_overlap:
-                        # fetch all appointments to service unit
-                        filters.pop("practitioner")
-                else:
-                    # fetch all appointments to practitioner without service unit
-                    filters["practitioner"] = practitioner
-                    filters.pop("service_unit")
-
-                appointments = frappe.get_all(
-                    "Patient Appointment",
-                    filters=filters,
-                    fields=["name", "appointment_time", "duration", "status"],
-                    order_by="appointment_date, appointment_time",
-                )
 
-                absent_events = get_absent_event(practitioner, date)
-
-                present_events_details.append(
-                    {
-                        "slot_name": slot_name,
-                        "service_unit": present_event.service_unit,
-                        "availability": present_event.name,
-                        "avail_slot": event_available_slots,
-                        "appointments": appointments,
-                        "absent_events": absent_events,
-                        "allow_overlap": allow_overlap,
-                        "service_unit_capacity": service_unit_capacity,
-                    }
-                )
-    return present_events_details
+        slot["booked"] = booked
+        slot["disabled"] = int(disabled)
+        if allow_overlap:
+            slot["capacity_left"] = max(capacity - booked, 0) if not disabled else 0
+        else:
+            slot["capacity_left"] = 0 if disabled else 1
+
 
+def clear_slot_plans(dates=None):
+    """Drop the cached slot plans of `dates`, or of every date, now and again
+    once the transaction is committed.
+    """
 
-def remove_events_by_repeat_on(events_list, date):
-    remove_events = []
-    add_events = []
+    def clear():
+        cache = frappe.cache()
+        if dates is None:
+            cache.delete_keys(slot_plan_key + ":")
+            return
+        for date in set(dates):
+            if date:
+                cache.delete_value(get_slot_plan_key(date))
 
-    weekdays = [
-        "monday",
-        "tuesday",
-        "wednesday",
-        "thursday",
-        "friday",
-        "saturday",
-        "sunday",
-    ]
-    if events_list:
-        i = 0
-        for event in events_list:
-            if event.repeat_this_event:
-                if event.repeat_on == "Every Day":
-                    if event[weekdays[getdate(date).weekday()]]:
-                        add_events.append(event.copy())
-                    remove_events.append(event.copy())
-
-                if event.repeat_on == "Every Week":
-                    if getdate(event.from_date).weekday() == getdate(date).weekday():
-                        add_events.append(event.copy())
-                    remove_events.append(event.copy())
-
-                if event.repeat_on == "Every Month":
-                    if getdate(event.from_date).day == getdate(date).day:
-                        add_events.append(event.copy())
-                    remove_events.append(event.copy())
-
-                if event.repeat_on == "Every Year":
-                    if getdate(event.from_date).strftime("%j") == getdate(
-                        date
-                    ).strftime("%j"):
-                        add_events.append(event.copy())
-                    remove_events.append(event.copy())
-    return remove_events, add_events
+    clear()
+    frappe.db.after_commit.add(clear)
+
+
+def clear_all_slot_plans(doc=None, method=None):
+    clear_slot_plans()
+
+
+def get_present_event(practitioner, date):
+    present_events = get_occurrences(practitioner, date, present=1)
+    return present_events if present_events else ""
+
+
+def get_absent_event(practitioner, date):
+    # Absent events
+    return get_occurrences(practitioner, date, present=0)
+
+
+def get_available_slots(practitioner_doc, date, day_data):
+    slot_details = []
+    practitioner = practitioner_doc.name
+
+    for schedule_entry in practitioner_doc.practitioner_schedules:
+        available_slots = day_data.time_slots.get(schedule_entry.schedule)
+        if not available_slots:
+            continue
+
+        if schedule_entry.service_unit:
+            slot_name = schedule_entry.schedule + " - " + schedule_entry.service_unit
+        else:
+            slot_name = schedule_entry.schedule
+
+        slot_details.append(
+            get_slot_group(
+                slot_name,
+                schedule_entry.service_unit,
+                practitioner,
+                [frappe._dict(time_slot) for time_slot in available_slots],
+                day_data,
+            )
+        )
+
+    return slot_details
+
+
+def get_present_event_slots(present_events, date, practitioner, day_data):
+    present_events_details = []
+    for present_event in present_events or []:
+        event_available_slots = []
+        total_time_diff = (
+            time_diff_in_seconds(present_event.to_time, present_event.from_time) / 60
+        )
+        from_time = present_event.from_time
+        slot_name = present_event.availability
+        for x in range(0, int(total_time_diff), present_event.duration):
+            to_time = from_time + datetime.timedelta(
+                seconds=present_event.duration * 60
+            )
+            event_available_slots.append({"from_time": from_time, "to_time": to_time})
+            from_time = to_time
+
+        if event_available_slots:
+            if present_event.service_unit:
+                slot_name = slot_name + " - " + present_event.service_unit
+            present_events_details.append(
+                get_slot_group(
+                    slot_name,
+                    present_event.service_unit,
+                    practitioner,
+                    event_available_slots,
+                    day_data,
+                    availability=present_event.name,
+                )
+            )
+    return present_events_details
 
 
 @frappe.whitelist()
 def update_status(appointment_id, status):
     frappe.db.set_value("Patient Appointment", appointment_id, "status", status)
+    clear_slot_plans(
+        [frappe.db.get_value("Patient Appointment", appointment_id, "appointment_date")]
+    )
     appointment_booked = True
     if status == "Cancelled":
         appointment_booked = False
@@ -6,7 +6,10 @@ from __future__ import unicode_literals
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils import time_diff_in_seconds, getdate, formatdate
+from frappe.utils import time_diff_in_seconds, getdate, formatdate, add_days, cint
+from hms_tz.nhif.doctype.practitioner_availability_detail.practitioner_availability_detail import (
+    get_occurrence_dates,
+)
 
 
 class PractitionerAvailability(Document):
@@ -118,96 +121,39 @@ def validate_service_unit_capacity(doc):
 
 
 def validate_event_overlap(doc):
-    query = """
+    dates = get_occurrence_dates(doc)
+    if not dates:
+        return
+
+    # range scan on the materialized occurrences of the practitioner's other events
+    overlap_doc = frappe.db.sql(
+        """
 		select
-			name, from_date, from_time, to_time, service_unit
+			practitioner_availability as name, from_date, from_time, to_time, service_unit
 		from
-			`tabPractitioner Availability`
+			`tabPractitioner Availability Detail`
 		where
-			name != %(name)s and present = %(present)s
-			and practitioner = %(practitioner)s and docstatus < 2 and
-			(
-				(
-					repeat_this_event = 1
-					and
-					(
-						(from_date between %(from_date)s and %(repeat_till)s)
-						or
-						(ifnull(repeat_till, "3000-01-01") between %(from_date)s and %(repeat_till)s)
-						or
-						(from_date < %(from_date)s and ifnull(repeat_till, "3000-01-01") > %(repeat_till)s)
-					)
-					and
-					(
-						(
-							repeat_on = 'Every Day'
-							and
-							(
-								monday=%(monday)s or tuesday=%(tuesday)s or wednesday=%(wednesday)s or thursday=%(thursday)s
-								or
-								friday=%(friday)s or saturday=%(saturday)s or sunday=%(sunday)s
-							)
-						)
-						or
-						(
-							repeat_on = 'Every Month'
-							and
-							(
-								month(%(from_date)s)=month(from_date)
-							)
-						)
-					)
-				)
-				or
-				(
-					repeat_this_event != 1
-					and
-					(
-						(%(from_date)s between from_date and to_date)
-						or
-						(%(to_date)s between from_date and to_date)
-						or
-						(%(from_date)s < from_date and %(to_date)s > to_date)
-					)
-				)
-			)
-			and
-			(
-				(from_time >= %(from_time)s and from_time < %(to_time)s)
-				or
-				(to_time > %(from_time)s and to_time <= %(to_time)s)
-				or
-				(from_time between %(from_time)s and %(to_time)s) and (to_time between %(from_time)s and %(to_time)s)
-				or
-				(from_time < %(from_time)s and to_time > %(to_time)s)
-			)
-		"""
-
-    if not doc.name:
-        # hack! if name is null, it could cause problems with !=
-        doc.name = "New " + doc.doctype
-
-    overlap_doc = frappe.db.sql(
-        query.format(doc.doctype),
+			practitioner = %(practitioner)s and from_date >= %(from_date)s and from_date < %(to_date)s
+			and present = %(present)s and practitioner_availability != %(name)s
+			and from_time < %(to_time)s and to_time > %(from_time)s
+		order by
+			from_date
+		""",
         {
             "practitioner": doc.get("practitioner"),
-            "from_date": doc.from_date,
-            "to_date": doc.to_date,
+            "from_date": dates[0],
+            "to_date": add_days(dates[-1], 1),
             "from_time": doc.from_time,
-            "repeat_till": doc.repeat_till or "3000-01-01",
             "to_time": doc.to_time,
-            "name": doc.name,
-            "present": doc.present,
-            "monday": 1 if doc.monday == 1 else 2,
-            "tuesday": 1 if doc.tuesday == 1 else 2,
-            "wednesday": 1 if doc.wednesday == 1 else 2,
-            "thursday": 1 if doc.thursday == 1 else 2,
-            "friday": 1 if doc.friday == 1 else 2,
-            "saturday": 1 if doc.saturday == 1 else 2,
-            "sunday": 1 if doc.sunday == 1 else 2,
+            "name": doc.name or "",
+            "present": cint(doc.present),
         },
         as_dict=1,
     )
+    dates = set(dates)
+    overlap_doc = [
+        overlap for overlap in overlap_doc if getdate(overlap.from_date) in dates
+    ]
 
     if overlap_doc:
         if doc.service_unit:
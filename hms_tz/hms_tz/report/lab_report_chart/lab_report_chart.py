@@ -5,6 +5,7 @@ import frappe
 from frappe import msgprint, _
 import pandas as pd
 import numpy as np
+from hms_tz.nhif.api.lab_test import evaluate_results, get_patient_age
 
 
 def execute(filters=None):
@@ -19,6 +20,7 @@ def execute(filters=None):
             )
         )
     else:
+        set_result_status(lab_details)
         lab_colnames = [key for key in lab_details[0].keys()]
         df = pd.DataFrame.from_records(lab_details, columns=lab_colnames)
 
@@ -36,6 +38,35 @@ def execute(filters=None):
     return columns, data
 
 
+def set_result_status(lab_details):
+    """Flag out of range normal results, e.g. 5.9 (H)"""
+    rows_by_patient_date = {}
+    for row in lab_details:
+        if (
+            row.result_type == "Normal"
+            and row.result_value
+            and frappe.get_cached_value("Patient", row.patient, "dob")
+        ):
+            rows_by_patient_date.setdefault(
+                (row.patient, row.patient_sex, row.result_date), []
+            ).append(row)
+
+    for (patient, patient_sex, result_date), rows in rows_by_patient_date.items():
+        results = evaluate_results(
+            [
+                {"lab_test_name": row.normal_test_name, "result_value": row.result_value}
+                for row in rows
+            ],
+            get_patient_age(patient, result_date),
+            patient_sex,
+        )
+        for row, normals in zip(rows, results):
+            if normals and normals.get("result_status") in ("L", "H"):
+                row.result_value = "{0} ({1})".format(
+                    row.result_value, normals["result_status"]
+                )
+
+
 def get_columns(filters):
     columns = [
         {"fieldname": "lab_test_name", "fieldtype": "Data", "label": _("Lab Test Name")}
@@ -61,25 +92,29 @@ def get_lab_results(filters):
 
     return frappe.db.sql(
         """
-		select lb.lab_test_name as lab_test_name,  date_format(lb.result_date, '%%Y-%%m-%%d') as result_date, n.result_value as result_value
+		select lb.lab_test_name as lab_test_name,  date_format(lb.result_date, '%%Y-%%m-%%d') as result_date, n.result_value as result_value,
+		lb.patient as patient, lb.patient_sex as patient_sex, 'Normal' as result_type, n.lab_test_name as normal_test_name
 		from `tabLab Test` lb inner join `tabNormal Test Result` n on lb.name = n.parent
 		where lb.docstatus = 1
         and lb.lab_test_name not in (select lbt.lab_test_name from `tabLab Test Template` lbt where lbt.lab_test_template_type="Grouped")
 		and lb.status = "Completed" {conditions}
 		union
-		select lb.lab_test_name as lab_test_name,  date_format(lb.result_date, '%%Y-%%m-%%d') as result_date, d.result_value as result_value
+		select lb.lab_test_name as lab_test_name,  date_format(lb.result_date, '%%Y-%%m-%%d') as result_date, d.result_value as result_value,
+		lb.patient as patient, lb.patient_sex as patient_sex, 'Other' as result_type, null as normal_test_name
 		from `tabLab Test` lb inner join `tabDescriptive Test Result` d on lb.name = d.parent
 		where lb.docstatus = 1
         and lb.lab_test_name not in (select lbt.lab_test_name from `tabLab Test Template` lbt where lbt.lab_test_template_type="Grouped")
 		and lb.status = "Completed" {conditions}
 		union
-		select lb.lab_test_name as lab_test_name,  date_format(lb.result_date, '%%Y-%%m-%%d') as result_date, org.colony_population as result_value
+		select lb.lab_test_name as lab_test_name,  date_format(lb.result_date, '%%Y-%%m-%%d') as result_date, org.colony_population as result_value,
+		lb.patient as patient, lb.patient_sex as patient_sex, 'Other' as result_type, null as normal_test_name
 		from `tabLab Test` lb inner join `tabOrganism Test Result` org on lb.name = org.parent
 		where lb.docstatus = 1
         and lb.lab_test_name not in (select lbt.lab_test_name from `tabLab Test Template` lbt where lbt.lab_test_template_type="Grouped")
 		and lb.status = "Completed" {conditions}
 		union
-		select lb.lab_test_name as lab_test_name,  date_format(lb.result_date, '%%Y-%%m-%%d') as result_date, ss.antibiotic_sensitivity as result_value
+		select lb.lab_test_name as lab_test_name,  date_format(lb.result_date, '%%Y-%%m-%%d') as result_date, ss.antibiotic_sensitivity as result_value,
+		lb.patient as patient, lb.patient_sex as patient_sex, 'Other' as result_type, null as normal_test_name
 		from `tabLab Test` lb inner join `tabSensitivity Test Result` ss on lb.name = ss.parent
 		where lb.docstatus = 1
         and lb.lab_test_name not in (select lbt.lab_test_name from `tabLab Test Template` lbt where lbt.lab_test_template_type="Grouped")
@@ -165,15 +165,25 @@ doc_events = {
         "validate": "hms_tz.nhif.api.insurance_subscription.validate",
     },
     "Practitioner Availability": {
-        "validate": "hms_tz.nhif.api.practitioner_availability.validate",
-        "on_trash": "hms_tz.nhif.api.practitioner_availability.on_trash",
+        "on_update": [
+            "hms_tz.nhif.api.practitioner_availability.on_update",
+            "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_all_slot_plans",
+        ],
+        "on_trash": [
+            "hms_tz.nhif.api.practitioner_availability.on_trash",
+            "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_all_slot_plans",
+        ],
     },
     "Lab Test": {
         "onload":"hms_tz.nhif.api.lab_test.onload",
         "before_submit": "hms_tz.nhif.api.lab_test.before_submit",
         "on_submit": "hms_tz.nhif.api.lab_test.on_submit",
-        "after_insert": "hms_tz.nhif.api.lab_test.after_insert",
+        "after_insert": [
+            "hms_tz.nhif.api.lab_test.after_insert",
+            "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_ordered_service_insert",
+        ],
         "on_trash": "hms_tz.nhif.api.lab_test.on_trash",
+        "after_delete": "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_ordered_service_delete",
         "on_cancel": "hms_tz.nhif.api.lab_test.on_cancel",
         "validate": "hms_tz.nhif.api.lab_test.validate",
     },
@@ -183,20 +193,30 @@ doc_events = {
         "on_submit": "hms_tz.nhif.api.radiology_examination.on_submit",
         "validate": "hms_tz.nhif.api.radiology_examination.validate",
         "on_cancel": "hms_tz.nhif.api.radiology_examination.on_cancel",
+        "after_insert": "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_ordered_service_insert",
+        "after_delete": "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_ordered_service_delete",
     },
     "Clinical Procedure": {
         "onload":"hms_tz.nhif.api.clinical_procedure.onload",
         "before_submit": "hms_tz.nhif.api.clinical_procedure.before_submit",
         "on_submit": "hms_tz.nhif.api.clinical_procedure.on_submit",
         "validate": "hms_tz.nhif.api.clinical_procedure.validate",
+        "after_insert": "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_ordered_service_insert",
+        "after_delete": "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_ordered_service_delete",
     },
     "Delivery Note": {
         "validate": "hms_tz.nhif.api.delivery_note.validate",
         "onload": "hms_tz.nhif.api.delivery_note.onload",
         "after_insert": "hms_tz.nhif.api.delivery_note.after_insert",
         "before_submit": "hms_tz.nhif.api.delivery_note.before_submit",
-        "on_submit": "hms_tz.nhif.api.delivery_note.on_submit",
-        "on_cancel": "hms_tz.nhif.api.delivery_note.on_cancel",
+        "on_submit": [
+            "hms_tz.nhif.api.delivery_note.on_submit",
+            "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_delivery_note_submit",
+        ],
+        "on_cancel": [
+            "hms_tz.nhif.api.delivery_note.on_cancel",
+            "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_delivery_note_cancel",
+        ],
         "on_update_after_submit": "hms_tz.nhif.api.delivery_note.on_update_after_submit",
     },
     "Inpatient Record": {
@@ -215,15 +235,58 @@ doc_events = {
     "Therapy Plan": {
         "before_insert": "hms_tz.nhif.api.therapy_plan.before_insert",
         "validate": "hms_tz.nhif.api.therapy_plan.validate",
+        "on_update": "hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history.on_therapy_plan_update",
     },
     "Therapy Session": {
         "before_insert": "hms_tz.nhif.api.therapy_session.before_insert",
         "after_insert": "hms_tz.nhif.api.therapy_session.after_insert",
         "before_submit": "hms_tz.nhif.api.therapy_session.before_submit",
     },
+    "Lab Test Template": {
+        "on_update": [
+            "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+            "hms_tz.nhif.api.lab_test.clear_reference_ranges",
+        ],
+        "on_trash": [
+            "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+            "hms_tz.nhif.api.lab_test.clear_reference_ranges",
+        ],
+    },
+    "Radiology Examination Template": {
+        "on_update": "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+        "on_trash": "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+    },
+    "Clinical Procedure Template": {
+        "on_update": "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+        "on_trash": "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+    },
+    "Medication": {
+        "on_update": "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+        "on_trash": "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+    },
+    "Therapy Type": {
+        "on_update": "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+        "on_trash": "hms_tz.nhif.api.healthcare_utils.clear_template_meta_cache",
+    },
+    "Item Price": {
+        "on_update": "hms_tz.nhif.api.healthcare_utils.clear_item_price_cache",
+        "on_trash": "hms_tz.nhif.api.healthcare_utils.clear_item_price_cache",
+    },
     "Patient Medical Record": {
         "before_insert": "hms_tz.nhif.api.medical_record.before_insert",
     },
+    "Healthcare Practitioner": {
+        "on_update": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_all_slot_plans",
+        "on_trash": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_all_slot_plans",
+    },
+    "Practitioner Schedule": {
+        "on_update": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_all_slot_plans",
+        "on_trash": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_all_slot_plans",
+    },
+    "Healthcare Service Unit": {
+        "on_update": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_all_slot_plans",
+        "on_trash": "hms_tz.hms_tz.doctype.patient_appointment.patient_appointment.clear_all_slot_plans",
+    },
 }
 
 # standard_queries = {
@@ -238,8 +301,15 @@ scheduler_events = {
     # 		"hms_tz.tasks.all"
     # 	],
     # "cron": {"*/1 * * * *": ["hms_tz.nhif.api.service_order.real_auto_submit"]},
-    "hourly": ["hms_tz.nhif.api.healthcare_utils.set_uninvoiced_so_closed"],
-    "daily": ["hms_tz.nhif.api.inpatient_record.daily_update_inpatient_occupancies"],
+    "hourly": [
+        "hms_tz.nhif.api.healthcare_utils.set_uninvoiced_so_closed",
+        "hms_tz.nhif.doctype.healthcare_invoice_outbox.healthcare_invoice_outbox.requeue_uncreated_items",
+    ],
+    "daily": [
+        "hms_tz.nhif.api.inpatient_record.daily_update_inpatient_occupancies",
+        "hms_tz.nhif.doctype.practitioner_availability_detail.practitioner_availability_detail.extend_occurrence_horizon",
+        "hms_tz.nhif.doctype.nhif_response_log.nhif_response_log.delete_orphaned_payloads",
+    ],
     "cron": {
         # Routine for every day 00:01 am at night
         "1 0 * * *": [
@@ -253,10 +323,14 @@ scheduler_events = {
         "30 2 * * *": [
             "hms_tz.nhif.api.healthcare_utils.delete_or_cancel_draft_document"
         ],
-        # Routine for every 10min
-        "*/10 * * * *": [
-            "hms_tz.nhif.api.healthcare_utils.create_invoiced_items_if_not_created"
+        # Routine for every minute
+        "* * * * *": [
+            "hms_tz.nhif.doctype.nhif_response_log.nhif_response_log.flush_log_queue",
+            "hms_tz.nhif.doctype.healthcare_invoice_outbox.healthcare_invoice_outbox.process_outbox",
+            "hms_tz.nhif.doctype.lab_machine_message.lab_machine_message.process_lab_machine_messages",
         ],
+        # Routine for every 5min
+        "*/5 * * * *": ["hms_tz.nhif.api.token.refresh_nhif_tokens"],
         # Routine for every day every after 30min from 03:00am to 05:00am
         "*/30 3-4 * * *": [
             "hms_tz.nhif.api.healthcare_utils.auto_finalize_patient_encounters"
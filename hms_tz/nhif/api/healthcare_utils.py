@@ -6,7 +6,6 @@ from __future__ import unicode_literals
 import frappe
 from frappe import _
 import datetime
-import requests
 from hms_tz.hms_tz.utils import validate_customer_created
 from frappe.utils import (
     nowdate,
@@ -16,14 +15,23 @@ from frappe.utils import (
     get_url_to_form,
     add_days,
     create_batch,
+    cint,
+    now,
+    get_datetime,
+    time_diff_in_seconds,
 )
 from datetime import timedelta
+from time import sleep
+import random
 import base64
 import re
 import json
+from redis.exceptions import LockNotOwnedError
 from frappe.model.workflow import apply_workflow
+from frappe.model.naming import parse_naming_series
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
 from hms_tz.nhif.api.token import get_nhifservice_token
+from hms_tz.nhif.api.nhif_client import nhif_request
 from frappe.query_builder import DocType
 
 @frappe.whitelist()
@@ -37,7 +45,11 @@ def get_healthcare_services_to_invoice(
         # Customer validated, build a list of billable services
         if encounter:
             items_to_invoice += get_healthcare_service_order_to_invoice(
-                patient, company, encounter, service_order_category, prescribed
+                patient,
+                company,
+                encounter,
+                service_order_category=service_order_category,
+                prescribed=prescribed,
             )
         return items_to_invoice
 
@@ -106,112 +118,241 @@ def get_healthcare_service_order_to_invoice(
         )
 
     inpatient_record = None
-    encounter_list = []
     for i in encounter_dict:
-        if not inpatient_record and i.inpatient_record:
+        if i.inpatient_record:
             inpatient_record = i.inpatient_record
+            break
 
-        encounter_doc = frappe.get_doc("Patient Encounter", i.name)
-        encounter_list.append(encounter_doc)
-    childs_map = get_childs_map()
-    services_to_invoice = []
+    return get_uninvoiced_services(
+        [i.name for i in encounter_dict], inpatient_record=inpatient_record
+    )
 
-    for en in encounter_list:
-        for key, value in childs_map.items():
-            table = en.get(value.get("table"))
-            if not table:
-                continue
-            for row in table:
-                if (
-                    not row.get("invoiced")
-                    and row.get("prescribe")
-                    and not row.get("is_not_available_inhouse")
-                    and not row.get("is_cancelled")
-                ):
-                    item_code = frappe.get_cached_value(
-                        value.get("template"),
-                        row.get(value.get("item")),
-                        "item",
-                    )
 
-                    qty = 1
-                    if value.get("doctype") == "Therapy Plan Detail":
-                        qty = (row.get("no_of_sessions") or 0) - (
-                            row.get("sessions_cancelled") or 0
-                        )
+def get_uninvoiced_services(
+    encounters, inpatient_record=None, start=0, page_length=None
+):
+    """Return the billable services of the encounters that are not invoiced yet.
 
-                    if value.get("doctype") == "Drug Prescription":
-                        qty = (row.get("quantity") or 0) - (
-                            row.get("quantity_returned") or 0
-                        )
+    Rows of the five prescription tables, and the confirmed occupancies and
+    consultancies of `inpatient_record`, are read with one query joined to the
+    templates for their items, ordered so they can be fetched in pages with
+    `start` and `page_length`.
+    """
+    if not encounters and not inpatient_record:
+        return []
+
+    queries = []
+    if encounters:
+        for sort_order, value in enumerate(get_childs_map().values()):
+            qty = "1"
+            if value.get("doctype") == "Therapy Plan Detail":
+                qty = "IFNULL(child.no_of_sessions, 0) - IFNULL(child.sessions_cancelled, 0)"
+            elif value.get("doctype") == "Drug Prescription":
+                qty = "IFNULL(child.quantity, 0) - IFNULL(child.quantity_returned, 0)"
+
+            queries.append(
+                """
+                SELECT '{doctype}' AS reference_type, child.name AS reference_name,
+                    template.item AS service, {qty} AS qty,
+                    0 AS source_order, child.parent AS parent,
+                    {sort_order} AS sort_order, child.idx AS idx
+                FROM `tab{doctype}` child
+                LEFT JOIN `tab{template}` template ON template.name = child.`{item}`
+                WHERE child.parent IN %(encounters)s
+                  AND child.parenttype = 'Patient Encounter'
+                  AND child.invoiced = 0
+                  AND child.prescribe = 1
+                  AND child.is_not_available_inhouse = 0
+                  AND child.is_cancelled = 0
+                """.format(
+                    doctype=value.get("doctype"),
+                    template=value.get("template"),
+                    item=value.get("item"),
+                    qty=qty,
+                    sort_order=sort_order,
+                )
+            )
 
-                    services_to_invoice.append(
-                        {
-                            "reference_type": row.doctype,
-                            "reference_name": row.name,
-                            "service": item_code,
-                            "qty": qty,
-                        }
-                    )
+    if inpatient_record:
+        queries.append(
+            """
+            SELECT 'Inpatient Occupancy' AS reference_type, io.name AS reference_name,
+                hsut.item_code AS service, 1 AS qty,
+                1 AS source_order, io.parent AS parent, 0 AS sort_order, io.idx AS idx
+            FROM `tabInpatient Occupancy` io
+            LEFT JOIN `tabHealthcare Service Unit` hsu ON hsu.name = io.service_unit
+            LEFT JOIN `tabHealthcare Service Unit Type` hsut
+                ON hsut.name = hsu.service_unit_type
+            WHERE io.parent = %(inpatient_record)s
+              AND io.parenttype = 'Inpatient Record'
+              AND io.is_confirmed = 1
+              AND io.invoiced = 0
+            """
+        )
+        queries.append(
+            """
+            SELECT 'Inpatient Consultancy' AS reference_type, ic.name AS reference_name,
+                ic.consultation_item AS service, 1 AS qty,
+                1 AS source_order, ic.parent AS parent, 1 AS sort_order, ic.idx AS idx
+            FROM `tabInpatient Consultancy` ic
+            WHERE ic.parent = %(inpatient_record)s
+              AND ic.parenttype = 'Inpatient Record'
+              AND ic.is_confirmed = 1
+              AND ic.hms_tz_invoiced = 0
+            """
+        )
+
+    limit = ""
+    if page_length:
+        limit = "LIMIT {0}, {1}".format(cint(start), cint(page_length))
 
+    services = frappe.db.sql(
+        """
+        SELECT reference_type, reference_name, service, qty
+        FROM ({0}) services
+        ORDER BY source_order, parent, sort_order, idx
+        {1}
+        """.format(
+            " UNION ALL ".join(queries), limit
+        ),
+        {
+            "encounters": tuple(encounters or [""]),
+            "inpatient_record": inpatient_record,
+        },
+        as_dict=1,
+    )
+    return services
+
+
+def iter_uninvoiced_services(encounters, inpatient_record=None, page_length=500):
+    """Yield the uninvoiced services page by page, for long admissions"""
+    start = 0
+    while True:
+        services = get_uninvoiced_services(
+            encounters, inpatient_record, start=start, page_length=page_length
+        )
+        for service in services:
+            yield service
+        if len(services) < page_length:
+            break
+        start += page_length
+
+
+@frappe.whitelist()
+def get_uninvoiced_services_page(
+    patient, appointment, inpatient_record=None, start=0, page_length=100
+):
+    """One page of the services of an appointment not invoiced yet"""
+    frappe.has_permission("Sales Invoice", "create", throw=True)
+
+    filters = {
+        "patient": patient,
+        "appointment": appointment,
+        "docstatus": 1,
+        "is_not_billable": 0,
+    }
     if inpatient_record:
-        inpatient_doc = frappe.get_doc("Inpatient Record", inpatient_record)
-        for row in inpatient_doc.inpatient_occupancies:
-            if row.is_confirmed == 0 or row.invoiced == 1:
-                continue
+        filters["inpatient_record"] = inpatient_record
+    encounters = frappe.get_all("Patient Encounter", filters=filters, pluck="name")
+    return get_uninvoiced_services(
+        encounters,
+        inpatient_record=inpatient_record,
+        start=start,
+        page_length=cint(page_length) or 100,
+    )
 
-            service_unit_type = frappe.get_cached_value(
-                "Healthcare Service Unit", row.service_unit, "service_unit_type"
-            )
-            item_code = frappe.get_cached_value(
-                "Healthcare Service Unit Type", service_unit_type, "item_code"
-            )
-            services_to_invoice.append(
-                {
-                    "reference_type": row.doctype,
-                    "reference_name": row.name,
-                    "service": item_code,
-                    "qty": 1,
-                }
-            )
 
-        for row in inpatient_doc.inpatient_consultancy:
-            if row.is_confirmed == 0 or row.hms_tz_invoiced == 1:
-                continue
+def get_item_price_cache_key(price_list, currency):
+    return "hms_tz_item_price:{0}:{1}".format(price_list, currency)
 
-            services_to_invoice.append(
-                {
-                    "reference_type": row.doctype,
-                    "reference_name": row.name,
-                    "service": row.consultation_item,
-                    "qty": 1,
-                }
-            )
-    return services_to_invoice
 
+def get_item_prices(item_codes, price_list, company):
+    """Return {item_code: rate} of `price_list` in the company currency.
 
-def get_item_price(item_code, price_list, company):
-    price = 0
+    Rates are memoized for the request and kept in a redis hash per price list,
+    which is cleared whenever an Item Price of that list changes. Items without
+    a price are returned with 0.
+    """
     company_currency = frappe.get_cached_value("Company", company, "default_currency")
-    item_prices_data = frappe.get_all(
-        "Item Price",
-        fields=["item_code", "price_list_rate", "currency"],
-        filters={
-            "price_list": price_list,
-            "item_code": item_code,
-            "currency": company_currency,
-        },
-        order_by="valid_from desc",
-    )
-    if len(item_prices_data):
-        price = item_prices_data[0].price_list_rate
-    return price
+    if frappe.flags.hms_tz_item_prices is None:
+        frappe.flags.hms_tz_item_prices = {}
+    local_cache = frappe.flags.hms_tz_item_prices
+    cache_key = get_item_price_cache_key(price_list, company_currency)
+
+    prices = {}
+    missing = []
+    for item_code in set(item_codes):
+        if (cache_key, item_code) in local_cache:
+            prices[item_code] = local_cache[(cache_key, item_code)]
+            continue
+        price = frappe.cache().hget(cache_key, item_code)
+        if price is None:
+            missing.append(item_code)
+        else:
+            prices[item_code] = local_cache[(cache_key, item_code)] = price
+
+    if missing:
+        item_prices_data = frappe.get_all(
+            "Item Price",
+            fields=["item_code", "price_list_rate", "currency"],
+            filters={
+                "price_list": price_list,
+                "item_code": ["in", missing],
+                "currency": company_currency,
+            },
+            order_by="valid_from desc",
+        )
+        found = {}
+        for item_price in item_prices_data:
+            found.setdefault(item_price.item_code, item_price.price_list_rate)
+        for item_code in missing:
+            price = found.get(item_code) or 0
+            frappe.cache().hset(cache_key, item_code, price)
+            prices[item_code] = local_cache[(cache_key, item_code)] = price
+
+    return prices
+
+
+def get_item_price(item_code, price_list, company):
+    return get_item_prices([item_code], price_list, company).get(item_code) or 0
+
+
+def clear_item_price_cache(doc, method=None):
+    """Drop cached rates of the Item Price's price list, hooked on Item Price changes"""
+    price_lists = {(doc.price_list, doc.currency)}
+    doc_before_save = doc.get_doc_before_save() if method == "on_update" else None
+    if doc_before_save:
+        price_lists.add((doc_before_save.price_list, doc_before_save.currency))
+    for price_list, currency in price_lists:
+        clear_price_list_cache(price_list, currency)
+
+
+def clear_price_list_cache(price_list, currency):
+    frappe.cache().delete_key(get_item_price_cache_key(price_list, currency))
+    frappe.flags.hms_tz_item_prices = None
 
 
 @frappe.whitelist()
 def get_item_rate(item_code, company, insurance_subscription, insurance_company=None):
+    return get_item_rates(
+        [item_code], company, insurance_subscription, insurance_company
+    ).get(item_code)
+
+
+@frappe.whitelist()
+def get_item_rates(item_codes, company, insurance_subscription, insurance_company=None):
+    """Return {item_code: rate} for all items, resolving the price lists once.
+
+    Each item is looked up in the plan's price list, then its secondary price
+    list, then the insurance company's default price list, same as `get_item_rate`.
+    """
+    if isinstance(item_codes, str):
+        item_codes = json.loads(item_codes)
+    item_codes = list(dict.fromkeys(item_codes))
+
+    rates = {}
+    pending = item_codes
     price_list = None
-    price_list_rate = None
     hic_plan = None
     if insurance_subscription:
         hic_plan = frappe.get_cached_value(
@@ -224,32 +365,26 @@ def get_item_rate(item_code, company, insurance_subscription, insurance_company=
             hic_plan,
             ["price_list", "secondary_price_list", "insurance_company"],
         )
-        if price_list:
-            price_list_rate = get_item_price(item_code, price_list, company)
-            if price_list_rate and price_list_rate != 0:
-                return price_list_rate
-            else:
-                price_list_rate = None
-        elif not price_list:
+        if not price_list:
             frappe.throw(
                 _(
                     f"Default price list for {hic_plan} NOT FOUND!<br>Please set Price List in {hic_plan} plan"
                 )
             )
-        if not price_list_rate:
-            if price_list and not secondary_price_list:
-                frappe.throw(
-                    _(
-                        f"Item Price for {item_code} not found in Default Price List and Secondary price list for {hic_plan} not set!<br>Please set Item rate in {price_list} or set a Secondary Price List in {hic_plan} plan"
-                    )
+        pending = set_found_rates(rates, pending, price_list, company)
+        if pending and not secondary_price_list:
+            frappe.throw(
+                _(
+                    f"Item Price for {pending[0]} not found in Default Price List and Secondary price list for {hic_plan} not set!<br>Please set Item rate in {price_list} or set a Secondary Price List in {hic_plan} plan"
                 )
-            price_list_rate = get_item_price(item_code, secondary_price_list, company)
-            if price_list_rate and price_list_rate != 0:
-                return price_list_rate
-            else:
-                price_list_rate = None
+            )
+        if pending:
+            pending = set_found_rates(rates, pending, secondary_price_list, company)
+
+    if not pending:
+        return rates
 
-    if not price_list_rate and insurance_company:
+    if insurance_company:
         price_list = frappe.get_cached_value(
             "Healthcare Insurance Company", insurance_company, "default_price_list"
         )
@@ -259,14 +394,102 @@ def get_item_rate(item_code, company, insurance_subscription, insurance_company=
                 f"Default price list for {hic_plan} NOT FOUND!<br>Please set Price List in {insurance_company} insurance company"
             )
         )
-    else:
-        price_list_rate = get_item_price(item_code, price_list, company)
-    if price_list_rate and price_list_rate != 0:
-        return price_list_rate
-    else:
+    pending = set_found_rates(rates, pending, price_list, company)
+    if pending:
         frappe.throw(
-            _(f"Please set Price List for item: {item_code} in price list {price_list}")
+            _(f"Please set Price List for item: {pending[0]} in price list {price_list}")
         )
+    return rates
+
+
+def set_found_rates(rates, item_codes, price_list, company):
+    """Copy the non zero rates of `price_list` into `rates`, return the items still unpriced"""
+    prices = get_item_prices(item_codes, price_list, company)
+    pending = []
+    for item_code in item_codes:
+        if prices.get(item_code):
+            rates[item_code] = prices[item_code]
+        else:
+            pending.append(item_code)
+    return pending
+
+
+template_meta_fields = ("is_inpatient", "medication_category")
+
+
+def get_template_meta_cache_key(doctype):
+    return "hms_tz_template_meta:{0}".format(doctype)
+
+
+def get_templates_meta(doctype, names):
+    """Return {template: meta} with the fields encounter validation reads from templates.
+
+    Each meta holds `disabled`, `item`, `is_inpatient`, `medication_category` and
+    `company_options` as {company: service_unit}. Entries live in a redis hash
+    per template doctype, cleared from the templates' on_update and on_trash.
+    Templates not in the cache are loaded with one query.
+    """
+    cache_key = get_template_meta_cache_key(doctype)
+    templates_meta = {}
+    missing = []
+    for name in set(names):
+        if not name:
+            continue
+        meta = frappe.cache().hget(cache_key, name)
+        if meta is None:
+            missing.append(name)
+        else:
+            templates_meta[name] = meta
+
+    if not missing:
+        return templates_meta
+
+    doctype_meta = frappe.get_meta(doctype)
+    extra_fields = [
+        "t.`{0}`".format(field)
+        for field in template_meta_fields
+        if doctype_meta.has_field(field)
+    ]
+    rows = frappe.db.sql(
+        """
+        SELECT t.name, t.disabled, t.item, {extra_fields}
+            o.company AS option_company, o.service_unit AS option_service_unit
+        FROM `tab{doctype}` t
+        LEFT JOIN `tabHealthcare Company Option` o
+            ON o.parent = t.name
+            AND o.parenttype = %(doctype)s
+            AND o.parentfield = 'company_options'
+        WHERE t.name IN %(names)s
+        ORDER BY o.idx
+        """.format(
+            extra_fields="".join(field + ", " for field in extra_fields),
+            doctype=doctype,
+        ),
+        {"doctype": doctype, "names": tuple(missing)},
+        as_dict=1,
+    )
+    loaded = {}
+    for row in rows:
+        meta = loaded.get(row.name)
+        if not meta:
+            meta = loaded[row.name] = frappe._dict(
+                disabled=row.disabled,
+                item=row.item,
+                is_inpatient=row.get("is_inpatient"),
+                medication_category=row.get("medication_category"),
+                company_options={},
+            )
+        if row.option_company:
+            meta.company_options[row.option_company] = row.option_service_unit
+
+    for name, meta in loaded.items():
+        frappe.cache().hset(cache_key, name, meta)
+        templates_meta[name] = meta
+    return templates_meta
+
+
+def clear_template_meta_cache(doc, method=None):
+    frappe.cache().hdel(get_template_meta_cache_key(doc.doctype), doc.name)
 
 
 def to_base64(value):
@@ -384,6 +607,36 @@ def get_warehouse_from_service_unit(healthcare_service_unit):
     return warehouse
 
 
+def get_stock_availabilities(pairs):
+    """Return {(item_code, warehouse): actual_qty} for all pairs with one query on Bin.
+
+    Pairs without a Bin have never had stock and are returned with 0.
+    """
+    pairs = {(item_code, warehouse) for item_code, warehouse in pairs if item_code and warehouse}
+    if not pairs:
+        return {}
+
+    bins = frappe.get_all(
+        "Bin",
+        fields=["item_code", "warehouse", "actual_qty"],
+        filters={
+            "item_code": ["in", list({pair[0] for pair in pairs})],
+            "warehouse": ["in", list({pair[1] for pair in pairs})],
+        },
+    )
+    stock = dict.fromkeys(pairs, 0)
+    for row in bins:
+        if (row.item_code, row.warehouse) in stock:
+            stock[(row.item_code, row.warehouse)] = row.actual_qty or 0
+    return stock
+
+
+def get_stock_availability(item_code, warehouse):
+    return get_stock_availabilities([(item_code, warehouse)]).get(
+        (item_code, warehouse), 0
+    )
+
+
 def get_item_form_LRPT(LRPT_doc):
     item = frappe._dict()
     comapny_option = get_template_company_option(LRPT_doc.template, LRPT_doc.company)
@@ -1194,179 +1447,6 @@ def return_quatity_or_cancel_delivery_note_via_lrpmt_returns(source_doc, method)
         target_doc.submit()
 
 
-def create_invoiced_items_if_not_created():
-    """create pending LRP item(s) after submission of sales invoice"""
-
-    from frappe.query_builder import DocType as dt
-
-    si = dt("Sales Invoice")
-    sii = dt("Sales Invoice Item")
-
-    si_invoices = (
-        frappe.qb.from_(si)
-        .inner_join(sii)
-        .on(si.name == sii.parent)
-        .select(si.name.as_("name"))
-        .where(
-            si.patient.isnotnull()
-            & (si.docstatus == 1)
-            & (si.posting_date == nowdate())
-            & (sii.hms_tz_is_lrp_item_created == 0)
-        )
-    ).run(as_dict=1)
-
-    for invoice in si_invoices:
-        si_doc = frappe.get_doc("Sales Invoice", invoice.name)
-
-        therapy_items = []
-
-        for item in si_doc.items:
-            if item.reference_dt in [
-                "Lab Prescription",
-                "Radiology Procedure Prescription",
-                "Procedure Prescription",
-            ]:
-                if item.hms_tz_is_lrp_item_created == 1:
-                    continue
-
-                try:
-                    child = frappe.get_doc(item.reference_dt, item.reference_dn)
-                    patient_encounter_doc = frappe.get_doc(
-                        "Patient Encounter", child.parent
-                    )
-
-                    if child.doctype == "Lab Prescription":
-                        ltt_doc = frappe.get_cached_doc(
-                            "Lab Test Template", child.lab_test_code
-                        )
-
-                        lab_doc = frappe.get_doc(
-                            {
-                                "doctype": "Lab Test",
-                                "patient": patient_encounter_doc.patient,
-                                "patient_sex": patient_encounter_doc.patient_sex,
-                                "company": patient_encounter_doc.company,
-                                "template": ltt_doc.name,
-                                "practitioner": patient_encounter_doc.practitioner,
-                                "source": patient_encounter_doc.source,
-                                "prescribe": child.prescribe,
-                                "insurance_subscription": (
-                                    patient_encounter_doc.insurance_subscription
-                                    if patient_encounter_doc.insurance_subscription
-                                    else ""
-                                ),
-                                "appointment": patient_encounter_doc.appointment,
-                                "ref_doctype": patient_encounter_doc.doctype,
-                                "ref_docname": patient_encounter_doc.name,
-                                "hms_tz_ref_childname": child.name,
-                                "invoiced": 1,
-                                "prescribe": 1,
-                                "service_comment": child.medical_code
-                                or "No ICD Code" + " : " + child.lab_test_comment
-                                or "No Comment",
-                            }
-                        )
-                        lab_doc.insert(ignore_permissions=True, ignore_mandatory=True)
-                        if lab_doc.name:
-                            child.lab_test_created = 1
-                            child.invoiced = 1
-                            child.sales_invoice_number = item.parent
-                            child.db_update()
-
-                    elif child.doctype == "Radiology Procedure Prescription":
-                        radiology_doc = frappe.get_doc(
-                            {
-                                "doctype": "Radiology Examination",
-                                "patient": patient_encounter_doc.patient,
-                                "company": patient_encounter_doc.company,
-                                "radiology_examination_template": child.radiology_examination_template,
-                                "practitioner": patient_encounter_doc.practitioner,
-                                "source": patient_encounter_doc.source,
-                                "prescribe": child.prescribe,
-                                "insurance_subscription": (
-                                    patient_encounter_doc.insurance_subscription
-                                    if patient_encounter_doc.insurance_subscription
-                                    else ""
-                                ),
-                                "medical_department": frappe.get_cached_value(
-                                    "Radiology Examination Template",
-                                    child.radiology_examination_template,
-                                    "medical_department",
-                                ),
-                                "appointment": patient_encounter_doc.appointment,
-                                "ref_doctype": patient_encounter_doc.doctype,
-                                "ref_docname": patient_encounter_doc.name,
-                                "hms_tz_ref_childname": child.name,
-                                "invoiced": 1,
-                                "prescribe": 1,
-                                "service_comment": child.medical_code
-                                or "No ICD Code" + " : " + child.radiology_test_comment
-                                or "No Comment",
-                            }
-                        )
-                        radiology_doc.insert(
-                            ignore_permissions=True, ignore_mandatory=True
-                        )
-                        if radiology_doc.name:
-                            child.radiology_examination_created = 1
-                            child.invoiced = 1
-                            child.sales_invoice_number = item.parent
-                            child.db_update()
-
-                    elif child.doctype == "Procedure Prescription":
-                        procedure_doc = frappe.get_doc(
-                            {
-                                "doctype": "Clinical Procedure",
-                                "patient": patient_encounter_doc.patient,
-                                "patient_sex": patient_encounter_doc.patient_sex,
-                                "company": patient_encounter_doc.company,
-                                "procedure_template": child.procedure,
-                                "practitioner": patient_encounter_doc.practitioner,
-                                "source": patient_encounter_doc.source,
-                                "prescribe": child.prescribe,
-                                "insurance_subscription": patient_encounter_doc.insurance_subscription,
-                                "medical_department": frappe.get_cached_value(
-                                    "Clinical Procedure Template",
-                                    child.procedure,
-                                    "medical_department",
-                                ),
-                                "appointment": patient_encounter_doc.appointment,
-                                "ref_doctype": patient_encounter_doc.doctype,
-                                "ref_docname": patient_encounter_doc.name,
-                                "hms_tz_ref_childname": child.name,
-                                "invoiced": 1,
-                                "prescribe": 1,
-                                "service_comment": child.medical_code
-                                or "No ICD Code" + " : " + child.comments
-                                or "No Comment",
-                            }
-                        )
-                        procedure_doc.insert(
-                            ignore_permissions=True, ignore_mandatory=True
-                        )
-                        if procedure_doc.name:
-                            child.procedure_created = 1
-                            child.invoiced = 1
-                            child.sales_invoice_number = item.parent
-                            child.db_update()
-
-                    item.hms_tz_is_lrp_item_created = 1
-                    item.db_update()
-                except Exception:
-                    traceback = frappe.get_traceback()
-                    frappe.log_error(traceback)
-
-            elif item.reference_dt == "Therapy Plan Detail":
-                if item.hms_tz_is_lrp_item_created == 1:
-                    continue
-
-                therapy_items.append(item)
-
-        create_therapy_plan(invoice_therapy_dict=therapy_items)
-
-        frappe.db.commit()
-
-
 @frappe.whitelist()
 def auto_submit_nhif_patient_claim(setting_dict=None):
     """Routine to submit patient claims and will be triggered:
@@ -1379,7 +1459,12 @@ def auto_submit_nhif_patient_claim(setting_dict=None):
         company_setting_detail = frappe.get_all(
             "Company NHIF Settings",
             filters={"enable": 1, "enable_auto_submit_of_claims": 1},
-            fields=["company", "submit_claim_year", "submit_claim_month"],
+            fields=[
+                "company",
+                "facility_code",
+                "submit_claim_year",
+                "submit_claim_month",
+            ],
         )
     else:
         company_setting_detail.append(frappe._dict(json.loads(setting_dict)))
@@ -1397,8 +1482,53 @@ def auto_submit_nhif_patient_claim(setting_dict=None):
         )
 
 
+# defaults of the claim submission scheduler, each can be set in site_config.json
+claim_submit_defaults = {
+    # jobs submitting claims of one company and month at the same time
+    "nhif_claim_submit_workers": 4,
+    # claims sent to SubmitFolios per facility per minute
+    "nhif_claim_submit_rate": 30,
+    # consecutive server errors that stop the submission
+    "nhif_claim_submit_max_errors": 3,
+    # seconds the submission stays stopped after that
+    "nhif_claim_submit_cooldown": 300,
+    # cool downs a worker waits out before it leaves the claims to the next run
+    "nhif_claim_submit_max_cooldowns": 12,
+    # times a claim is queued again after an NHIF server error
+    "nhif_claim_submit_max_attempts": 3,
+}
+# seconds a claim submission queue is kept after its last run
+claim_submit_queue_expiry = 7 * 24 * 60 * 60
+
+
+def get_claim_submit_setting(key):
+    return cint(frappe.conf.get(key) or claim_submit_defaults[key])
+
+
+def get_claim_submit_queue_key(setting_obj):
+    return "nhif_claim_submit_queue:{0}:{1}:{2}".format(
+        setting_obj.company,
+        setting_obj.submit_claim_year,
+        setting_obj.submit_claim_month,
+    )
+
+
 def enqueue_auto_sending_of_patient_claims(setting_obj):
-    from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
+    """Queue the claims ready for auto submission and start the submission workers.
+
+    The claims are kept in a redis list that the workers pop from, so when the
+    submission is stopped by the circuit breaker or a restart, the next run picks
+    up the claims left in the list instead of starting over.
+    """
+    setting_obj = frappe._dict(setting_obj)
+    queue_key = get_claim_submit_queue_key(setting_obj)
+    cache = frappe.cache()
+    queue = cache.make_key(queue_key)
+    processing = cache.make_key(queue_key + ":processing")
+
+    # claims taken by workers that were killed go back to the queue
+    while cache.rpoplpush(processing, queue):
+        pass
 
     patient_claims = frappe.get_all(
         "NHIF Patient Claim",
@@ -1409,26 +1539,144 @@ def enqueue_auto_sending_of_patient_claims(setting_obj):
             "is_ready_for_auto_submission": 1,
             "docstatus": 0,
         },
+        pluck="name",
     )
-
-    if len(patient_claims) == 0:
+    # claims that became ready since the last run join the ones still queued
+    queued = {frappe.safe_decode(name) for name in cache.lrange(queue_key, 0, -1)}
+    pipe = cache.pipeline()
+    for name in patient_claims:
+        if name not in queued:
+            pipe.rpush(queue, name)
+    for key in (queue, processing, cache.make_key(queue_key + ":attempts")):
+        pipe.expire(key, claim_submit_queue_expiry)
+    pipe.execute()
+
+    if not cache.llen(queue_key):
         return
 
-    success_count = 0
-    failed_count = 0
-    for claim in patient_claims:
-        doc = frappe.get_doc("NHIF Patient Claim", claim.name)
+    total = cache.llen(queue_key)
+    workers = min(get_claim_submit_setting("nhif_claim_submit_workers"), total)
+    run_key = cache.make_key("nhif_claim_submit_run:" + frappe.generate_hash(length=10))
+    pipe = cache.pipeline()
+    pipe.hset(run_key, "total", total)
+    pipe.hset(run_key, "pending_workers", workers)
+    pipe.expire(run_key, claim_run_expiry)
+    pipe.execute()
+
+    facility_code = setting_obj.get("facility_code") or frappe.get_cached_value(
+        "Company NHIF Settings", setting_obj.company, "facility_code"
+    )
+    for i in range(workers):
+        frappe.enqueue(
+            method=submit_queued_patient_claims,
+            queue="long",
+            timeout=1000000,
+            company=setting_obj.company,
+            facility_code=facility_code,
+            queue_key=queue_key,
+            run_key=run_key,
+        )
+
+
+def submit_queued_patient_claims(company, facility_code, queue_key, run_key):
+    """Submit claims popped from the queue until it is empty or NHIF keeps failing.
+
+    While one worker renders a claim form the others wait on NHIF, so PDF
+    rendering overlaps with the network calls. When the circuit opens the
+    workers sleep through the cool down and try again.
+    """
+    cache = frappe.cache()
+    queue = cache.make_key(queue_key)
+    processing = cache.make_key(queue_key + ":processing")
+    attempts_key = cache.make_key(queue_key + ":attempts")
+    success_count, failed_count = 0, 0
+    cooldowns = 0
+    while True:
+        if is_claim_submit_circuit_open(facility_code):
+            cooldowns += 1
+            if cooldowns > get_claim_submit_setting("nhif_claim_submit_max_cooldowns"):
+                break
+            wait_for_claim_submit_circuit(facility_code)
+            continue
+
+        # the claim stays in the processing list until its outcome is committed
+        name = cache.rpoplpush(queue, processing)
+        if not name:
+            break
+        name = frappe.safe_decode(name)
+
+        lock = cache.lock(cache.make_key("nhif_claim_submit:" + name), timeout=1200)
+        if not lock.acquire(blocking=False):
+            # another worker is submitting it
+            pipe = cache.pipeline()
+            pipe.lrem(processing, 1, name)
+            pipe.execute()
+            continue
+
+        requeue = False
         try:
-            doc.submit()
-            doc.reload()
-            if doc.docstatus == 1:
+            if frappe.db.get_value("NHIF Patient Claim", name, "docstatus") != 0:
+                continue
+
+            wait_for_claim_submit_slot(facility_code)
+            doc = frappe.get_doc("NHIF Patient Claim", name)
+            try:
+                doc.submit()
+                frappe.db.commit()
                 success_count += 1
-        except:
-            failed_count += 1
+                record_claim_submit_result(facility_code, server_error=False)
+            except Exception:
+                frappe.db.rollback()
+                if doc.flags.nhif_request_sent:
+                    status_code = doc.flags.nhif_status_code
+                    server_error = not status_code or cint(status_code) >= 500
+                    record_claim_submit_result(facility_code, server_error=server_error)
+                    # a server error is not the claim's fault, try it again later
+                    if server_error:
+                        pipe = cache.pipeline()
+                        pipe.hincrby(attempts_key, name, 1)
+                        pipe.expire(attempts_key, claim_submit_queue_expiry)
+                        requeue = pipe.execute()[0] < get_claim_submit_setting(
+                            "nhif_claim_submit_max_attempts"
+                        )
+                if not requeue:
+                    failed_count += 1
+        finally:
+            pipe = cache.pipeline()
+            pipe.lrem(processing, 1, name)
+            if requeue:
+                pipe.rpush(queue, name)
+            pipe.execute()
+            try:
+                lock.release()
+            except LockNotOwnedError:
+                pass
+
+    pipe = cache.pipeline()
+    pipe.hincrby(run_key, "submitted", success_count)
+    pipe.hincrby(run_key, "failed", failed_count)
+    pipe.hincrby(run_key, "pending_workers", -1)
+    pending_workers = pipe.execute()[-1]
+
+    # the last worker to stop writes the summary
+    if pending_workers == 0:
+        log_claim_submit_run(company, queue_key, run_key)
+
+
+def log_claim_submit_run(company, queue_key, run_key):
+    cache = frappe.cache()
+    pipe = cache.pipeline()
+    pipe.hgetall(run_key)
+    pipe.llen(cache.make_key(queue_key))
+    summary, remaining = pipe.execute()
+    run = frappe._dict(
+        {frappe.safe_decode(k): frappe.safe_decode(v) for k, v in summary.items()}
+    )
 
     description = "CLAIM'S AUTO SUBMISSION SUMMARY\n\n\ncompany: {0}\n\nTotal Claims Prepared for auto submit: {1}\
-        \n\nTotal claims Submitted: {2}\n\nTotal Claims failed: {3}".format(
-        setting_obj.company, len(patient_claims), success_count, failed_count
+        \n\nTotal claims Submitted: {2}\n\nTotal Claims failed: {3}\
+        \n\nTotal Claims left in queue: {4}".format(
+        company, run.total, run.submitted or 0, run.failed or 0, remaining
     )
     add_log(
         request_type="AutoSubmitFolios",
@@ -1441,6 +1689,76 @@ def enqueue_auto_sending_of_patient_claims(setting_obj):
     frappe.db.commit()
 
 
+def wait_for_claim_submit_slot(facility_code):
+    """Block until the facility is below its SubmitFolios rate for the current minute"""
+    cache = frappe.cache()
+    limit = get_claim_submit_setting("nhif_claim_submit_rate")
+    while True:
+        minute = now_datetime().strftime("%Y%m%d%H%M")
+        key = cache.make_key("nhif_claim_submit_rate:{0}:{1}".format(facility_code, minute))
+        pipe = cache.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, 120)
+        if pipe.execute()[0] <= limit:
+            return
+        sleep(60 - now_datetime().second + 0.1)
+
+
+def get_claim_submit_circuit_key(facility_code):
+    return frappe.cache().make_key("nhif_claim_submit_circuit:" + str(facility_code))
+
+
+def is_claim_submit_circuit_open(facility_code):
+    pipe = frappe.cache().pipeline()
+    pipe.exists(get_claim_submit_circuit_key(facility_code) + ":open")
+    return bool(pipe.execute()[0])
+
+
+def wait_for_claim_submit_circuit(facility_code):
+    """Sleep until the cool down of the facility is over, with a little jitter so
+    the workers do not all retry at the same moment
+    """
+    pipe = frappe.cache().pipeline()
+    pipe.pttl(get_claim_submit_circuit_key(facility_code) + ":open")
+    ttl = pipe.execute()[0] or 0
+    if ttl > 0:
+        sleep(ttl / 1000.0 + random.uniform(0, 5))
+
+
+def record_claim_submit_result(facility_code, server_error):
+    """Count consecutive NHIF server errors, and stop submissions of the facility for
+    a cool down once there are too many.
+
+    After a cool down the circuit is half open: the first server error stops the
+    submission again, the first success closes it.
+    """
+    key = get_claim_submit_circuit_key(facility_code)
+    pipe = frappe.cache().pipeline()
+    if not server_error:
+        pipe.delete(key)
+        pipe.delete(key + ":half_open")
+        pipe.execute()
+        return
+
+    pipe.incr(key)
+    pipe.expire(key, 3600)
+    pipe.exists(key + ":half_open")
+    errors, _expire, half_open = pipe.execute()
+    if half_open or errors >= get_claim_submit_setting("nhif_claim_submit_max_errors"):
+        cooldown = get_claim_submit_setting("nhif_claim_submit_cooldown")
+        pipe = frappe.cache().pipeline()
+        pipe.set(key + ":open", 1, ex=cooldown)
+        pipe.set(key + ":half_open", 1, ex=cooldown + 3600)
+        pipe.delete(key)
+        pipe.execute()
+        frappe.log_error(
+            "Stopped submitting claims of facility {0} after {1} server errors".format(
+                facility_code, errors
+            ),
+            "NHIF Claim Submission Stopped",
+        )
+
+
 @frappe.whitelist()
 def verify_service_approval_number_for_LRPMT(
     company,
@@ -1532,7 +1850,7 @@ def verify_service_approval_number_for_LRPMT(
 
     headers = {"Content-Type": "application/json", "Authorization": "Bearer " + token}
 
-    r = requests.request("GET", url, headers=headers, timeout=120)
+    r = nhif_request("GET", url, "GetReferenceNoStatus", headers=headers)
 
     if r.status_code == 200:
         add_log(
@@ -1566,91 +1884,163 @@ def verify_service_approval_number_for_LRPMT(
         return False
 
 
+# encounters finalized per UPDATE statement
+finalize_chunk_size = 1000
+# the finalize job stops at this time, or after finalize_max_runtime seconds when
+# started later than that
+finalize_window_end = "05:00:00"
+finalize_max_runtime = 3600
+
+
 def auto_finalize_patient_encounters():
     """Auto finalize patient encounters after a number of days set in company settings
 
     IPD encounters will only be finalized if the inpatient record is discharged
 
-    This routine runs every day at 3:00am at night
+    This routine runs every 30 minutes between 3:00am and 5:00am, each run hands
+    the work to a long job that keeps going until the backlog is empty.
     """
+    frappe.enqueue(
+        method=finalize_patient_encounters,
+        queue="long",
+        timeout=3 * 60 * 60,
+        job_name="auto_finalize_patient_encounters",
+    )
 
-    def finalize_encounter(encounter_list):
-        for encounter in encounter_list:
-            try:
-                if (
-                    encounter.inpatient_record
-                    and frappe.db.get_value(
-                        "Inpatient Record", encounter.inpatient_record, "status"
-                    )
-                    != "Discharged"
-                ):
-                    continue
 
-                else:
-                    frappe.set_value(
-                        "Patient Encounter",
-                        encounter.name,
-                        {
-                            "finalized": 1,
-                            "encounter_type": "Final",
-                        },
-                    )
+def get_finalize_deadline():
+    deadline = get_datetime(nowdate() + " " + finalize_window_end)
+    if now_datetime() >= deadline:
+        deadline = add_to_date(now_datetime(), seconds=finalize_max_runtime)
+    return deadline
 
-                    reference_encounters = frappe.get_all(
-                        "Patient Encounter",
-                        {
-                            "docstatus": 1,
-                            "reference_encounter": encounter.reference_encounter,
-                        },
-                        ["name", "finalized"],
-                    )
-                    if len(reference_encounters) > 0:
-                        for ref_encounter in reference_encounters:
-                            if ref_encounter.finalized == 1:
-                                continue
-
-                            frappe.set_value(
-                                "Patient Encounter",
-                                ref_encounter,
-                                {
-                                    "finalized": 1,
-                                },
-                            )
-
-            except Exception as e:
-                frappe.log_error(
-                    frappe.get_traceback(),
-                    f"Error in finalizing encounter: {encounter.name}",
-                )
+
+def finalize_patient_encounters():
+    cache = frappe.cache()
+    lock = cache.lock(
+        cache.make_key("auto_finalize_patient_encounters"), timeout=3 * 60 * 60
+    )
+    if not lock.acquire(blocking=False):
+        return
+
+    try:
+        deadline = get_finalize_deadline()
+        companies = frappe.get_all(
+            "Company",
+            {"auto_finalize_patient_encounter": 1},
+            ["name", "valid_days_to_auto_finalize_encounter"],
+        )
+        for row in companies:
+            if not row.valid_days_to_auto_finalize_encounter:
                 continue
+            if now_datetime() >= deadline:
+                break
 
-    companies = frappe.get_all(
-        "Company",
-        {"auto_finalize_patient_encounter": 1},
-        ["name", "valid_days_to_auto_finalize_encounter"],
+            date = add_days(nowdate(), -row.valid_days_to_auto_finalize_encounter)
+            finalize_company_encounters(row.name, date, deadline)
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            pass
+
+
+def get_encounters_to_finalize(company, date, limit):
+    """Eligible encounters, IPD encounters only once their inpatient record is discharged"""
+    return frappe.db.sql(
+        """
+        SELECT pe.name, pe.reference_encounter
+        FROM `tabPatient Encounter` pe
+        LEFT JOIN `tabInpatient Record` ir ON ir.name = pe.inpatient_record
+        WHERE pe.docstatus = 1
+          AND pe.duplicated = 0
+          AND pe.finalized = 0
+          AND pe.encounter_date <= %(date)s
+          AND pe.company = %(company)s
+          AND (IFNULL(pe.inpatient_record, '') = '' OR ir.status = 'Discharged')
+        ORDER BY pe.encounter_date
+        LIMIT %(limit)s
+        """,
+        {"company": company, "date": date, "limit": limit},
+        as_dict=1,
     )
 
-    for row in companies:
-        if row.valid_days_to_auto_finalize_encounter == 0:
-            continue
 
-        date = add_days(nowdate(), -row.valid_days_to_auto_finalize_encounter)
-        encounters = frappe.get_all(
-            "Patient Encounter",
-            {
-                "docstatus": 1,
-                "duplicated": 0,
-                "finalized": 0,
-                "encounter_date": ["<=", date],
-                "company": row.name,
-            },
-            ["name", "reference_encounter", "inpatient_record"],
-            order_by="modified desc", 
-            limit=100
-        )
-        for encounter_batch in create_batch(encounters, 100):
-            finalize_encounter(encounter_batch)
+def finalize_company_encounters(company, date, deadline):
+    start = now_datetime()
+    finalized = 0
+    chunks = 0
+    backlog_cleared = False
+    while now_datetime() < deadline:
+        encounters = get_encounters_to_finalize(company, date, finalize_chunk_size)
+        if not encounters:
+            backlog_cleared = True
+            break
+
+        try:
+            finalized += finalize_encounter_chunk(encounters)
             frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(
+                frappe.get_traceback(),
+                f"Error in finalizing encounters of company: {company}",
+            )
+            break
+        chunks += 1
+
+    seconds = time_diff_in_seconds(now_datetime(), start)
+    frappe.logger("hms_tz").info(
+        {
+            "auto_finalize_patient_encounters": company,
+            "finalized": finalized,
+            "chunks": chunks,
+            "seconds": seconds,
+            "per_second": round(finalized / seconds, 1) if seconds else finalized,
+            "backlog_cleared": backlog_cleared,
+        }
+    )
+    return finalized
+
+
+def finalize_encounter_chunk(encounters):
+    """Finalize the encounters and all submitted encounters of their reference chains"""
+    time_stamp = now()
+    names = tuple(encounter.name for encounter in encounters)
+    reference_encounters = tuple(
+        {encounter.reference_encounter for encounter in encounters}
+        - {None, ""}
+    )
+
+    frappe.db.sql(
+        """
+        UPDATE `tabPatient Encounter`
+        SET finalized = 1, encounter_type = 'Final', modified = %(modified)s
+        WHERE name IN %(names)s
+        """,
+        {"names": names, "modified": time_stamp},
+    )
+    updated = len(names)
+
+    if reference_encounters:
+        filters = {
+            "docstatus": 1,
+            "finalized": 0,
+            "reference_encounter": ["in", reference_encounters],
+        }
+        updated += frappe.db.count("Patient Encounter", filters)
+        frappe.db.sql(
+            """
+            UPDATE `tabPatient Encounter`
+            SET finalized = 1, modified = %(modified)s
+            WHERE docstatus = 1
+              AND finalized = 0
+              AND reference_encounter IN %(reference_encounters)s
+            """,
+            {"reference_encounters": reference_encounters, "modified": time_stamp},
+        )
+
+    return updated
 
 
 def validate_nhif_patient_claim_status(
@@ -1705,111 +2095,295 @@ def validate_nhif_patient_claim_status(
                 )
 
 
+# appointments per claim creation job
+claim_chunk_size = 20
+claim_run_expiry = 2 * 24 * 60 * 60
+
+
 def enqueue_auto_create_nhif_patient_claims():
     frappe.enqueue(
         method=auto_create_nhif_patient_claims,
         job_name="auto_create_nhif_patient_claims",
         queue="default",
-        timeout=100000,
+        timeout=3600,
         is_async=True,
     )
 
-def auto_create_nhif_patient_claims():
-    """Auto create NHIF patient claims after a number of days set in company settings
 
-    This routine runs every day at 01: 30am at night
-    """
+def get_claim_appointments(company, appointment_date):
+    """Closed NHIF appointments of the company ready for a claim.
 
+    OPD appointments of `appointment_date` without an ongoing admission, plus
+    inpatient appointments discharged on that date.
+    """
     pa = DocType("Patient Appointment")
     pe = DocType("Patient Encounter")
     ip = DocType("Inpatient Record")
 
-    def get_appointments(appointment_date):
-        appointments = (
-            frappe.qb.from_(pa)
-            .inner_join(pe)
-            .on(pa.name == pe.appointment)
-            .select(
-                pa.name.as_("appointment"),
-            )
-            .where(
-                (pa.status == "Closed")
-                # (pa.insurance_company.like("NHIF"))
-                & (pa.insurance_company == "NHIF")
-                & (pa.company == "Shree Hindu Mandal Hospital - Dar es Salaam")
-                & (pa.appointment_date == appointment_date)
-                & (pa.nhif_patient_claim.isnull() | (pa.nhif_patient_claim == ""))
-                & (pe.docstatus == 1)
-                & (pe.duplicated == 0)
-            )
-        ).run(as_dict=True)
-
-        appointment_ids = [i.appointment for i in appointments]
-        return appointment_ids
-
-    def get_ongoiong_inpatients():
-        inpatient_appointments = (
-            frappe.qb.from_(ip)
-            .select(ip.patient_appointment)
-            .where(
-                # (ip.insurance_company.like("NHIF"))
-                (ip.insurance_company == "NHIF")
-                & (ip.company == "Shree Hindu Mandal Hospital - Dar es Salaam")
-                & (ip.patient_appointment.isnotnull())
-                & (ip.status != "Discharged")
-            )
-        ).run(as_dict=True)
-
-        ongoing_inpatients = [i.patient_appointment for i in inpatient_appointments]
-
-        return ongoing_inpatients
-    
-    def get_discharged_inpatients(discharge_date):
-        inpatient_appointments = (
-            frappe.qb.from_(ip)
-            .inner_join(pa)
-            .on(ip.patient_appointment == pa.name)
-            .inner_join(pe)
-            .on(ip.patient_appointment == pe.appointment)
-            .select(ip.patient_appointment)
-            .where(
-                # (ip.insurance_company.like("NHIF"))
-                (ip.insurance_company == "NHIF")
-                & (ip.company == "Shree Hindu Mandal Hospital - Dar es Salaam")
-                & (ip.patient_appointment.isnotnull())
-                & (ip.status == "Discharged")
-                & (ip.discharge_date == discharge_date)
-                & (pa.status == "Closed")
-                & (pa.nhif_patient_claim.isnull() | (pa.nhif_patient_claim == ""))
-                & (pe.docstatus == 1)
-                & (pe.duplicated == 0)
+    appointments = (
+        frappe.qb.from_(pa)
+        .inner_join(pe)
+        .on(pa.name == pe.appointment)
+        .select(pa.name.as_("appointment"))
+        .distinct()
+        .where(
+            (pa.status == "Closed")
+            & (pa.insurance_company.like("%NHIF%"))
+            & (pa.company == company)
+            & (pa.appointment_date == appointment_date)
+            & (pa.nhif_patient_claim.isnull() | (pa.nhif_patient_claim == ""))
+            & (pe.docstatus == 1)
+            & (pe.duplicated == 0)
+        )
+    ).run(pluck=True)
+
+    ongoing_inpatients = (
+        frappe.qb.from_(ip)
+        .select(ip.patient_appointment)
+        .where(
+            (ip.insurance_company.like("%NHIF%"))
+            & (ip.company == company)
+            & (ip.patient_appointment.isnotnull())
+            & (ip.status != "Discharged")
+        )
+    ).run(pluck=True)
+
+    discharged_appointments = (
+        frappe.qb.from_(ip)
+        .inner_join(pa)
+        .on(ip.patient_appointment == pa.name)
+        .inner_join(pe)
+        .on(ip.patient_appointment == pe.appointment)
+        .select(ip.patient_appointment)
+        .distinct()
+        .where(
+            (ip.insurance_company.like("%NHIF%"))
+            & (ip.company == company)
+            & (ip.patient_appointment.isnotnull())
+            & (ip.status == "Discharged")
+            & (ip.discharge_date == appointment_date)
+            & (pa.status == "Closed")
+            & (pa.nhif_patient_claim.isnull() | (pa.nhif_patient_claim == ""))
+            & (pe.docstatus == 1)
+            & (pe.duplicated == 0)
+        )
+    ).run(pluck=True)
+
+    return sorted(
+        (set(appointments) - set(ongoing_inpatients)) | set(discharged_appointments)
+    )
+
+
+def auto_create_nhif_patient_claims():
+    """Auto create NHIF patient claims for every company with NHIF enabled
+
+    This routine runs every day at 01:30am at night. Eligible appointments are
+    split in chunks, each chunk is created by its own job so claims are built
+    by as many workers as the long queue has.
+    """
+    log_stale_claim_runs()
+
+    run_id = frappe.generate_hash(length=10)
+    before_1_day = add_days(nowdate(), -1)
+    companies = frappe.get_all(
+        "Company NHIF Settings", filters={"enable": 1}, pluck="company"
+    )
+    for company in companies:
+        appointment_ids = get_claim_appointments(company, before_1_day)
+        if not appointment_ids:
+            continue
+
+        chunks = list(create_batch(appointment_ids, claim_chunk_size))
+        start_claim_run(run_id, company, len(appointment_ids), len(chunks))
+        for chunk in chunks:
+            frappe.enqueue(
+                method=create_nhif_patient_claims,
+                queue="long",
+                timeout=claim_chunk_size * 300,
+                run_id=run_id,
+                company=company,
+                appointments=list(chunk),
             )
-        ).run(as_dict=True)
 
-        discharged_appointments = [i.patient_appointment for i in inpatient_appointments]
 
-        return discharged_appointments
+def get_claim_run_key(run_id, company):
+    return frappe.cache().make_key("nhif_claim_run:{0}:{1}".format(run_id, company))
+
 
+def get_claim_runs_key():
+    """Set of the runs that have not written their summary yet"""
+    return frappe.cache().make_key("nhif_claim_runs")
+
+
+def start_claim_run(run_id, company, total, chunks):
+    pipe = frappe.cache().pipeline()
+    key = get_claim_run_key(run_id, company)
+    pipe.hset(key, "started", now())
+    pipe.hset(key, "total", total)
+    pipe.hset(key, "pending_chunks", chunks)
+    pipe.expire(key, claim_run_expiry)
+    pipe.sadd(get_claim_runs_key(), json.dumps([run_id, company]))
+    pipe.execute()
+
+
+def log_stale_claim_runs():
+    """Write the summary of earlier runs that still have pending chunks, a chunk
+    job that was killed never reports back
+    """
+    pipe = frappe.cache().pipeline()
+    pipe.smembers(get_claim_runs_key())
+    pipe.delete(get_claim_runs_key())
+    runs = pipe.execute()[0]
+    for member in runs:
+        run_id, company = json.loads(frappe.safe_decode(member))
+        run = get_claim_run(run_id, company)
+        if run.total:
+            log_claim_run(run_id, company, run)
+
+
+def create_nhif_patient_claims(run_id, company, appointments):
+    """Create the claims of a chunk of appointments, one lock per appointment keeps
+    a retried or overlapping job from creating a claim twice.
+    """
+    cache = frappe.cache()
+    created, skipped, failed = 0, 0, []
+    processed, finished = 0, False
+    try:
+        for appointment in appointments:
+            processed += 1
+            lock = cache.lock(
+                cache.make_key("nhif_claim_appointment:" + appointment), timeout=600
+            )
+            if not lock.acquire(blocking=False):
+                skipped += 1
+                continue
 
-    def create_claims(appointment_ids):
-        for appointment in appointment_ids:
             try:
+                if frappe.db.get_value(
+                    "Patient Appointment", appointment, "nhif_patient_claim"
+                ) or frappe.db.exists(
+                    "NHIF Patient Claim",
+                    {"patient_appointment": appointment, "docstatus": ["<", 2]},
+                ):
+                    skipped += 1
+                    continue
+
                 doc = frappe.new_doc("NHIF Patient Claim")
                 doc.patient_appointment = appointment
+                # bulk created claims render their form on the next edit or on submit
+                doc.flags.skip_claim_pdf_prerender = True
                 doc.save(ignore_permissions=True)
-                doc.reload()
-            
-            except Exception as e:
+                frappe.db.commit()
+                created += 1
+
+            except Exception:
+                frappe.db.rollback()
                 frappe.log_error(
                     frappe.get_traceback(),
                     f"Error in creating NHIF Patient Claim for appointment: {appointment}",
                 )
-                continue
-    
-    before_1_day = add_days(nowdate(), -1)
-    appointment_names = get_appointments(before_1_day)
-    ongoing_inpatients = get_ongoiong_inpatients()
-    discharged_appointments = get_discharged_inpatients(before_1_day)
-    appointment_ids = list(set(list(set(appointment_names) - set(ongoing_inpatients)) + list(set(discharged_appointments))))
+                failed.append(appointment)
+
+            finally:
+                try:
+                    lock.release()
+                except LockNotOwnedError:
+                    pass
+        finished = True
+
+    finally:
+        # an interrupted job still reports, the appointments it did not finish count as failed
+        if not finished:
+            failed.extend(
+                appointment
+                for appointment in appointments[max(processed - 1, 0) :]
+                if appointment not in failed
+            )
+        update_claim_run(run_id, company, created, skipped, failed)
+
+
+def update_claim_run(run_id, company, created, skipped, failed):
+    key = get_claim_run_key(run_id, company)
+    pipe = frappe.cache().pipeline()
+    pipe.hincrby(key, "created", created)
+    pipe.hincrby(key, "skipped", skipped)
+    pipe.hincrby(key, "failed", len(failed))
+    for appointment in failed:
+        pipe.rpush(key + ":failed", appointment)
+    pipe.expire(key + ":failed", claim_run_expiry)
+    pipe.hincrby(key, "pending_chunks", -1)
+    pending_chunks = pipe.execute()[-1]
+
+    # the last chunk of the run writes the summary
+    if pending_chunks == 0:
+        pipe = frappe.cache().pipeline()
+        pipe.srem(get_claim_runs_key(), json.dumps([run_id, company]))
+        pipe.execute()
+        log_claim_run(run_id, company)
+
+
+def get_claim_run(run_id, company):
+    key = get_claim_run_key(run_id, company)
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(key)
+    pipe.lrange(key + ":failed", 0, -1)
+    summary, failed = pipe.execute()
+    run = frappe._dict(
+        {frappe.safe_decode(k): frappe.safe_decode(v) for k, v in summary.items()}
+    )
+    run.failed_appointments = [frappe.safe_decode(a) for a in failed]
+    return run
+
+
+def log_claim_run(run_id, company, run=None):
+    run = run or get_claim_run(run_id, company)
+    description = "CLAIM'S AUTO CREATION SUMMARY\n\n\ncompany: {0}\n\nRun: {1}\n\nStarted: {2}\
+        \n\nFinished: {3}\n\nTotal Appointments: {4}\n\nTotal Claims Created: {5}\
+        \n\nTotal Skipped: {6}\n\nTotal Failed: {7}\n\nFailed Appointments: {8}".format(
+        company,
+        run_id,
+        run.started,
+        now(),
+        run.total,
+        run.created or 0,
+        run.skipped or 0,
+        run.failed or 0,
+        ", ".join(run.failed_appointments),
+    )
+    if cint(run.pending_chunks) > 0:
+        description += "\n\nChunks that never finished: {0}".format(run.pending_chunks)
+    add_log(
+        request_type="AutoCreateClaims",
+        request_url="",
+        request_header="",
+        request_body="",
+        response_data=description,
+        status_code="Summary",
+    )
 
-    create_claims(appointment_ids)
+
+def get_naming_series_names(naming_series, count, digits=5):
+    """Reserve `count` consecutive names of a naming series with one counter update"""
+    if "#" in naming_series:
+        digits = naming_series.count("#")
+        naming_series = naming_series[: naming_series.index("#")]
+    prefix = parse_naming_series(naming_series)
+    current = frappe.db.sql(
+        "SELECT `current` FROM `tabSeries` WHERE `name` = %s FOR UPDATE", prefix
+    )
+    if current and current[0][0] is not None:
+        current = cint(current[0][0])
+        frappe.db.sql(
+            "UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name` = %s",
+            (count, prefix),
+        )
+    else:
+        current = 0
+        frappe.db.sql(
+            "INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)",
+            (prefix, count),
+        )
+    return [
+        prefix + ("%0" + str(digits) + "d") % (current + i)
+        for i in range(1, count + 1)
+    ]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Aakvatech and contributors
+# For license information, please see license.txt
+
+import re
+import uuid
+import datetime
+import frappe
+
+
+segment_separator = re.compile(r"\r\n|\r|\n")
+
+
+def parse_hl7(message):
+    """Split an HL7 v2 message into its segments in one pass.
+
+    Returns a dict with `segments`, the list of field lists in message order
+    (line indexes of the raw message are kept, blank lines included), and the
+    first `MSH` and `OBR` segments plus all `OBX` segments.
+    """
+    parsed = frappe._dict(segments=[], msh=None, obr=None, obx=[])
+    for line in segment_separator.split(message or ""):
+        fields = line.split("|")
+        parsed.segments.append(fields)
+        segment = fields[0]
+        if segment == "OBX":
+            parsed.obx.append(fields)
+        elif segment == "OBR" and parsed.obr is None:
+            parsed.obr = fields
+        elif segment == "MSH" and parsed.msh is None:
+            parsed.msh = fields
+    return parsed
+
+
+def get_field(fields, index):
+    if fields and len(fields) > index:
+        return fields[index]
+    return ""
+
+
+def get_message_header(parsed):
+    """Machine make and model from MSH, the test name from the fourth segment and
+    the Sample Collection from OBR-2, or OBR-3 when OBR-2 is empty
+    """
+    first = parsed.segments[0] if parsed.segments else []
+    fourth = parsed.segments[3] if len(parsed.segments) > 3 else []
+    return frappe._dict(
+        machine_make=get_field(first, 2),
+        machine_model=get_field(first, 3),
+        lab_test_name=get_field(fourth, 3),
+        sample_collection=get_field(parsed.obr, 2) or get_field(parsed.obr, 3),
+        control_id=get_field(parsed.msh, 9),
+    )
+
+
+def get_test_name(fields, fallback_index=3):
+    """Test name of an OBX segment, the text of OBX-3 when it is coded"""
+    identifier = get_field(fields, 3)
+    if "^" in identifier:
+        return identifier.split("^")[1].replace("*", "")
+    return get_field(fields, fallback_index).replace("*", "")
+
+
+def get_profile_results(parsed, start, end):
+    """{test name: value} of the segments between the line indexes of a machine profile"""
+    results = {}
+    for fields in parsed.segments[start:end]:
+        results[get_test_name(fields)] = get_field(fields, 5)
+    return results
+
+
+def get_numeric_results(parsed):
+    """{test name: value} of the numeric OBX segments"""
+    results = {}
+    for fields in parsed.obx:
+        if get_field(fields, 2) == "NM":
+            results[get_test_name(fields, fallback_index=4)] = get_field(fields, 5)
+    return results
+
+
+def build_ack(message, code="AA", text=""):
+    """HL7 acknowledgement of `message`, AA accepted, AE error or AR rejected.
+
+    Needs no site context, the MLLP handler threads build acks without one.
+    """
+    parsed = parse_hl7(message)
+    msh = parsed.msh or ["MSH", "^~\\&"]
+    ack = [
+        "|".join(
+            [
+                "MSH",
+                get_field(msh, 1) or "^~\\&",
+                get_field(msh, 4),
+                get_field(msh, 5),
+                get_field(msh, 2),
+                get_field(msh, 3),
+                datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
+                "",
+                "ACK",
+                uuid.uuid4().hex[:10],
+                get_field(msh, 10) or "P",
+                get_field(msh, 11) or "2.3.1",
+            ]
+        ),
+        "|".join(["MSA", code, get_field(msh, 9), text]),
+    ]
+    return "\r".join(ack) + "\r"
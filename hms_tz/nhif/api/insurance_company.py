@@ -6,21 +6,26 @@ from time import perf_counter
 import frappe
 from frappe import _
 from hms_tz.nhif.api.token import get_claimsservice_token
+from hms_tz.nhif.api.nhif_client import nhif_request
 import json
-import requests
+import hashlib
 from frappe.utils.background_jobs import enqueue
 from hms_tz.nhif.doctype.nhif_product.nhif_product import add_product
 from hms_tz.nhif.doctype.nhif_scheme.nhif_scheme import add_scheme
-from frappe.utils import now
-from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
-from frappe.model.naming import set_new_name
+from frappe.utils import now, nowdate, cstr, flt, create_batch
+from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import (
+    add_log,
+    iter_log_records,
+)
+from hms_tz.nhif.api.healthcare_utils import (
+    get_naming_series_names,
+    clear_price_list_cache,
+)
 import ast
 from hms_tz.nhif.doctype.nhif_custom_excluded_services.nhif_custom_excluded_services import (
-    get_custom_excluded_services,
+    get_custom_excluded_services_map,
 )
 
-from time import sleep
-
 @frappe.whitelist()
 def enqueue_get_nhif_price_package(company):
     enqueue(
@@ -35,7 +40,6 @@ def enqueue_get_nhif_price_package(company):
 
 def get_nhif_price_package(kwargs):
     company = kwargs
-    user = frappe.session.user
     token = get_claimsservice_token(company)
     claimsserver_url, facility_code = frappe.get_cached_value(
         "Company NHIF Settings", company, ["claimsserver_url", "facility_code"]
@@ -46,7 +50,9 @@ def get_nhif_price_package(kwargs):
         + "/claimsserver/api/v1/Packages/GetPricePackageWithExcludedServices?FacilityCode="
         + str(facility_code)
     )
-    r = requests.get(url, headers=headers, timeout=300)
+    r = nhif_request(
+        "GET", url, "GetPricePackageWithExcludedServices", headers=headers
+    )
     if r.status_code != 200:
         add_log(
             request_type="GetPricePackageWithExcludedServices",
@@ -57,115 +63,177 @@ def get_nhif_price_package(kwargs):
         )
         frappe.throw(json.loads(r.text))
     else:
-        if json.loads(r.text):
-            frappe.db.sql(
-                """DELETE FROM `tabNHIF Price Package` WHERE company = '{0}' """.format(company)
-            )
-            frappe.db.sql(
-                """DELETE FROM `tabNHIF Excluded Services` WHERE company = '{0}' """.format(
-                    company
-                )
-            )
-            frappe.db.commit()
-
-            # wait for 60 seconds before creating records again
-            sleep(60)
-
+        data = json.loads(r.text)
+        if data:
             log_name = add_log(
                 request_type="GetPricePackageWithExcludedServices",
                 request_url=url,
                 request_header=headers,
                 response_data=r.text,
-                status_code=r.status_code
+                status_code=r.status_code,
+                queue=False,
             )
-            time_stamp = now()
-            data = json.loads(r.text)
-            insert_data = []
-            for item in data.get("PricePackage"):
-                insert_data.append(
-                    (
-                        frappe.generate_hash("", 20),
-                        facility_code,
-                        time_stamp,
-                        log_name,
-                        item.get("ItemCode"),
-                        item.get("PriceCode"),
-                        item.get("LevelPriceCode"),
-                        item.get("OldItemCode"),
-                        item.get("ItemTypeID"),
-                        item.get("ItemName"),
-                        item.get("Strength"),
-                        item.get("Dosage"),
-                        item.get("PackageID"),
-                        item.get("SchemeID"),
-                        item.get("FacilityLevelCode"),
-                        item.get("UnitPrice"),
-                        item.get("IsRestricted"),
-                        item.get("MaximumQuantity"),
-                        item.get("AvailableInLevels"),
-                        item.get("PractitionerQualifications"),
-                        item.get("IsActive"),
-                        time_stamp,
-                        time_stamp,
-                        user,
-                        user,
-                        company,
-                    )
-                )
-            frappe.db.sql(
-                """
-                INSERT INTO `tabNHIF Price Package`
-                (
-                    `name`, `facilitycode`, `time_stamp`, `log_name`, `itemcode`, `pricecode`,
-                    `levelpricecode`, `olditemcode`, `itemtypeid`, `itemname`, `strength`, 
-                    `dosage`, `packageid`, `schemeid`, `facilitylevelcode`, `unitprice`, 
-                    `isrestricted`, `maximumquantity`, `availableinlevels`, 
-                    `practitionerqualifications`, `IsActive`, `creation`, `modified`,
-                    `modified_by`, `owner`,`company`
-                )
-                VALUES {}
-            """.format(
-                    ", ".join(["%s"] * len(insert_data))
-                ),
-                tuple(insert_data),
+            result = sync_nhif_price_package(company, facility_code, log_name, data)
+            set_nhif_diff_records(facility_code, data)
+            frappe.db.commit()
+            frappe.msgprint(_("Received data from NHIF"))
+            return result
+
+
+price_package_fields = {
+    "itemcode": "ItemCode",
+    "pricecode": "PriceCode",
+    "levelpricecode": "LevelPriceCode",
+    "olditemcode": "OldItemCode",
+    "itemtypeid": "ItemTypeID",
+    "itemname": "ItemName",
+    "strength": "Strength",
+    "dosage": "Dosage",
+    "packageid": "PackageID",
+    "schemeid": "SchemeID",
+    "facilitylevelcode": "FacilityLevelCode",
+    "unitprice": "UnitPrice",
+    "isrestricted": "IsRestricted",
+    "maximumquantity": "MaximumQuantity",
+    "availableinlevels": "AvailableInLevels",
+    "practitionerqualifications": "PractitionerQualifications",
+    "isactive": "IsActive",
+}
+
+excluded_services_fields = {
+    "itemcode": "ItemCode",
+    "schemeid": "SchemeID",
+    "schemename": "SchemeName",
+    "excludedforproducts": "ExcludedForProducts",
+}
+
+
+def sync_nhif_price_package(company, facility_code, log_name, data):
+    """Bring `NHIF Price Package` and `NHIF Excluded Services` in line with the
+    NHIF payload by applying only the inserted, changed and removed rows.
+
+    Existing rows stay readable for the whole sync, there is no window where
+    the company has an empty catalogue.
+    """
+    time_stamp = now()
+    return {
+        "price_package": sync_nhif_records(
+            "NHIF Price Package",
+            price_package_fields,
+            ("pricecode",),
+            data.get("PricePackage") or [],
+            company,
+            facility_code,
+            log_name,
+            time_stamp,
+        ),
+        "excluded_services": sync_nhif_records(
+            "NHIF Excluded Services",
+            excluded_services_fields,
+            ("itemcode", "schemeid"),
+            data.get("ExcludedServices") or [],
+            company,
+            facility_code,
+            log_name,
+            time_stamp,
+        ),
+    }
+
+
+def sync_nhif_records(
+    doctype, fields, key_fields, records, company, facility_code, log_name, time_stamp
+):
+    user = frappe.session.user
+    columns = list(fields)
+
+    existing_map = {}
+    to_delete = []
+    for row in frappe.db.sql(
+        """SELECT name, {0} FROM `tab{1}` WHERE company = %s""".format(
+            ", ".join("`{0}`".format(col) for col in columns), doctype
+        ),
+        company,
+        as_dict=1,
+    ):
+        key = tuple(cstr(row.get(col)) for col in key_fields)
+        if key in existing_map:
+            # duplicates left behind by the old delete and reinsert sync
+            to_delete.append(row.name)
+        else:
+            existing_map[key] = row
+
+    upsert_data = []
+    seen_keys = set()
+    inserted = updated = 0
+    for record in records:
+        values = []
+        for col in columns:
+            value = record.get(fields[col])
+            values.append(int(value) if isinstance(value, bool) else value)
+
+        key = tuple(cstr(values[columns.index(col)]) for col in key_fields)
+        if key in seen_keys:
+            continue
+        seen_keys.add(key)
+
+        existing = existing_map.pop(key, None)
+        if existing:
+            if all(
+                cstr(existing.get(col)) == cstr(value)
+                for col, value in zip(columns, values)
+            ):
+                continue
+            name = existing.name
+            updated += 1
+        else:
+            name = frappe.generate_hash("", 20)
+            inserted += 1
+
+        upsert_data.append(
+            tuple(
+                [name, facility_code, time_stamp, log_name]
+                + values
+                + [time_stamp, time_stamp, user, user, company]
             )
-            insert_data = []
-            for item in data.get("ExcludedServices"):
-                insert_data.append(
-                    (
-                        frappe.generate_hash("", 20),
-                        facility_code,
-                        time_stamp,
-                        log_name,
-                        item.get("ItemCode"),
-                        item.get("SchemeID"),
-                        item.get("SchemeName"),
-                        item.get("ExcludedForProducts"),
-                        time_stamp,
-                        time_stamp,
-                        user,
-                        user,
-                        company,
-                    )
-                )
-            frappe.db.sql(
-                """
-                INSERT INTO `tabNHIF Excluded Services`
-                (
-                    `name`, `facilitycode`, `time_stamp`, `log_name`, `itemcode`, `schemeid`,
-                    `schemename`, `excludedforproducts`, `creation`, `modified`,
-                    `modified_by`, `owner`, `company`
-                )
-                VALUES {}
+        )
+
+    to_delete.extend(row.name for row in existing_map.values())
+
+    for names in create_batch(to_delete, 5000):
+        frappe.db.sql(
+            """DELETE FROM `tab{0}` WHERE name IN %(names)s""".format(doctype),
+            {"names": tuple(names)},
+        )
+
+    insert_columns = (
+        ["name", "facilitycode", "time_stamp", "log_name"]
+        + columns
+        + ["creation", "modified", "modified_by", "owner", "company"]
+    )
+    update_columns = ["facilitycode", "time_stamp", "log_name", "modified", "modified_by"]
+    for rows in create_batch(upsert_data, 5000):
+        frappe.db.sql(
+            """
+            INSERT INTO `tab{0}` ({1})
+            VALUES {2}
+            ON DUPLICATE KEY UPDATE {3}
             """.format(
-                    ", ".join(["%s"] * len(insert_data))
+                doctype,
+                ", ".join("`{0}`".format(col) for col in insert_columns),
+                ", ".join(["%s"] * len(rows)),
+                ", ".join(
+                    "`{0}` = VALUES(`{0}`)".format(col)
+                    for col in update_columns + columns
                 ),
-                tuple(insert_data),
-            )
-            set_nhif_diff_records(facility_code)
-            frappe.db.commit()
-            frappe.msgprint(_("Received data from NHIF"))
-            return insert_data
+            ),
+            tuple(rows),
+        )
+
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "deleted": len(to_delete),
+    }
 
 
 @frappe.whitelist()
@@ -189,23 +257,31 @@ def process_nhif_records(company):
 
 
 def process_prices_list(kwargs):
+    """Reconcile NHIF Item Prices against the price package in bulk.
+
+    Price package rows, NHIF item mappings and existing Item Prices are loaded
+    once, the differences are computed in memory and applied with batched
+    statements. Returns the inserted, updated and deleted counts per price list.
+    """
     company = kwargs
+    start = perf_counter()
     facility_code = frappe.get_cached_value("Company NHIF Settings", company, "facility_code")
     currency = frappe.get_cached_value("Company", company, "default_currency")
     schemeid_list = frappe.db.sql(
         """
             SELECT packageid, schemeid from `tabNHIF Price Package`
-                WHERE facilitycode = {0}
-                AND company = '{1}'
+                WHERE facilitycode = %s
+                AND company = %s
                 GROUP BY packageid, schemeid
-        """.format(
-            facility_code, company
-        ),
+        """,
+        (facility_code, company),
         as_dict=1,
     )
 
+    price_lists_by_scheme = {}
     for scheme in schemeid_list:
         price_list_name = "NHIF-" + scheme.packageid + "-" + facility_code
+        price_lists_by_scheme.setdefault(scheme.schemeid, []).append(price_list_name)
         if not frappe.db.exists("Price List", price_list_name):
             price_list_doc = frappe.new_doc("Price List")
             price_list_doc.price_list_name = price_list_name
@@ -214,88 +290,183 @@ def process_prices_list(kwargs):
             price_list_doc.selling = 1
             price_list_doc.save(ignore_permissions=True)
 
+    if not price_lists_by_scheme:
+        return {}
+
+    # lowest facility level wins when an item is priced on several levels
+    package_rates = {}
+    for package in frappe.db.sql(
+        """
+            SELECT schemeid, itemcode, unitprice
+            FROM `tabNHIF Price Package`
+            WHERE facilitycode = %s AND company = %s
+            ORDER BY facilitylevelcode
+        """,
+        (facility_code, company),
+        as_dict=1,
+    ):
+        package_rates.setdefault(
+            (package.schemeid, package.itemcode), flt(package.unitprice)
+        )
+
     item_list = frappe.db.sql(
         """
             SELECT icd.ref_code, icd.parent as item_code, npp.schemeid from `tabItem Customer Detail` icd
                 INNER JOIN `tabNHIF Price Package` npp ON icd.ref_code = npp.itemcode
                 WHERE icd.customer_name = 'NHIF'
+                AND npp.company = %s
                 GROUP by icd.ref_code, icd.parent, npp.schemeid
         """,
+        company,
         as_dict=1,
     )
 
+    expected_rates = {}
     for item in item_list:
-        for scheme in schemeid_list:
-            schemeid = scheme.schemeid
-            if item.schemeid != schemeid:
-                continue
-            price_list_name = "NHIF-" + scheme.packageid + "-" + facility_code
-            package_list = frappe.db.sql(
-                """
-                    SELECT schemeid, itemcode, unitprice, isactive
-                    FROM `tabNHIF Price Package` 
-                    WHERE facilitycode = {0} and schemeid = {1} and itemcode = {2}
-                    GROUP BY itemcode, schemeid, facilitylevelcode
-                    ORDER BY facilitylevelcode
-                    LIMIT 1
-                """.format(
-                    facility_code, schemeid, item.ref_code
-                ),
-                as_dict=1,
-            )
-            if len(package_list) > 0:
-                for package in package_list:
-                    item_price_list = frappe.get_all(
-                        "Item Price",
-                        filters={
-                            "price_list": price_list_name,
-                            "item_code": item.item_code,
-                            "currency": currency,
-                            "selling": 1,
-                        },
-                        fields=["name", "item_code", "price_list_rate"],
-                    )
-                    if len(item_price_list) > 0:
-                        for price in item_price_list:
-                            #2023-05-16 
-                            # remove condition for isactive
-                            # if package.isactive and int(package.isactive) == 1:
-                            
-                            if float(price.price_list_rate) != float(
-                                package.unitprice
-                            ):
-                                # delete Item Price if no package.unitprice or it is 0
-                                if (
-                                    not float(package.unitprice)
-                                    or float(package.unitprice) == 0
-                                ):
-                                    frappe.delete_doc("Item Price", price.name)
-                                else:
-                                    frappe.set_value(
-                                        "Item Price",
-                                        price.name,
-                                        "price_list_rate",
-                                        float(package.unitprice),
-                                    )
-                            # else:
-                                # frappe.delete_doc("Item Price", price.name)
-
-                    # elif package.isactive and int(package.isactive) == 1:
-                    else:
-                        item_price_doc = frappe.new_doc("Item Price")
-                        item_price_doc.update(
-                            {
-                                "item_code": item.item_code,
-                                "price_list": price_list_name,
-                                "currency": currency,
-                                "price_list_rate": float(package.unitprice),
-                                "buying": 0,
-                                "selling": 1,
-                            }
-                        )
-                        item_price_doc.insert(ignore_permissions=True)
-                        item_price_doc.save(ignore_permissions=True)
+        rate = package_rates.get((item.schemeid, item.ref_code))
+        if rate is None:
+            continue
+        for price_list_name in price_lists_by_scheme.get(item.schemeid, []):
+            expected_rates[(price_list_name, item.item_code)] = rate
+
+    existing_prices = {}
+    for price in frappe.db.sql(
+        """
+            SELECT name, price_list, item_code, price_list_rate
+            FROM `tabItem Price`
+            WHERE price_list IN %(price_lists)s
+            AND currency = %(currency)s
+            AND selling = 1
+        """,
+        {
+            "price_lists": tuple(
+                price_list_name
+                for price_lists in price_lists_by_scheme.values()
+                for price_list_name in price_lists
+            ),
+            "currency": currency,
+        },
+        as_dict=1,
+    ):
+        existing_prices.setdefault((price.price_list, price.item_code), []).append(
+            price
+        )
+
+    counts = {}
+    to_insert, to_update, to_delete = [], {}, []
+    for (price_list_name, item_code), rate in expected_rates.items():
+        count = counts.setdefault(
+            price_list_name, {"inserted": 0, "updated": 0, "deleted": 0}
+        )
+        prices = existing_prices.get((price_list_name, item_code))
+        if prices:
+            for price in prices:
+                if flt(price.price_list_rate) == rate:
+                    continue
+                # delete Item Price if no package.unitprice or it is 0
+                if not rate:
+                    to_delete.append(price.name)
+                    count["deleted"] += 1
+                else:
+                    to_update[price.name] = rate
+                    count["updated"] += 1
+        elif rate:
+            to_insert.append((price_list_name, item_code, rate))
+            count["inserted"] += 1
+
+    apply_item_price_changes(to_insert, to_update, to_delete, currency)
     frappe.db.commit()
+    for price_list_name, count in counts.items():
+        if any(count.values()):
+            clear_price_list_cache(price_list_name, currency)
+
+    frappe.logger().info(
+        {
+            "process_prices_list": company,
+            "seconds": round(perf_counter() - start, 2),
+            "counts": counts,
+        }
+    )
+    return counts
+
+
+def apply_item_price_changes(to_insert, to_update, to_delete, currency):
+    time_stamp = now()
+    user = frappe.session.user
+
+    for names in create_batch(to_delete, 1000):
+        frappe.db.sql(
+            "DELETE FROM `tabItem Price` WHERE name IN %(names)s",
+            {"names": tuple(names)},
+        )
+
+    for names in create_batch(list(to_update), 1000):
+        frappe.db.sql(
+            """
+            UPDATE `tabItem Price`
+            SET price_list_rate = CASE name {0} END,
+                modified = %s,
+                modified_by = %s
+            WHERE name IN ({1})
+            """.format(
+                " ".join(["WHEN %s THEN %s"] * len(names)),
+                ", ".join(["%s"] * len(names)),
+            ),
+            tuple(
+                value for name in names for value in (name, to_update[name])
+            )
+            + (time_stamp, user)
+            + tuple(names),
+        )
+
+    if not to_insert:
+        return
+
+    item_details = {
+        item.name: item
+        for item in frappe.get_all(
+            "Item",
+            filters={"name": ["in", list({row[1] for row in to_insert})]},
+            fields=["name", "item_name", "description"],
+        )
+    }
+    today = nowdate()
+    for rows in create_batch(to_insert, 1000):
+        insert_data = []
+        for price_list_name, item_code, rate in rows:
+            item = item_details.get(item_code) or frappe._dict()
+            insert_data.append(
+                (
+                    frappe.generate_hash("", 10),
+                    item_code,
+                    item.item_name,
+                    item.description,
+                    price_list_name,
+                    currency,
+                    rate,
+                    0,
+                    1,
+                    today,
+                    time_stamp,
+                    time_stamp,
+                    user,
+                    user,
+                )
+            )
+        frappe.db.sql(
+            """
+            INSERT INTO `tabItem Price`
+            (
+                `name`, `item_code`, `item_name`, `item_description`, `price_list`,
+                `currency`, `price_list_rate`, `buying`, `selling`, `valid_from`,
+                `creation`, `modified`, `modified_by`, `owner`
+            )
+            VALUES {}
+            """.format(
+                ", ".join(["%s"] * len(insert_data))
+            ),
+            tuple(insert_data),
+        )
 
 
 def get_insurance_coverage_items(company):
@@ -369,31 +540,34 @@ def get_insurance_coverage_items(company):
     return items_list
 
 
-def get_excluded_services(itemcode, company):
-    excluded_services = None
-    excluded_services_list = frappe.get_all(
+def get_excluded_services_map(company):
+    excluded_services_map = {}
+    for row in frappe.get_all(
         "NHIF Excluded Services",
-        filters={"itemcode": itemcode, "company": company},
-        fields=["excludedforproducts", "schemeid"],
-    )
-    if len(excluded_services_list) > 0:
-        excluded_services = excluded_services_list[0]
-    return excluded_services
+        filters={"company": company},
+        fields=["itemcode", "excludedforproducts", "schemeid"],
+    ):
+        excluded_services_map.setdefault(row.itemcode, row)
+    return excluded_services_map
 
 
-def get_price_package(itemcode, schemeid, company):
-    price_package = ""
-    price_package_list = frappe.get_all(
+def get_price_package_map(company):
+    price_package_map = {}
+    for row in frappe.get_all(
         "NHIF Price Package",
-        filters={"itemcode": itemcode, "schemeid": schemeid, "company": company},
-        fields=["maximumquantity", "isrestricted"],
-    )
-    if len(price_package_list) > 0:
-        price_package = price_package_list[0]
-    return price_package
+        filters={"company": company},
+        fields=["itemcode", "schemeid", "maximumquantity", "isrestricted"],
+    ):
+        price_package_map.setdefault((row.itemcode, row.schemeid), row)
+    return price_package_map
 
 
 def process_insurance_coverages(kwargs):
+    """Regenerate the auto generated coverages of all active NHIF plans.
+
+    Exclusions and price packages are read once for the company, and the old
+    rows are swapped for the new ones in a single transaction.
+    """
     company = kwargs
     items_list = get_insurance_coverage_items(company)
 
@@ -407,14 +581,20 @@ def process_insurance_coverages(kwargs):
         },
     )
 
+    excluded_services_map = get_excluded_services_map(company)
+    custom_excluded_services_map = get_custom_excluded_services_map(company)
+    price_package_map = get_price_package_map(company)
+
+    items_by_scheme = {}
+    for item in items_list:
+        items_by_scheme.setdefault(item.schemeid, []).append(item)
+
+    coverage_rows = []
+    plans_to_replace = []
     for plan in coverage_plan_list:
-        insert_data = []
-        time_stamp = now()
-        user = frappe.session.user
-        for item in items_list:
-            if plan.nhif_scheme_id != item.schemeid:
-                continue
-            excluded_services = get_excluded_services(item.ref_code, company)
+        plan_rows = []
+        for item in items_by_scheme.get(plan.nhif_scheme_id, []):
+            excluded_services = excluded_services_map.get(item.ref_code)
             if (
                 excluded_services
                 and excluded_services.excludedforproducts
@@ -426,9 +606,7 @@ def process_insurance_coverages(kwargs):
                 ):
                     continue
 
-            user_excluded_products = get_custom_excluded_services(
-                company, item.ref_code
-            )
+            user_excluded_products = custom_excluded_services_map.get(item.ref_code)
             if (
                 user_excluded_products
                 and plan.code_for_nhif_excluded_services
@@ -436,19 +614,9 @@ def process_insurance_coverages(kwargs):
             ):
                 continue
 
-            doc = frappe.new_doc("Healthcare Service Insurance Coverage")
-            doc.healthcare_service = item.dt
-            doc.healthcare_service_template = item.healthcare_service_template
-            doc.healthcare_insurance_coverage_plan = plan.name
-            doc.company = company
-            doc.coverage = 100
-            doc.end_date = "2099-12-31"
-            doc.is_active = 1
-            doc.discount = 0
-
             maximumquantity = 0
             isrestricted = 0
-            price_package = get_price_package(item.ref_code, item.schemeid, company)
+            price_package = price_package_map.get((item.ref_code, item.schemeid))
             if price_package:
                 if (
                     price_package.maximumquantity
@@ -458,85 +626,104 @@ def process_insurance_coverages(kwargs):
                 if price_package.isrestricted:
                     isrestricted = int(price_package.isrestricted)
 
-            set_new_name(doc)
+            plan_rows.append((plan.name, item, isrestricted, maximumquantity))
 
-            insert_data.append(
-                (
-                    isrestricted,  # doc.approval_mandatory_for_claim,
-                    doc.coverage,
-                    time_stamp,
-                    doc.discount,
-                    doc.end_date,
-                    doc.healthcare_insurance_coverage_plan,
-                    doc.healthcare_service,
-                    doc.healthcare_service_template,
-                    doc.is_active,
-                    isrestricted,  # doc.manual_approval_only,
-                    maximumquantity,  # doc.maximum_number_of_claims,
-                    time_stamp,
-                    user,
-                    doc.name,
-                    doc.naming_series,
-                    user,
-                    doc.start_date,
-                    1,
-                    doc.company,
-                )
+        if plan_rows and plan.name:
+            plans_to_replace.append(plan.name)
+            coverage_rows.extend(plan_rows)
+
+    if not coverage_rows:
+        return
+
+    naming_series = frappe.get_meta(
+        "Healthcare Service Insurance Coverage"
+    ).get_field("naming_series").options.split("\n")[0]
+    names = get_naming_series_names(naming_series, len(coverage_rows))
+    time_stamp = now()
+    start_date = nowdate()
+    user = frappe.session.user
+
+    insert_data = []
+    for name, (plan_name, item, isrestricted, maximumquantity) in zip(
+        names, coverage_rows
+    ):
+        insert_data.append(
+            (
+                isrestricted,  # approval_mandatory_for_claim,
+                100,  # coverage
+                time_stamp,
+                0,  # discount
+                "2099-12-31",  # end_date
+                plan_name,
+                item.dt,
+                item.healthcare_service_template,
+                1,  # is_active
+                isrestricted,  # manual_approval_only,
+                maximumquantity,  # maximum_number_of_claims,
+                time_stamp,
+                user,
+                name,
+                naming_series,
+                user,
+                start_date,
+                1,
+                company,
             )
+        )
 
-        if insert_data:
-            if plan.name:
-                frappe.db.sql(
-                        "DELETE FROM `tabHealthcare Service Insurance Coverage` WHERE is_auto_generated = 1 AND healthcare_insurance_coverage_plan = '{0}'".format(
-                            plan.name
-                        )
-                    )
-                frappe.db.commit()
-                
-            # wait for 60 seconds before creating HSIC records again
-            sleep(60)
-
-            frappe.db.sql(
-                """
-                INSERT INTO `tabHealthcare Service Insurance Coverage`
-                (
-                    `approval_mandatory_for_claim`, 
-                    `coverage`, 
-                    `creation`, 
-                    `discount`, 
-                    `end_date`, 
-                    `healthcare_insurance_coverage_plan`, 
-                    `healthcare_service`, 
-                    `healthcare_service_template`, 
-                    `is_active`, 
-                    `manual_approval_only`, 
-                    `maximum_number_of_claims`, 
-                    `modified`, 
-                    `modified_by`, 
-                    `name`, 
-                    `naming_series`, 
-                    `owner`, 
-                    `start_date`,
-                    `is_auto_generated`,
-                    `company`
-                )
-                VALUES {}
-            """.format(
-                    ", ".join(["%s"] * len(insert_data))
-                ),
-                tuple(insert_data),
+    frappe.db.sql(
+        """
+        DELETE FROM `tabHealthcare Service Insurance Coverage`
+        WHERE is_auto_generated = 1
+        AND healthcare_insurance_coverage_plan IN %(plans)s
+        """,
+        {"plans": tuple(plans_to_replace)},
+    )
+    for rows in create_batch(insert_data, 5000):
+        frappe.db.sql(
+            """
+            INSERT INTO `tabHealthcare Service Insurance Coverage`
+            (
+                `approval_mandatory_for_claim`, 
+                `coverage`, 
+                `creation`, 
+                `discount`, 
+                `end_date`, 
+                `healthcare_insurance_coverage_plan`, 
+                `healthcare_service`, 
+                `healthcare_service_template`, 
+                `is_active`, 
+                `manual_approval_only`, 
+                `maximum_number_of_claims`, 
+                `modified`, 
+                `modified_by`, 
+                `name`, 
+                `naming_series`, 
+                `owner`, 
+                `start_date`,
+                `is_auto_generated`,
+                `company`
             )
+            VALUES {}
+        """.format(
+                ", ".join(["%s"] * len(rows))
+            ),
+            tuple(rows),
+        )
     frappe.db.commit()
 
 
-def set_nhif_diff_records(FacilityCode):
+def set_nhif_diff_records(FacilityCode, current_rec=None):
     logs = frappe.get_all(
         "NHIF Response Log",
         filters={
             "request_type": "GetPricePackageWithExcludedServices",
-            "response_data": ["not in", ["", None]],
             "request_url": ["like", "%" + FacilityCode + "%"],
         },
+        or_filters={
+            "response_data": ["not in", ["", None]],
+            "response_data_payload": ["is", "set"],
+        },
         order_by="creation desc",
         page_length=2,
     )
@@ -546,158 +733,239 @@ def set_nhif_diff_records(FacilityCode):
     else:
         frappe.throw(_("There are not enough records in NHIF Response Log"))
 
-    current_rec = json.loads(
-        frappe.get_cached_value("NHIF Response Log", current, "response_data")
+    def get_records(log_name, rec, key):
+        if rec is not None:
+            return rec.get(key) or []
+        # stream the stored payload instead of loading it as one string
+        return iter_log_records(log_name, key)
+
+    (
+        changed_price_packages,
+        new_price_packages,
+        deleted_price_packages,
+    ) = diff_nhif_records(
+        get_records(current, current_rec, "PricePackage"),
+        get_records(previous, None, "PricePackage"),
+        ("PriceCode",),
     )
-    previous_rec = json.loads(
-        frappe.get_cached_value("NHIF Response Log", previous, "response_data")
+    (
+        changed_excluded_services,
+        new_excluded_services,
+        deleted_excluded_services,
+    ) = diff_nhif_records(
+        get_records(current, current_rec, "ExcludedServices"),
+        get_records(previous, None, "ExcludedServices"),
+        ("ItemCode", "SchemeID"),
     )
-    current_price_packages = current_rec.get("PricePackage")
-    previousـprice_packages = previous_rec.get("PricePackage")
-
-    diff_price_packages_from_current = [
-        i for i in current_price_packages if i not in previousـprice_packages
-    ]
-    diff_price_packages_from_previous = [
-        i for i in previousـprice_packages if i not in current_price_packages
-    ]
-
-    changed_price_packages = []
-    new_price_packages = []
 
-    for e in diff_price_packages_from_current:
-        exist_rec = next(
-            (
-                item
-                for item in diff_price_packages_from_previous
-                if item.get("PriceCode") == e.get("PriceCode")
-            ),
-            None,
-        )
-        if exist_rec:
-            changed_price_packages.append(exist_rec)
-        else:
-            new_price_packages.append(e)
-
-    deleted_price_packages = []
-
-    for z in diff_price_packages_from_previous:
-        exist_rec = next(
-            (
-                item
-                for item in diff_price_packages_from_current
-                if item.get("PriceCode") == z.get("PriceCode")
-            ),
-            None,
-        )
-        if not exist_rec:
-            deleted_price_packages.append(z)
-
-    doc = frappe.new_doc("NHIF Update")
-    if (
-        len(changed_price_packages)
-        or len(new_price_packages)
-        or len(deleted_price_packages)
+    if not (
+        changed_price_packages
+        or new_price_packages
+        or deleted_price_packages
+        or changed_excluded_services
+        or new_excluded_services
+        or deleted_excluded_services
     ):
-        add_price_packages_records(doc, changed_price_packages, "Changed")
-        add_price_packages_records(doc, new_price_packages, "New")
-        add_price_packages_records(doc, deleted_price_packages, "Deleted")
+        return
 
-    current_excluded_services = current_rec.get("ExcludedServices")
-    previous_excluded_services = previous_rec.get("ExcludedServices")
+    doc = frappe.new_doc("NHIF Update")
+    doc.current_log = current
+    doc.previous_log = previous
+    doc.insert(ignore_permissions=True)
+
+    price_rows = []
+    add_price_packages_records(price_rows, changed_price_packages, "Changed")
+    add_price_packages_records(price_rows, new_price_packages, "New")
+    add_price_packages_records(price_rows, deleted_price_packages, "Deleted")
+    insert_nhif_update_rows(
+        doc, "price_package", "Staging NHIF Price Package", price_rows
+    )
 
-    diff_current_excluded_services = [
-        i for i in current_excluded_services if i not in previous_excluded_services
-    ]
-    diff_previous_excluded_services = [
-        i for i in previous_excluded_services if i not in previous_excluded_services
+    excluded_rows = []
+    add_excluded_services_records(
+        excluded_rows, changed_excluded_services, "Changed"
+    )
+    add_excluded_services_records(excluded_rows, new_excluded_services, "New")
+    add_excluded_services_records(
+        excluded_rows, deleted_excluded_services, "Deleted"
+    )
+    insert_nhif_update_rows(
+        doc, "excluded_services", "Staging NHIF Excluded Services", excluded_rows
+    )
+    return doc.name
+
+
+def get_nhif_records_index(records, key_fields):
+    """Map the natural key of every record to its content digest and the record"""
+    index = {}
+    for record in records:
+        key = tuple(cstr(record.get(field)) for field in key_fields)
+        digest = hashlib.md5(
+            json.dumps(record, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        index[key] = (digest, record)
+    return index
+
+
+def diff_nhif_records(current_records, previous_records, key_fields):
+    """Compare two iterables of NHIF payload records in linear time.
+
+    Returns changed, new and deleted records. Like before, a changed record is
+    reported with its previous values.
+    """
+    previous_index = get_nhif_records_index(previous_records, key_fields)
+
+    changed, new, seen_keys = [], [], set()
+    for record in current_records:
+        key = tuple(cstr(record.get(field)) for field in key_fields)
+        if key in seen_keys:
+            continue
+        seen_keys.add(key)
+
+        previous = previous_index.get(key)
+        if not previous:
+            new.append(record)
+            continue
+
+        digest = hashlib.md5(
+            json.dumps(record, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        if digest != previous[0]:
+            changed.append(previous[1])
+
+    deleted = [
+        record
+        for key, (digest, record) in previous_index.items()
+        if key not in seen_keys
     ]
+    return changed, new, deleted
+
+
+def benchmark_nhif_diff(sizes=None, change_ratio=0.05):
+    """Time `diff_nhif_records` against synthetic price packages of growing size.
+
+    Run with `bench --site <site> execute hms_tz.nhif.api.insurance_company.benchmark_nhif_diff`
+    """
+    sizes = sizes or [1000, 5000, 10000, 20000, 40000, 80000]
+    results = []
+    for size in sizes:
+        previous = [
+            {
+                "ItemCode": str(10000 + i),
+                "PriceCode": "PC" + str(i),
+                "SchemeID": str(i % 8),
+                "ItemName": "Item " + str(i),
+                "UnitPrice": 1000 + i,
+                "MaximumQuantity": -1,
+                "IsRestricted": False,
+                "IsActive": True,
+            }
+            for i in range(size)
+        ]
+        step = max(int(1 / change_ratio), 1) if change_ratio else size + 1
+        current = []
+        for i, record in enumerate(previous):
+            if i % step == 1:
+                continue
+            record = dict(record)
+            if i % step == 0:
+                record["UnitPrice"] += 100
+            current.append(record)
+        current.extend(
+            dict(previous[0], PriceCode="NEW" + str(i)) for i in range(size // step)
+        )
 
-    changed_excluded_services = []
-    new_excluded_services = []
-
-    for e in diff_current_excluded_services:
-        exist_rec = next(
-            (
-                item
-                for item in diff_previous_excluded_services
-                if item.get("ItemCode") == e.get("ItemCode")
-            ),
-            None,
+        start = perf_counter()
+        changed, new, deleted = diff_nhif_records(current, previous, ("PriceCode",))
+        elapsed = perf_counter() - start
+
+        results.append(
+            {
+                "size": size,
+                "seconds": round(elapsed, 4),
+                "changed": len(changed),
+                "new": len(new),
+                "deleted": len(deleted),
+            }
         )
-        if exist_rec:
-            changed_excluded_services.append(exist_rec)
-        else:
-            new_excluded_services.append(e)
+    frappe.logger("hms_tz").info({"benchmark_nhif_diff": results})
+    return results
 
-    deleted_excluded_services = []
 
-    for z in diff_previous_excluded_services:
-        exist_rec = next(
-            (
-                item
-                for item in diff_current_excluded_services
-                if item.get("ItemCode") == z.get("ItemCode")
+def insert_nhif_update_rows(doc, parentfield, child_doctype, rows):
+    if not rows:
+        return
+    time_stamp = now()
+    user = frappe.session.user
+    for idx, row in enumerate(rows, 1):
+        row.update(
+            {
+                "name": frappe.generate_hash("", 10),
+                "parent": doc.name,
+                "parenttype": doc.doctype,
+                "parentfield": parentfield,
+                "idx": idx,
+                "docstatus": 0,
+                "creation": time_stamp,
+                "modified": time_stamp,
+                "modified_by": user,
+                "owner": user,
+            }
+        )
+    columns = list(rows[0])
+    for batch in create_batch(rows, 5000):
+        frappe.db.sql(
+            """
+            INSERT INTO `tab{0}` ({1})
+            VALUES {2}
+            """.format(
+                child_doctype,
+                ", ".join("`{0}`".format(col) for col in columns),
+                ", ".join(["%s"] * len(batch)),
             ),
-            None,
+            tuple(tuple(row[col] for col in columns) for row in batch),
         )
-        if not exist_rec:
-            deleted_excluded_services.append(z)
 
-    if (
-        len(changed_excluded_services)
-        or len(new_excluded_services)
-        or len(deleted_excluded_services)
-    ):
-        add_excluded_services_records(doc, changed_excluded_services, "Changed")
-        add_excluded_services_records(doc, new_excluded_services, "New")
-        add_excluded_services_records(doc, deleted_excluded_services, "Deleted")
 
-    if (doc.get("price_package") and len(doc.price_package)) or (
-        doc.get("excluded_services") and (doc.excluded_services)
-    ):
-        doc.current_log = current
-        doc.previous_log = previous
-        doc.save(ignore_permissions=True)
+def add_price_packages_records(rows, rec, type):
+    for e in rec:
+        rows.append(
+            {
+                "itemcode": e.get("ItemCode"),
+                "type": type,
+                "facilitycode": e.get("FacilityCode"),
+                "package_item_id": e.get("PackageItemID"),
+                "pricecode": e.get("PriceCode"),
+                "levelpricecode": e.get("LevelPriceCode"),
+                "olditemcode": e.get("OldItemCode"),
+                "itemtypeid": e.get("ItemTypeID"),
+                "itemname": e.get("ItemName"),
+                "schemename": e.get("SchemeName"),
+                "strength": e.get("Strength"),
+                "dosage": e.get("Dosage"),
+                "packageid": e.get("PackageID"),
+                "schemeid": e.get("SchemeID"),
+                "facilitylevelcode": e.get("FacilityLevelCode"),
+                "unitprice": e.get("UnitPrice"),
+                "isrestricted": e.get("IsRestricted"),
+                "maximumquantity": e.get("MaximumQuantity"),
+                "availableinlevels": e.get("AvailableInLevels"),
+                "practitionerqualifications": e.get("PractitionerQualifications"),
+                "isactive": e.get("IsActive"),
+                "record": json.dumps(e),
+            }
+        )
 
 
-def add_price_packages_records(doc, rec, type):
-    if not len(rec) > 0:
-        return
+def add_excluded_services_records(rows, rec, type):
     for e in rec:
-        price_row = doc.append("price_package", {})
-        price_row.itemcode = e.get("ItemCode")
-        price_row.type = type
-        price_row.facilitycode = e.get("FacilityCode")
-        price_row.package_item_id = e.get("PackageItemID")
-        price_row.pricecode = e.get("PriceCode")
-        price_row.levelpricecode = e.get("LevelPriceCode")
-        price_row.olditemcode = e.get("OldItemCode")
-        price_row.itemtypeid = e.get("ItemTypeID")
-        price_row.itemname = e.get("ItemName")
-        price_row.schemename = e.get("SchemeName")
-        price_row.strength = e.get("Strength")
-        price_row.dosage = e.get("Dosage")
-        price_row.packageid = e.get("PackageID")
-        price_row.schemeid = e.get("SchemeID")
-        price_row.facilitylevelcode = e.get("FacilityLevelCode")
-        price_row.unitprice = e.get("UnitPrice")
-        price_row.isrestricted = e.get("IsRestricted")
-        price_row.maximumquantity = e.get("MaximumQuantity")
-        price_row.availableinlevels = e.get("AvailableInLevels")
-        price_row.practitionerqualifications = e.get("PractitionerQualifications")
-        price_row.IsActive = e.get("IsActive")
-        price_row.record = json.dumps(e)
-
-
-def add_excluded_services_records(doc, rec, type):
-    if not len(rec) > 0:
-        return
-    for e in rec:
-        price_row = doc.append("excluded_services", {})
-        price_row.type = type
-        price_row.itemcode = e.get("ItemCode")
-        price_row.schemeid = e.get("SchemeID")
-        price_row.schemename = e.get("SchemeName")
-        price_row.excludedforproducts = e.get("ExcludedForProducts")
-        price_row.record = json.dumps(e)
+        rows.append(
+            {
+                "type": type,
+                "itemcode": e.get("ItemCode"),
+                "schemeid": e.get("SchemeID"),
+                "schemename": e.get("SchemeName"),
+                "excludedforproducts": e.get("ExcludedForProducts"),
+                "record": json.dumps(e),
+            }
+        )
@@ -15,6 +15,19 @@ import dateutil
 from frappe.query_builder import DocType
 
 
+reference_ranges_version_key = "lab_reference_ranges_version"
+# reference range band => prefix of its fields on Lab Test Template
+range_field_prefixes = {
+    "infant": "i",
+    "child": "c",
+    "Male": "m",
+    "Female": "f",
+}
+
+# site => (version, compiled reference ranges)
+_reference_ranges = {}
+
+
 def validate(doc, method):
     if not doc.prescribe:
         is_restricted = get_restricted_LRPT(doc)
@@ -32,20 +45,22 @@ def onload(doc, method):
 )
 
 def set_normals(doc):
-    dob = frappe.get_cached_value("Patient", doc.patient, "dob")
-    age = dateutil.relativedelta.relativedelta(getdate(), dob).years
-    for row in doc.normal_test_items:
-        normals = get_normals(row.lab_test_name, age, doc.patient_sex)
-        if normals:
-            row.min_normal = normals.get("min")
-            row.max_normal = normals.get("max")
-            row.text_normal = normals.get("text")
-
-            if not row.result_value:
-                continue
-            data_normals = calc_data_normals(normals, row.result_value)
-            row.detailed_normal_range = data_normals["detailed_normal_range"]
-            row.result_status = data_normals["result_status"]
+    age = get_patient_age(doc.patient)
+    results = evaluate_results(doc.normal_test_items, age, doc.patient_sex)
+    for row, normals in zip(doc.normal_test_items, results):
+        if normals is None:
+            continue
+        row.min_normal = normals.get("min")
+        row.max_normal = normals.get("max")
+        row.text_normal = normals.get("text")
+        if "result_status" in normals:
+            row.detailed_normal_range = normals["detailed_normal_range"]
+            row.result_status = normals["result_status"]
+
+
+def get_patient_age(patient, date=None):
+    dob = frappe.get_cached_value("Patient", patient, "dob")
+    return dateutil.relativedelta.relativedelta(getdate(date), dob).years
 
 
 def calc_data_normals(data, value):
@@ -83,40 +98,125 @@ def calc_data_normals(data, value):
     return result
 
 
+def evaluate_results(rows, patient_age, patient_sex):
+    """Reference range and status of every result row of a patient, in one pass
+    over the compiled reference ranges.
+
+    Returns one dict per row, or None for rows whose test has no range for the
+    patient. Status is only set for rows with a numeric result value.
+    """
+    reference_ranges = get_reference_ranges()
+    band = get_range_band(patient_age, patient_sex)
+    results = []
+    for row in rows:
+        normals = reference_ranges.get(row.get("lab_test_name"), {}).get(band)
+        if normals is None:
+            results.append(None)
+            continue
+
+        normals = dict(normals)
+        if row.get("result_value"):
+            try:
+                normals.update(calc_data_normals(normals, row.get("result_value")))
+            except ValueError:
+                pass
+        results.append(normals)
+    return results
+
+
+@frappe.whitelist()
+def evaluate_sample_collection(sample_collection):
+    """Reference ranges and status of the results of every Lab Test of a Sample Collection"""
+    lab_tests = frappe.get_all(
+        "Lab Test",
+        filters={"sample": sample_collection},
+        fields=["name", "patient", "patient_sex"],
+    )
+    if not lab_tests:
+        return {}
+
+    rows_by_test = {}
+    for row in frappe.get_all(
+        "Normal Test Result",
+        filters={
+            "parenttype": "Lab Test",
+            "parent": ["in", [lab_test.name for lab_test in lab_tests]],
+        },
+        fields=["name", "parent", "lab_test_name", "result_value"],
+        order_by="parent, idx",
+    ):
+        rows_by_test.setdefault(row.parent, []).append(row)
+
+    evaluation = {}
+    for lab_test in lab_tests:
+        rows = rows_by_test.get(lab_test.name, [])
+        results = evaluate_results(
+            rows, get_patient_age(lab_test.patient), lab_test.patient_sex
+        )
+        evaluation[lab_test.name] = [
+            dict(row, **(normals or {})) for row, normals in zip(rows, results)
+        ]
+    return evaluation
+
+
 @frappe.whitelist()
 def get_normals(lab_test_name, patient_age, patient_sex):
-    data = {}
-    doc = get_lab_test_template(lab_test_name)
-    if not doc:
-        return data
+    normals = get_reference_ranges().get(lab_test_name, {}).get(
+        get_range_band(patient_age, patient_sex)
+    )
+    return dict(normals) if normals else {}
+
+
+def get_range_band(patient_age, patient_sex):
+    """Reference range band of a patient: infant, child or the adult sex"""
     if float(patient_age) < 3:
-        data["min"] = doc.i_min_range
-        data["max"] = doc.i_max_range
-        data["text"] = doc.i_text
+        return "infant"
     elif float(patient_age) < 12:
-        data["min"] = doc.c_min_range
-        data["max"] = doc.c_max_range
-        data["text"] = doc.c_text
-    else:
-        if patient_sex == "Male":
-            data["min"] = doc.m_min_range
-            data["max"] = doc.m_max_range
-            data["text"] = doc.m_text
-        elif patient_sex == "Female":
-            data["min"] = doc.f_min_range
-            data["max"] = doc.f_max_range
-            data["text"] = doc.f_text
-
-    return data
-
-
-def get_lab_test_template(lab_test_name):
-    template_id = frappe.db.exists(
-        "Lab Test Template", {"lab_test_code": lab_test_name}
+        return "child"
+    elif patient_sex in ("Male", "Female"):
+        return patient_sex
+
+
+def get_reference_ranges():
+    """{lab_test_code: {band: {"min", "max", "text"}}} of all Lab Test Templates.
+
+    Compiled once per process and site, and compiled again when a template
+    changed since, see `clear_reference_ranges`.
+    """
+    version = frappe.cache().get_value(reference_ranges_version_key)
+    compiled = _reference_ranges.get(frappe.local.site)
+    if not compiled or compiled[0] != version:
+        compiled = (version, compile_reference_ranges())
+        _reference_ranges[frappe.local.site] = compiled
+    return compiled[1]
+
+
+def compile_reference_ranges():
+    fields = ["lab_test_code"]
+    for prefix in range_field_prefixes.values():
+        fields += [prefix + "_min_range", prefix + "_max_range", prefix + "_text"]
+
+    reference_ranges = {}
+    for template in frappe.get_all(
+        "Lab Test Template",
+        filters={"lab_test_code": ["is", "set"]},
+        fields=fields,
+    ):
+        reference_ranges[template.lab_test_code] = {
+            band: {
+                "min": template.get(prefix + "_min_range"),
+                "max": template.get(prefix + "_max_range"),
+                "text": template.get(prefix + "_text"),
+            }
+            for band, prefix in range_field_prefixes.items()
+        }
+    return reference_ranges
+
+
+def clear_reference_ranges(doc=None, method=None):
+    frappe.cache().set_value(
+        reference_ranges_version_key, frappe.generate_hash(length=10)
     )
-    if template_id:
-        return frappe.get_cached_doc("Lab Test Template", lab_test_name)
-    return False
 
 
 def before_submit(doc, method):
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Aakvatech and contributors
+# For license information, please see license.txt
+
+"""MLLP listener for lab analyzers.
+
+Run it next to the bench, e.g. from supervisor:
+
+    bench --site <site> execute hms_tz.nhif.api.mllp.run_listener
+
+Host and port come from `lab_mllp_host` and `lab_mllp_port` in site_config.json,
+the listener binds to 127.0.0.1 unless a host is set. Analyzers connecting from
+other machines must be listed in `lab_mllp_allowed_hosts` (a list or a comma
+separated string of IP addresses), connections from any other peer are closed.
+Every framed HL7 message is stored as a Lab Machine Message and acknowledged,
+the results are applied to the Lab Tests by a background job.
+"""
+
+import socket
+import threading
+import socketserver
+import frappe
+from frappe.utils import cint
+from hms_tz.nhif.api.hl7 import build_ack
+
+
+start_block = b"\x0b"
+end_block = b"\x1c\r"
+default_port = 2575
+read_size = 64 * 1024
+
+
+class MLLPFrameReader:
+    """Incremental decoder of MLLP frames, bytes go in and whole messages come out"""
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while True:
+            start = self.buffer.find(start_block)
+            if start < 0:
+                self.buffer = b""
+                break
+            end = self.buffer.find(end_block, start + 1)
+            if end < 0:
+                # keep the partial frame until the rest arrives
+                self.buffer = self.buffer[start:]
+                break
+            messages.append(self.buffer[start + 1 : end])
+            self.buffer = self.buffer[end + len(end_block) :]
+        return messages
+
+
+def frame(message):
+    return start_block + frappe.safe_encode(message) + end_block
+
+
+class MLLPRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        reader = MLLPFrameReader()
+        machine_id = self.client_address[0]
+        if not self.server.is_allowed(machine_id):
+            frappe.logger("hms_tz").warning(
+                {"mllp_listener": "rejected", "peer": machine_id}
+            )
+            return
+        while True:
+            data = self.request.recv(read_size)
+            if not data:
+                break
+            for message in reader.feed(data):
+                message = frappe.safe_decode(message)
+                try:
+                    self.server.message_handler(message, machine_id)
+                    ack = build_ack(message, "AA")
+                except Exception as e:
+                    ack = build_ack(message, "AE", str(e)[:80])
+                self.request.sendall(frame(ack))
+
+
+class MLLPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Threaded MLLP server handing every message to `message_handler(message, machine_id)`.
+
+    Peers outside `allowed_hosts` are disconnected without reading, `None`
+    allows every peer. With a plain callable as handler and port 0 it doubles
+    as a local stand-in analyzer endpoint for tests, see `start_local_server`.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, message_handler, allowed_hosts=None):
+        super().__init__(address, MLLPRequestHandler)
+        self.message_handler = message_handler
+        self.allowed_hosts = allowed_hosts
+
+    def is_allowed(self, peer):
+        return self.allowed_hosts is None or peer in self.allowed_hosts
+
+
+def start_local_server(message_handler, host="127.0.0.1", port=0, allowed_hosts=None):
+    """Serve MLLP from a background thread, returns the server, its address is
+    `server.server_address` and `server.shutdown()` stops it
+    """
+    server = MLLPServer((host, port), message_handler, allowed_hosts)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def send_messages(host, port, messages, timeout=30):
+    """Send HL7 messages over one MLLP connection like an analyzer does,
+    returns the acknowledgements
+    """
+    acks = []
+    reader = MLLPFrameReader()
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        for message in messages:
+            sock.sendall(frame(message))
+            received = []
+            while not received:
+                data = sock.recv(read_size)
+                if not data:
+                    return acks
+                received = reader.feed(data)
+            acks.extend(frappe.safe_decode(ack) for ack in received)
+    return acks
+
+
+def get_site_message_handler(site):
+    """Store messages as Lab Machine Messages of `site`, every message gets its
+    own site connection since handlers run in the connection threads
+    """
+
+    def handle_message(message, machine_id):
+        from hms_tz.nhif.doctype.lab_machine_message.lab_machine_message import (
+            receive_message,
+        )
+
+        frappe.init(site=site)
+        try:
+            frappe.connect()
+            frappe.set_user("Administrator")
+            receive_message(message, machine_id)
+            frappe.db.commit()
+        except Exception:
+            if frappe.db:
+                frappe.db.rollback()
+                frappe.log_error(
+                    frappe.get_traceback(), "Lab Machine Message not stored"
+                )
+                frappe.db.commit()
+            raise
+        finally:
+            frappe.destroy()
+
+    return handle_message
+
+
+def get_allowed_hosts():
+    """Loopback plus the analyzers listed in `lab_mllp_allowed_hosts`"""
+    hosts = frappe.conf.get("lab_mllp_allowed_hosts") or []
+    if isinstance(hosts, str):
+        hosts = hosts.split(",")
+    allowed = {"127.0.0.1", "::1"}
+    allowed.update(host.strip() for host in hosts if host and host.strip())
+    return allowed
+
+
+def run_listener(host=None, port=None):
+    """Serve MLLP for the current site until stopped"""
+    host = host or frappe.conf.get("lab_mllp_host") or "127.0.0.1"
+    port = cint(port or frappe.conf.get("lab_mllp_port") or default_port)
+    site = frappe.local.site
+    allowed_hosts = get_allowed_hosts()
+    server = MLLPServer((host, port), get_site_message_handler(site), allowed_hosts)
+    frappe.logger("hms_tz").info(
+        {
+            "mllp_listener": "started",
+            "host": host,
+            "port": port,
+            "allowed_hosts": sorted(allowed_hosts),
+        }
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Aakvatech and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import os
+import frappe
+import requests
+from time import sleep, perf_counter
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+
+# endpoint => timeout in seconds, retries and backoff factor in seconds.
+# Any of these can be overridden per site with `nhif_client_policies` in site_config.json
+endpoint_policies = {
+    "Token": {"timeout": 5, "retries": 2, "backoff": 1},
+    "GetCardDetails": {"timeout": 5, "retries": 2, "backoff": 1},
+    "AuthorizeCard": {"timeout": 5, "retries": 0, "backoff": 0},
+    "GetReferenceNoStatus": {"timeout": 120, "retries": 1, "backoff": 1},
+    "GetReferralNo": {"timeout": 30, "retries": 0, "backoff": 0},
+    "SubmitFolios": {"timeout": 300, "retries": 0, "backoff": 0},
+    "GetPricePackageWithExcludedServices": {"timeout": 300, "retries": 2, "backoff": 5},
+    "GetSubmittedClaims": {"timeout": 300, "retries": 1, "backoff": 5},
+}
+default_policy = {"timeout": 30, "retries": 0, "backoff": 0}
+
+# status codes worth retrying, the request did not reach NHIF's application
+retry_status_codes = (502, 503, 504)
+
+pool_maxsize = 10
+
+_sessions = {}
+_sessions_pid = None
+
+
+def get_policy(endpoint):
+    policy = dict(endpoint_policies.get(endpoint) or default_policy)
+    policy.update((frappe.conf.get("nhif_client_policies") or {}).get(endpoint) or {})
+    return policy
+
+
+def get_session(url):
+    """Return the keep-alive session of this process for the base url of `url`"""
+    global _sessions, _sessions_pid
+
+    # sockets must not be shared with a forked parent or child
+    if _sessions_pid != os.getpid():
+        _sessions = {}
+        _sessions_pid = os.getpid()
+
+    parts = urlsplit(url)
+    base_url = "{0}://{1}".format(parts.scheme, parts.netloc)
+    session = _sessions.get(base_url)
+    if not session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        session.mount(base_url, adapter)
+        _sessions[base_url] = session
+    return session
+
+
+def nhif_request(method, url, endpoint, **kwargs):
+    """Send a request to NHIF over the pooled session of its base url.
+
+    The timeout, retries and backoff come from the policy of `endpoint`.
+    Connection errors and gateway errors are retried, everything else is
+    returned to the caller as is.
+    """
+    policy = get_policy(endpoint)
+    kwargs.setdefault("timeout", policy.get("timeout"))
+    session = get_session(url)
+
+    retries = policy.get("retries") or 0
+    for attempt in range(retries + 1):
+        start = perf_counter()
+        try:
+            r = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_metrics(endpoint, perf_counter() - start, error=True)
+            frappe.logger().debug(
+                {"nhif_request_error": e, "endpoint": endpoint, "try": attempt + 1}
+            )
+            if attempt >= retries:
+                raise
+        else:
+            record_metrics(
+                endpoint,
+                perf_counter() - start,
+                error=r.status_code >= 500,
+            )
+            if r.status_code not in retry_status_codes or attempt >= retries:
+                return r
+
+        sleep((policy.get("backoff") or 0) * (2 ** attempt))
+
+
+def get_metrics_key():
+    return frappe.cache().make_key("nhif_client_metrics")
+
+
+def record_metrics(endpoint, seconds, error=False):
+    try:
+        cache = frappe.cache()
+        key = get_metrics_key()
+        pipe = cache.pipeline()
+        pipe.hincrby(key, endpoint + ":count", 1)
+        pipe.hincrby(key, endpoint + ":ms", int(seconds * 1000))
+        if error:
+            pipe.hincrby(key, endpoint + ":errors", 1)
+        pipe.execute()
+    except Exception:
+        # metrics must never break a request
+        pass
+
+
+@frappe.whitelist()
+def get_nhif_client_metrics(reset=False):
+    """Request count, error count and average latency per NHIF endpoint"""
+    frappe.only_for("System Manager")
+
+    # a plain pipeline skips the pickling done by frappe's redis wrapper
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(get_metrics_key())
+    if frappe.utils.cint(reset):
+        pipe.delete(get_metrics_key())
+    raw = pipe.execute()[0] or {}
+
+    metrics = {}
+    for field, value in raw.items():
+        endpoint, metric = frappe.safe_decode(field).rsplit(":", 1)
+        metrics.setdefault(endpoint, {"count": 0, "ms": 0, "errors": 0})[metric] = int(
+            value
+        )
+
+    for endpoint, row in metrics.items():
+        row["average_ms"] = round(row["ms"] / row["count"], 1) if row["count"] else 0
+    return metrics
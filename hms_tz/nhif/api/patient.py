@@ -8,8 +8,7 @@ from frappe import _
 from hms_tz.nhif.api.token import get_nhifservice_token
 from erpnext import get_default_company
 import json
-import requests
-from time import sleep
+from hms_tz.nhif.api.nhif_client import nhif_request
 from hms_tz.nhif.doctype.nhif_product.nhif_product import add_product
 from hms_tz.nhif.doctype.nhif_scheme.nhif_scheme import add_scheme
 from frappe.utils import getdate, nowdate, flt
@@ -78,42 +77,33 @@ def get_patient_info(card_no=None):
         + "/nhifservice/breeze/verification/GetCardDetails?CardNo="
         + str(card_no)
     )
-    for i in range(3):
-        try:
-            r = requests.get(url, headers=headers, timeout=5)
-            r.raise_for_status()
-            frappe.logger().debug({"webhook_success": r.text})
-            if json.loads(r.text):
-                add_log(
-                    request_type="GetCardDetails",
-                    request_url=url,
-                    request_header=headers,
-                    response_data=json.loads(r.text),
-                )
-                card = json.loads(r.text)
-                frappe.msgprint(_(card["Remarks"]), alert=True)
-                add_scheme(card.get("SchemeID"), card.get("SchemeName"))
-                add_product(card.get("ProductCode"), card.get("ProductName"))
-                return card
-            else:
-                add_log(
-                    request_type="GetCardDetails",
-                    request_url=url,
-                    request_header=headers,
-                )
-                frappe.msgprint(json.loads(r.text))
-                frappe.msgprint(
-                    _(
-                        "Getting information from NHIF failed. Try again after sometime, or continue manually."
-                    )
-                )
-        except Exception as e:
-            frappe.logger().debug({"webhook_error": e, "try": i + 1})
-            sleep(3 * i + 1)
-            if i != 2:
-                continue
-            else:
-                raise e
+    r = nhif_request("GET", url, "GetCardDetails", headers=headers)
+    r.raise_for_status()
+    frappe.logger().debug({"webhook_success": r.text})
+    if json.loads(r.text):
+        add_log(
+            request_type="GetCardDetails",
+            request_url=url,
+            request_header=headers,
+            response_data=json.loads(r.text),
+        )
+        card = json.loads(r.text)
+        frappe.msgprint(_(card["Remarks"]), alert=True)
+        add_scheme(card.get("SchemeID"), card.get("SchemeName"))
+        add_product(card.get("ProductCode"), card.get("ProductName"))
+        return card
+    else:
+        add_log(
+            request_type="GetCardDetails",
+            request_url=url,
+            request_header=headers,
+        )
+        frappe.msgprint(json.loads(r.text))
+        frappe.msgprint(
+            _(
+                "Getting information from NHIF failed. Try again after sometime, or continue manually."
+            )
+        )
 
 
 def update_patient_history(doc):
@@ -597,53 +597,13 @@ const check_and_set_availability = (frm) => {
                         for (let i = 0; i < slot_details.length; i++) {
                             slot_html = slot_html + `<label>${slot_details[i].slot_name}</label>`;
                             slot_html = slot_html + `<br/>` + slot_details[i].avail_slot.map(slot => {
-                                let appointment_count = 0;
-                                let disabled = false;
+                                let appointment_count = slot.booked || 0;
+                                // booked appointments and absent events are applied on the server
+                                let disabled = slot.disabled == 1;
                                 let start_str = slot.from_time;
                                 let slot_start_time = moment(slot.from_time, 'HH:mm:ss');
                                 let slot_to_time = moment(slot.to_time, 'HH:mm:ss');
                                 let interval = (slot_to_time - slot_start_time) / 60000 | 0;
-                                // iterate in all booked appointments, update the start time and duration
-                                slot_details[i].appointments.forEach(function (booked) {
-                                    let booked_moment = moment(booked.appointment_time, 'HH:mm:ss');
-                                    let end_time = booked_moment.clone().add(booked.duration, 'minutes');
-                                    // Deal with 0 duration appointments
-                                    if (booked_moment.isSame(slot_start_time) || booked_moment.isBetween(slot_start_time, slot_to_time)) {
-                                        if (booked.duration == 0) {
-                                            disabled = true;
-                                            return false;
-                                        }
-                                    }
-                                    // Check for overlaps considering appointment duration
-                                    if (slot_details[i].allow_overlap != 1) {
-                                        if (slot_start_time.isBefore(end_time) && slot_to_time.isAfter(booked_moment)) {
-                                            // There is an overlap
-                                            disabled = true;
-                                            return false;
-                                        }
-                                    }
-                                    else {
-                                        if (slot_start_time.isBefore(end_time) && slot_to_time.isAfter(booked_moment)) {
-                                            appointment_count++
-                                        }
-                                        if (appointment_count >= slot_details[i].service_unit_capacity) {
-                                            // There is an overlap
-                                            disabled = true;
-                                            return false;
-                                        }
-                                    }
-                                });
-                                //iterate in all absent events and disable the slots
-                                slot_details[i].absent_events.forEach(function (event) {
-                                    let event_from_time = moment(event.from_time, 'HH:mm:ss');
-                                    let event_to_time = moment(event.to_time, 'HH:mm:ss');
-                                    // Check for overlaps considering event start and end time
-                                    if (slot_start_time.isBefore(event_to_time) && slot_to_time.isAfter(event_from_time)) {
-                                        // There is an overlap
-                                        disabled = true;
-                                        return false;
-                                    }
-                                });
                                 let count = ''
                                 if (slot_details[i].allow_overlap == 1 && slot_details[i].service_unit_capacity > 1) {
                                     count = '' - '' + (slot_details[i].service_unit_capacity - appointment_count)
@@ -666,8 +626,9 @@ const check_and_set_availability = (frm) => {
 
                                 slot_html = slot_html + `<label>${present_events[i].slot_name}</label>`;
                                 slot_html = slot_html + `<br/>` + present_events[i].avail_slot.map(slot => {
-                                    let appointment_count = 0;
-                                    let disabled = false;
+                                    let appointment_count = slot.booked || 0;
+                                    // booked appointments and absent events are applied on the server
+                                    let disabled = slot.disabled == 1;
                                     let start_str = slot.from_time;
                                     let slot_start_time = moment(slot.from_time, 'HH:mm:ss');
                                     let slot_to_time = moment(slot.to_time, 'HH:mm:ss');
@@ -681,47 +642,6 @@ const check_and_set_availability = (frm) => {
                                             disabled = true;
                                         }
                                     }
-                                    //iterate in all booked appointments, update the start time and duration
-                                    present_events[i].appointments.forEach(function (booked) {
-                                        let booked_moment = moment(booked.appointment_time, 'HH:mm:ss');
-                                        let end_time = booked_moment.clone().add(booked.duration, 'minutes');
-                                        // Deal with 0 duration appointments
-                                        if (booked_moment.isSame(slot_start_time) || booked_moment.isBetween(slot_start_time, slot_to_time)) {
-                                            if (booked.duration == 0) {
-                                                disabled = true;
-                                                return false;
-                                            }
-                                        }
-                                        // Check for overlaps considering appointment duration
-                                        if (present_events[i].allow_overlap != 1) {
-                                            if (slot_start_time.isBefore(end_time) && slot_to_time.isAfter(booked_moment)) {
-                                                // There is an overlap
-                                                disabled = true;
-                                                return false;
-                                            }
-                                        }
-                                        else {
-                                            if (slot_start_time.isBefore(end_time) && slot_to_time.isAfter(booked_moment)) {
-                                                appointment_count++
-                                            }
-                                            if (appointment_count >= present_events[i].service_unit_capacity) {
-                                                // There is an overlap
-                                                disabled = true;
-                                                return false;
-                                            }
-                                        }
-                                    });
-                                    //iterate in all absent events and disable the slots
-                                    present_events[i].absent_events.forEach(function (event) {
-                                        let event_from_time = moment(event.from_time, 'HH:mm:ss');
-                                        let event_to_time = moment(event.to_time, 'HH:mm:ss');
-                                        // Check for overlaps considering event start and end time
-                                        if (slot_start_time.isBefore(event_to_time) && slot_to_time.isAfter(event_from_time)) {
-                                            // There is an overlap
-                                            disabled = true;
-                                            return false;
-                                        }
-                                    });
                                     let count = ''
                                     if (present_events[i].allow_overlap == 1 && present_events[i].service_unit_capacity > 1) {
                                         count = '' - '' + (present_events[i].service_unit_capacity - appointment_count)
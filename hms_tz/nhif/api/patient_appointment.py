@@ -13,8 +13,8 @@ from healthcare.healthcare.doctype.healthcare_settings.healthcare_settings impor
 )
 from frappe.model.mapper import get_mapped_doc
 from hms_tz.nhif.api.token import get_nhifservice_token
+from hms_tz.nhif.api.nhif_client import nhif_request
 import json
-import requests
 from hms_tz.nhif.doctype.nhif_product.nhif_product import add_product
 from hms_tz.nhif.doctype.nhif_scheme.nhif_scheme import add_scheme
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
@@ -496,7 +496,7 @@ def get_authorization_num(
     )
 
     url = set_nhif_url(url)
-    r = requests.get(url, headers=headers, timeout=5)
+    r = nhif_request("GET", url, "AuthorizeCard", headers=headers)
     r.raise_for_status()
     frappe.logger().debug({"webhook_success": r.text})
     if json.loads(r.text):
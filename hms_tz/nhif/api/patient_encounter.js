@@ -806,7 +806,7 @@ frappe.ui.form.on('Drug Prescription', {
                 }
 
             });
-        validate_stock_item(frm, row.drug_code, row.prescribe, row.quantity, row.healthcare_service_unit, "Drug Prescription");
+        check_drug_stock(frm);
 
         // shm rock: 169
         validate_medication_class(frm, row.drug_code);
@@ -873,7 +873,7 @@ frappe.ui.form.on('Drug Prescription', {
         let row = frappe.get_doc(cdt, cdn);
         if (row.override_subscription) {
             frappe.model.set_value(cdt, cdn, "prescribe", 0);
-            validate_stock_item(frm, row.drug_code, row.prescribe, row.quantity, row.healthcare_service_unit, "Drug Prescription");
+            check_drug_stock(frm);
         }
     },
     dosage: (frm, cdt, cdn) => {
@@ -939,27 +939,40 @@ frappe.ui.form.on('Therapy Plan Detail', {
 });
 
 
-const validate_stock_item = function (frm, healthcare_service, prescribe = 0, qty = 1, healthcare_service_unit = "", caller = "Unknown") {
-    if (healthcare_service_unit == "") {
-        healthcare_service_unit = frm.doc.healthcare_service_unit;
-    }
+// rows edited in quick succession are checked together with one call
+const check_drug_stock = frappe.utils.debounce(function (frm) {
+    if (!frm.doc.drug_prescription || frm.doc.drug_prescription.length == 0) { return; }
     frappe.call({
-        method: 'hms_tz.nhif.api.patient_encounter.validate_stock_item',
+        method: 'hms_tz.nhif.api.patient_encounter.get_encounter_stock_availability',
         args: {
-            'healthcare_service': healthcare_service,
-            'qty': qty,
-            'company': frm.doc.company,
-            'prescribe': prescribe,
-            'caller': caller,
-            'healthcare_service_unit': healthcare_service_unit
+            'encounter': frm.doc,
         },
-        callback: function (data) {
-            if (data.message) {
-                // console.log(data.message)
+        callback: function (r) {
+            const availability = r.message || {};
+            let messages = [];
+            frm.doc.drug_prescription.forEach(row => {
+                const stock = availability[row.name];
+                if (!stock) { return; }
+                const service_unit = row.healthcare_service_unit || frm.doc.healthcare_service_unit;
+                if (!stock.warehouse) {
+                    messages.push(__("Warehouse is missing in healthcare service unit {0} when checking for {1}", [service_unit, stock.item_code]));
+                    return;
+                }
+                const qty = flt(row.quantity) || 1;
+                if (qty > flt(stock.actual_qty)) {
+                    messages.push(__("Available quantity for item: <b>{0}</b> is <b>{1}</b> in {2}/{3}.", [stock.item_code, stock.actual_qty, stock.warehouse, service_unit]));
+                }
+            });
+            if (messages.length > 0) {
+                frappe.msgprint({
+                    title: __("Stock Availability"),
+                    message: messages.join("<br>"),
+                    indicator: "red",
+                });
             }
         }
     });
-};
+}, 500);
 const load_print_page = function (invoice_name, pos_profile) {
     const print_format = pos_profile.print_format || "AV Tax Invoice";
     const letter_head = pos_profile.letter_head || 0;
@@ -18,6 +18,7 @@ from frappe.utils import (
 )
 from hms_tz.nhif.api.healthcare_utils import (
     get_item_rate,
+    get_item_rates,
     get_warehouse_from_service_unit,
     get_item_price,
     create_individual_lab_test,
@@ -27,6 +28,9 @@ from hms_tz.nhif.api.healthcare_utils import (
     msgThrow,
     msgPrint,
     validate_nhif_patient_claim_status,
+    get_templates_meta,
+    get_stock_availability,
+    get_stock_availabilities,
 )
 from healthcare.healthcare.doctype.healthcare_settings.healthcare_settings import (
     get_receivable_account,
@@ -39,6 +43,9 @@ from hms_tz.nhif.api.patient_appointment import (
     calculate_patient_age,
 )
 from erpnext.accounts.utils import get_balance_on
+from hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history import (
+    get_prescription_history,
+)
 
 
 def on_trash(doc, method):
@@ -207,10 +214,18 @@ def on_submit_validation(doc, method):
         },
     ]
     for child in childs_map:
+        templates_meta = get_templates_meta(
+            child.get("doctype"),
+            [row.get(child.get("item")) for row in doc.get(child.get("table"))],
+        )
         for row in doc.get(child.get("table")):
-            healthcare_doc = frappe.get_doc(
-                child.get("doctype"), row.get(child.get("item"))
-            )
+            healthcare_doc = templates_meta.get(row.get(child.get("item")))
+            if not healthcare_doc:
+                frappe.throw(
+                    _("{0} {1} not found").format(
+                        child.get("doctype"), frappe.bold(row.get(child.get("item")))
+                    )
+                )
             if healthcare_doc.disabled:
                 msgThrow(
                     _(
@@ -219,15 +234,14 @@ def on_submit_validation(doc, method):
                     method,
                 )
             company_option = None
-            for option in healthcare_doc.company_options:
-                if doc.company == option.company:
-                    company_option = option.company
+            if doc.company in healthcare_doc.company_options:
+                company_option = doc.company
 
-                    if (
-                        child.get("doctype") != "Medication"
-                        and row.doctype != "Drug Prescription"
-                    ):
-                        row.department_hsu = option.service_unit
+                if (
+                    child.get("doctype") != "Medication"
+                    and row.doctype != "Drug Prescription"
+                ):
+                    row.department_hsu = healthcare_doc.company_options[doc.company]
 
             if not company_option:
                 msgThrow(
@@ -270,6 +284,7 @@ def on_submit_validation(doc, method):
 
     # Run on_submit?
     prescribed_list = ""
+    stock_map = get_drug_stock_map(doc.drug_prescription)
     for key, value in child_tables.items():
         table = doc.get(key)
         for row in table:
@@ -319,6 +334,7 @@ def on_submit_validation(doc, method):
                     row.get("prescribe"),
                     healthcare_service_unit=row.get("healthcare_service_unit"),
                     method=method,
+                    stock_map=stock_map,
                 )
                 if doc.insurance_subscription:
                     method = old_method
@@ -617,20 +633,68 @@ def get_item_info(item_code=None, medication_name=None):
     return data
 
 
-def get_stock_availability(item_code, warehouse):
-    latest_sle = frappe.db.sql(
-        """SELECT qty_after_transaction AS actual_qty
-        FROM `tabStock Ledger Entry`
-        WHERE item_code = %s AND warehouse = %s
-          AND is_cancelled = 0
-        ORDER BY creation DESC
-        LIMIT 1""",
-        (item_code, warehouse),
-        as_dict=1,
-    )
+def get_drug_stock_map(drug_rows):
+    """Return {(item_code, warehouse): actual_qty} for the drug rows, read at once"""
+    pairs = []
+    for row in drug_rows:
+        if row.get("is_not_available_inhouse") or not row.get("drug_code"):
+            continue
+        item_code = frappe.get_cached_value("Medication", row.drug_code, "item")
+        warehouse = row.get("healthcare_service_unit") and frappe.get_cached_value(
+            "Healthcare Service Unit", row.healthcare_service_unit, "warehouse"
+        )
+        pairs.append((item_code, warehouse))
+    return get_stock_availabilities(pairs)
+
+
+@frappe.whitelist()
+def get_encounter_stock_availability(encounter):
+    """Return {row name: {item_code, warehouse, actual_qty}} for the in-house stock
+    drugs of an encounter, read with one query so the form checks all rows at once.
+
+    `encounter` is either the name of a Patient Encounter or the form's doc as json,
+    so unsaved rows are included. Rows without a service unit use the encounter's.
+    """
+    if isinstance(encounter, str) and encounter.startswith("{"):
+        encounter = frappe._dict(json.loads(encounter))
+    if isinstance(encounter, dict):
+        default_service_unit = encounter.get("healthcare_service_unit")
+        drug_rows = [frappe._dict(row) for row in encounter.get("drug_prescription") or []]
+    else:
+        frappe.has_permission("Patient Encounter", doc=encounter, throw=True)
+        default_service_unit = frappe.db.get_value(
+            "Patient Encounter", encounter, "healthcare_service_unit"
+        )
+        drug_rows = frappe.get_all(
+            "Drug Prescription",
+            fields=["name", "drug_code", "healthcare_service_unit", "is_not_available_inhouse"],
+            filters={
+                "parent": encounter,
+                "parenttype": "Patient Encounter",
+                "parentfield": "drug_prescription",
+            },
+        )
 
-    sle_qty = latest_sle[0].actual_qty or 0 if latest_sle else 0
-    return sle_qty
+    for row in drug_rows:
+        row.healthcare_service_unit = row.healthcare_service_unit or default_service_unit
+    stock_map = get_drug_stock_map(drug_rows)
+
+    availability = {}
+    for row in drug_rows:
+        if row.is_not_available_inhouse or not row.drug_code:
+            continue
+        item_info = get_item_info(medication_name=row.drug_code)
+        if not item_info.get("is_stock"):
+            continue
+        warehouse = row.healthcare_service_unit and frappe.get_cached_value(
+            "Healthcare Service Unit", row.healthcare_service_unit, "warehouse"
+        )
+        availability[row.name] = {
+            "item_code": item_info.get("item_code"),
+            "warehouse": warehouse,
+            "actual_qty": stock_map.get((item_info.get("item_code"), warehouse)) or 0,
+        }
+    return availability
 
 
 @frappe.whitelist()
@@ -643,6 +707,7 @@ def validate_stock_item(
     healthcare_service_unit=None,
     caller="Unknown",
     method=None,
+    stock_map=None,
 ):
     setting_doc = frappe.get_cached_doc("Healthcare Settings")
     if caller == "Drug Prescription":
@@ -692,7 +757,11 @@ def validate_stock_item(
             method,
         )
     if item_info.get("is_stock") and item_info.get("item_code"):
-        stock_qty = get_stock_availability(item_info.get("item_code"), warehouse) or 0
+        stock_key = (item_info.get("item_code"), warehouse)
+        if stock_map and stock_key in stock_map:
+            stock_qty = stock_map[stock_key] or 0
+        else:
+            stock_qty = get_stock_availability(*stock_key) or 0
         if float(qty) > float(stock_qty):
             # To be removed after few months of stability. 2021-03-18 17:01:46
             # This is to avoid socketio diconnection when bench is restarted but user session is on.
@@ -1209,6 +1278,7 @@ def validate_totals(doc, method, show_alert=True):
         doc.current_total = 0
         discount_percent = get_discount_percent(doc.insurance_company)
 
+        rows = []
         for child in get_field_map():
             for row in doc.get(child.get("table")):
                 if (
@@ -1221,20 +1291,25 @@ def validate_totals(doc, method, show_alert=True):
                 item_code = frappe.get_cached_value(
                     child.get("doctype"), row.get(child.get("item")), "item"
                 )
-                item_price_rate = get_item_rate(
-                    item_code,
-                    doc.company,
-                    doc.insurance_subscription,
-                    doc.insurance_company,
-                )
+                rows.append((item_code, row))
+
+        if not rows:
+            return
 
-                if hasattr(row, "quantity"):
-                    quantity = flt(row.quantity)
-                else:
-                    quantity = 1
+        item_rates = get_item_rates(
+            [item_code for item_code, row in rows],
+            doc.company,
+            doc.insurance_subscription,
+            doc.insurance_company,
+        )
+        for item_code, row in rows:
+            if hasattr(row, "quantity"):
+                quantity = flt(row.quantity)
+            else:
+                quantity = 1
 
-                item_rate = item_price_rate * quantity
-                doc.current_total += item_rate - (item_rate * (discount_percent / 100))
+            item_rate = item_rates.get(item_code) * quantity
+            doc.current_total += item_rate - (item_rate * (discount_percent / 100))
 
     def mark_limit_exceeded(doc):
         for child in get_field_map():
@@ -1717,26 +1792,23 @@ def show_last_prescribed(doc, method):
     if method == "validate":
         msg = None
         valid_days_msg = ""
-        for row in doc.drug_prescription:
-            if row.is_cancelled or row.is_not_available_inhouse:
-                continue
-
-            item_code = frappe.get_cached_value("Medication", row.drug_code, "item")
+        rows = [
+            row
+            for row in doc.drug_prescription
+            if not row.is_cancelled and not row.is_not_available_inhouse
+        ]
+        item_codes = {
+            row.drug_code: frappe.get_cached_value("Medication", row.drug_code, "item")
+            for row in rows
+        }
+        history = get_prescription_history(
+            doc.patient, [("Item", item_code) for item_code in item_codes.values()]
+        )
+        min_days_map = get_min_prescribe_days(doc, "Medication", list(item_codes))
 
-            medication_list = frappe.db.sql(
-                """
-            select dn.posting_date, dni.item_code, dni.stock_qty, dni.uom from `tabDelivery Note` dn
-            inner join `tabDelivery Note Item` dni on dni.parent = dn.name
-                            where dni.item_code = %s
-                            and dn.patient = %s
-                            and dn.docstatus = 1
-                            order by posting_date desc
-                            limit 1"""
-                % ("%s", "%s"),
-                (item_code, doc.patient),
-                as_dict=1,
-            )
-            if len(medication_list) > 0:
+        for row in rows:
+            last_prescribed = history.get(("Item", item_codes.get(row.drug_code)))
+            if last_prescribed:
                 msg = (
                     (msg or "")
                     + _(
@@ -1744,9 +1816,9 @@ def show_last_prescribed(doc, method):
                         + row.drug_code
                         + "</strong>"
                         + " qty: <strong>"
-                        + str(medication_list[0].get("stock_qty"))
+                        + str(last_prescribed.last_qty)
                         + "</strong>, prescribed lastly on: <strong>"
-                        + str(medication_list[0].get("posting_date"))
+                        + str(last_prescribed.last_date)
                     )
                     + "</strong><br>"
                 )
@@ -1755,7 +1827,8 @@ def show_last_prescribed(doc, method):
                     doc,
                     "Medication",
                     row.drug_code,
-                    medication_list[0].get("posting_date"),
+                    last_prescribed.last_date,
+                    min_days_map,
                 )
                 if val_msg:
                     valid_days_msg += val_msg
@@ -1793,6 +1866,67 @@ def update_drug_prescription(patient_encounter_doc, name):
                     )
 
 
+prescription_doctypes = [
+    "Lab Prescription",
+    "Radiology Procedure Prescription",
+    "Procedure Prescription",
+    "Drug Prescription",
+    "Therapy Plan Detail",
+]
+
+
+def get_encounter_costs(encounters):
+    """Return the amount of prescribed items of the encounters not invoiced yet,
+    added up by the database with one query over all prescription tables.
+    """
+    if not encounters:
+        return 0
+
+    queries = []
+    for doctype in prescription_doctypes:
+        if doctype == "Drug Prescription":
+            amount = "(child.quantity - child.quantity_returned) * child.amount"
+        else:
+            amount = "child.amount"
+        queries.append(
+            f"""
+            SELECT SUM({amount}) AS amount
+            FROM `tab{doctype}` child
+            WHERE child.parent IN %(encounters)s
+              AND child.parenttype = 'Patient Encounter'
+              AND child.prescribe = 1
+              AND child.is_not_available_inhouse = 0
+              AND child.invoiced = 0
+              AND child.is_cancelled = 0
+            """
+        )
+
+    costs = frappe.db.sql(
+        " UNION ALL ".join(queries), {"encounters": tuple(encounters)}
+    )
+    return sum(flt(row[0]) for row in costs)
+
+
+def get_inpatient_costs(inpatient_record):
+    """Return the confirmed occupancy and consultancy costs and the cash limit of an
+    Inpatient Record, without loading the record.
+    """
+    costs = frappe.db.sql(
+        """
+        SELECT
+            (SELECT SUM(amount) FROM `tabInpatient Occupancy`
+                WHERE parent = %(inpatient_record)s AND parenttype = 'Inpatient Record'
+                  AND is_confirmed = 1),
+            (SELECT SUM(rate) FROM `tabInpatient Consultancy`
+                WHERE parent = %(inpatient_record)s AND parenttype = 'Inpatient Record'
+                  AND is_confirmed = 1),
+            (SELECT cash_limit FROM `tabInpatient Record` WHERE name = %(inpatient_record)s)
+        """,
+        {"inpatient_record": inpatient_record},
+    )[0]
+    return flt(costs[0]) + flt(costs[1]), flt(costs[2])
+
+
 def validate_patient_balance_vs_patient_costs(
     patient,
     patient_name,
@@ -1804,54 +1938,6 @@ def validate_patient_balance_vs_patient_costs(
     caller="",
     encounters=[],
 ):
-    def get_encounter_costs(encounters):
-        encounter_cost = 0
-        child_map = [
-            {"child_table": "lab_test_prescription"},
-            {"child_table": "radiology_procedure_prescription"},
-            {"child_table": "procedure_prescription"},
-            {"child_table": "drug_prescription"},
-            {"child_table": "therapies"},
-        ]
-        for enc in encounters:
-            encounter_doc = frappe.get_doc("Patient Encounter", enc)
-
-            for row in child_map:
-                for child in encounter_doc.get(row.get("child_table")):
-                    if (
-                        child.prescribe == 0
-                        or child.is_not_available_inhouse == 1
-                        or child.invoiced == 1
-                        or child.is_cancelled == 1
-                    ):
-                        continue
-
-                    if child.doctype == "Drug Prescription":
-                        encounter_cost += (
-                            child.quantity - child.quantity_returned
-                        ) * child.amount
-                    else:
-                        encounter_cost += child.amount
-        return encounter_cost
-
-    def get_inpatient_costs(inpatient_record):
-        inpatient_cost = 0
-        inpatient_record_doc = frappe.get_doc("Inpatient Record", inpatient_record)
-        cash_limit = inpatient_record_doc.cash_limit
-        for record in inpatient_record_doc.inpatient_occupancies:
-            if not record.is_confirmed:
-                continue
-
-            inpatient_cost += record.amount
-
-        for record in inpatient_record_doc.inpatient_consultancy:
-            if not record.is_confirmed:
-                continue
-
-            inpatient_cost += record.rate
-
-        return inpatient_cost, cash_limit
-
     cash_limit_details = frappe.get_value(
         "Company",
         {"name": company, "hms_tz_has_cash_limit_alert": 1},
@@ -1978,94 +2064,62 @@ def show_last_prescribed_for_lrpt(doc, method):
             "table": "lab_test_prescription",
             "doctype": "Lab Test Template",
             "item": "lab_test_code",
-            "ref_doc": "Lab Test",
-            "field_name": "template",
         },
         {
             "table": "radiology_procedure_prescription",
             "doctype": "Radiology Examination Template",
             "item": "radiology_examination_template",
-            "ref_doc": "Radiology Examination",
-            "field_name": "radiology_examination_template",
         },
         {
             "table": "procedure_prescription",
             "doctype": "Clinical Procedure Template",
             "item": "procedure",
-            "ref_doc": "Clinical Procedure",
-            "field_name": "procedure_template",
         },
-        # {
-        # "table": "therapies",
-        # "doctype": "Therapy Type",
-        # "item": "therapy_type",
-        # "ref_doc": "Therapy Plan",
-        # "field_name": "therapy_plan_template"
-        # }
+        {
+            "table": "therapies",
+            "doctype": "Therapy Type",
+            "item": "therapy_type",
+        },
     ]
 
     if method == "validate":
         msg = ""
         valid_days_msg = ""
+        history = get_prescription_history(
+            doc.patient,
+            [
+                (child.get("doctype"), entry.get(child.get("item")))
+                for child in childs_map
+                for entry in doc.get(child.get("table"))
+            ],
+        )
         for child in childs_map:
             msg_print = ""
-            for entry in doc.get(child.get("table")):
-                conditions = {
-                    "patient": doc.patient,
-                    child.get("field_name"): entry.get(child.get("item")),
-                }
-
-                item_doc = frappe.get_all(
-                    child.get("ref_doc"),
-                    filters=conditions,
-                    fields=[child.get("field_name"), "creation"],
-                    order_by="creation DESC",
-                    limit=1,
-                )
-
-                if len(item_doc) > 0:
-                    date = item_doc[0]["creation"].strftime("%Y-%m-%d")
-
-                    msg_print += _(
-                        "{0} prescribed last on: {1}".format(
-                            frappe.bold(entry.get(child.get("item"))), frappe.bold(date)
-                        )
-                        + "<br>"
-                    )
-
-                    val_msg = validate_prescribe_days(
-                        doc, child.get("doctype"), entry.get(child.get("item")), date
-                    )
-                    if val_msg:
-                        valid_days_msg += val_msg
-
-            msg += msg_print
-
-        for plan in doc.therapies:
-            items = frappe.db.sql(
-                """ 
-                SELECT tpd.therapy_type, Date(tpd.creation) AS date FROM `tabTherapy Plan Detail` tpd
-                INNER JOIN `tabTherapy Plan` tp ON tpd.parent = tp.name WHERE tp.patient = %s 
-                AND tpd.therapy_type = %s """
-                % (frappe.db.escape(doc.patient), frappe.db.escape(plan.therapy_type)),
-                as_dict=1,
-            )
+            templates = [
+                entry.get(child.get("item")) for entry in doc.get(child.get("table"))
+            ]
+            min_days_map = get_min_prescribe_days(doc, child.get("doctype"), templates)
+            for template in templates:
+                last_prescribed = history.get((child.get("doctype"), template))
+                if not last_prescribed:
+                    continue
 
-            if items:
-                msg = _(
-                    msg
-                    + "{0} prescribed last on: {1}".format(
-                        frappe.bold(items[0]["therapy_type"]),
-                        frappe.bold(items[0]["date"]),
+                date = str(last_prescribed.last_date)
+                msg_print += _(
+                    "{0} prescribed last on: {1}".format(
+                        frappe.bold(template), frappe.bold(date)
                     )
                     + "<br>"
                 )
+
                 val_msg = validate_prescribe_days(
-                    doc, "Therapy Type", items[0]["therapy_type"], items[0]["date"]
+                    doc, child.get("doctype"), template, date, min_days_map
                 )
                 if val_msg:
                     valid_days_msg += val_msg
 
+            msg += msg_print
+
         if valid_days_msg:
             frappe.throw(
                 _(
@@ -2079,21 +2133,37 @@ def show_last_prescribed_for_lrpt(doc, method):
             )
 
 
-def validate_prescribe_days(doc, doctype, item_value, date):
-    valid_min_presribe_days = None
+def get_min_prescribe_days(doc, doctype, item_values):
+    """Return {template: minimum days between prescriptions} for the patient's
+    payment type, only templates with the validation enabled are returned.
+    """
     if doc.insurance_company:
-        valid_min_presribe_days = frappe.get_value(
-            doctype,
-            {"name": item_value, "hms_tz_validate_prescription_days_for_insurance": 1},
-            "hms_tz_insurance_min_no_of_days_for_prescription",
-        )
-
+        check_field = "hms_tz_validate_prescription_days_for_insurance"
+        days_field = "hms_tz_insurance_min_no_of_days_for_prescription"
     elif doc.mode_of_payment:
-        valid_min_presribe_days = frappe.get_value(
+        check_field = "hms_tz_validate_prescription_days_for_cash"
+        days_field = "hms_tz_cash_min_no_of_days_for_prescription"
+    else:
+        return {}
+
+    item_values = [item_value for item_value in item_values if item_value]
+    if not item_values:
+        return {}
+
+    return frappe._dict(
+        frappe.get_all(
             doctype,
-            {"name": item_value, "hms_tz_validate_prescription_days_for_cash": 1},
-            "hms_tz_cash_min_no_of_days_for_prescription",
+            filters={"name": ["in", list(set(item_values))], check_field: 1},
+            fields=["name", days_field],
+            as_list=1,
         )
+    )
+
+
+def validate_prescribe_days(doc, doctype, item_value, date, min_days_map=None):
+    if min_days_map is None:
+        min_days_map = get_min_prescribe_days(doc, doctype, [item_value])
+    valid_min_presribe_days = min_days_map.get(item_value)
 
     if valid_min_presribe_days and (
         date_diff(nowdate(), date) < cint(valid_min_presribe_days)
@@ -12,10 +12,17 @@ from hms_tz.nhif.api.healthcare_utils import (
     create_individual_procedure_prescription,
     create_therapy_plan
 )
-from hms_tz.nhif.api.sales_order import validate_stock_item
+from hms_tz.nhif.api.sales_order import validate_stock_item, get_items_stock_map
+from hms_tz.nhif.doctype.healthcare_invoice_outbox.healthcare_invoice_outbox import (
+    add_outbox_entries,
+    outbox_doctypes,
+)
 
 
 def validate(doc, method):
+    stock_map = None
+    if doc.enabled_auto_create_delivery_notes:
+        stock_map = get_items_stock_map(doc.items)
     for item in doc.items:
         if not item.is_free_item and item.amount == 0:
             frappe.throw(
@@ -28,7 +35,7 @@ def validate(doc, method):
         if doc.enabled_auto_create_delivery_notes == 0:
             continue
 
-        validate_stock_item(item, item.warehouse, method)
+        validate_stock_item(item, item.warehouse, method, stock_map)
 
     update_dimensions(doc)
     validate_create_delivery_note(doc)
@@ -74,9 +81,10 @@ def before_submit(doc, method):
     
     # do not validate stock for cash inpatient sales invoice
     if doc.enabled_auto_create_delivery_notes == 1:
+        stock_map = get_items_stock_map(doc.items)
         for row in doc.items:
-            if frappe.get_value("Item", row.item_code, "is_stock_item") == 1:
-                validate_stock_item(row, row.warehouse, method)
+            if frappe.get_cached_value("Item", row.item_code, "is_stock_item") == 1:
+                validate_stock_item(row, row.warehouse, method, stock_map)
 
     if doc.is_return == 1:
         reset_invoiced_status(doc)
@@ -87,10 +95,71 @@ def on_submit(doc, method):
         reset_invoiced_status(doc)
         return
 
-    create_healthcare_docs(doc, method)
+    queue_healthcare_docs(doc)
     update_drug_prescription(doc)
 
 
+def queue_healthcare_docs(doc):
+    """Mark billed prescriptions and inpatient items as invoiced and queue the
+    LRPMT documents of the invoice, they are created by a background job right
+    after commit.
+    """
+    references = {}
+    for item in doc.items:
+        if item.reference_dt in outbox_doctypes and item.reference_dn:
+            references.setdefault(item.reference_dt, []).append(item.reference_dn)
+
+        elif item.reference_dt in ["Inpatient Occupancy", "Inpatient Consultancy"]:
+            set_inpatient_item_invoiced(doc, item)
+
+    cancelled = set()
+    for reference_dt, reference_names in references.items():
+        cancelled.update(
+            frappe.get_all(
+                reference_dt,
+                filters={"name": ["in", reference_names], "is_cancelled": 1},
+                pluck="name",
+            )
+        )
+
+    for item in doc.items:
+        if item.reference_dn in cancelled:
+            frappe.throw(
+                f"Item: {frappe.bold(item.item_code)} RowNo#: {frappe.bold(item.idx)} is already cancelled,\
+                Please confirm cancellation of this item on Patient Encounter and remove this item from sales invoice"
+            )
+
+    # billed rows must leave the uninvoiced list in this transaction
+    for reference_dt, reference_names in references.items():
+        frappe.db.sql(
+            """
+            UPDATE `tab{0}`
+            SET `invoiced` = 1, `sales_invoice_number` = %(sales_invoice)s
+            WHERE `name` IN %(names)s
+            """.format(
+                reference_dt
+            ),
+            {"sales_invoice": doc.name, "names": tuple(reference_names)},
+        )
+
+    add_outbox_entries(doc)
+
+
+def set_inpatient_item_invoiced(doc, item):
+    invoiced_field = "invoiced"
+    if frappe.get_meta(item.reference_dt).get_field("hms_tz_invoiced"):
+        invoiced_field = "hms_tz_invoiced"
+
+    frappe.db.set_value(
+        item.reference_dt,
+        item.reference_dn,
+        {
+            invoiced_field: 1,
+            "sales_invoice_number": doc.name,
+        },
+    )
+
+
 def create_healthcare_docs(doc, method):
     if doc.docstatus != 1 or method not in ["on_submit", "From Front End"]:
         frappe.msgprint(
@@ -144,18 +213,7 @@ def create_healthcare_docs(doc, method):
                 "Inpatient Occupancy",
                 "Inpatient Consultancy",
             ]:
-                invoiced_field = "invoiced"
-                if frappe.get_meta(item.reference_dt).get_field("hms_tz_invoiced"):
-                    invoiced_field = "hms_tz_invoiced"
-
-                frappe.db.set_value(
-                    item.reference_dt,
-                    item.reference_dn,
-                    {
-                        invoiced_field: 1,
-                        "sales_invoice_number": doc.name,
-                    },
-                )
+                set_inpatient_item_invoiced(doc, item)
 
         create_therapy_plan(invoice_therapy_dict=therapy_items)
 
@@ -1,14 +1,17 @@
 import frappe
 from frappe import _
 from frappe.utils import nowdate
-from frappe.query_builder import DocType
-from frappe.query_builder.functions import CombineDatetime
-from hms_tz.nhif.api.healthcare_utils import msgThrow
+from hms_tz.nhif.api.healthcare_utils import (
+    msgThrow,
+    get_stock_availability,
+    get_stock_availabilities,
+)
 
 
 def validate(doc, method):
+    stock_map = get_items_stock_map(doc.items, doc.set_warehouse)
     for item in doc.items:
-        validate_stock_item(item, doc.set_warehouse, method)
+        validate_stock_item(item, doc.set_warehouse, method, stock_map)
 
 
 def before_submit(doc, method):
@@ -18,8 +21,9 @@ def before_submit(doc, method):
                 Please inform the doctor: <b>{doc.healthcare_practitioner}</b> to approve the request."
         )
 
+    stock_map = get_items_stock_map(doc.items, doc.set_warehouse)
     for item in doc.items:
-        validate_stock_item(item, doc.set_warehouse, method)
+        validate_stock_item(item, doc.set_warehouse, method, stock_map)
 
 
 def create_sales_order(doc, method):
@@ -213,9 +217,19 @@ def get_childs_map():
     ]
 
 
-def validate_stock_item(item, warehouse, method):
+def get_items_stock_map(items, warehouse=None):
+    """Return {(item_code, warehouse): actual_qty} for the items, read at once"""
+    return get_stock_availabilities(
+        (item.item_code, warehouse or item.get("warehouse")) for item in items
+    )
+
+
+def validate_stock_item(item, warehouse, method, stock_map=None):
     if frappe.get_cached_value("Item", item.item_code, "is_stock_item") == 1:
-        stock_qty = get_stock_availability(item.item_code, warehouse)
+        if stock_map and (item.item_code, warehouse) in stock_map:
+            stock_qty = stock_map[(item.item_code, warehouse)]
+        else:
+            stock_qty = get_stock_availability(item.item_code, warehouse)
         if float(item.qty) > float(stock_qty):
             msgThrow(
                 (
@@ -232,29 +246,3 @@ def validate_stock_item(item, warehouse, method):
             ),
             method,
         )
-
-
-def get_stock_availability(item_code, warehouse):
-    sle = DocType("Stock Ledger Entry")
-    latest_sle = (
-        frappe.qb.from_(sle)
-        .select(
-            sle.qty_after_transaction.as_("actual_qty"),
-            sle.posting_date,
-            sle.posting_time,
-            sle.name,
-        )
-        .where(
-            (sle.item_code == item_code)
-            & (sle.warehouse == warehouse)
-            & (sle.is_cancelled == 0)
-            & (sle.docstatus < 2)
-        )
-        .orderby(
-            CombineDatetime(sle.posting_date, sle.posting_time), order=frappe.qb.desc
-        )
-        .limit(1)
-    ).run(as_dict=True)
-
-    sle_qty = latest_sle[0].actual_qty or 0 if latest_sle else 0
-    return sle_qty
@@ -8,121 +8,188 @@ from frappe.utils import get_url_to_form, get_url
 from frappe import _
 from frappe.utils.password import get_decrypted_password
 import json
-import requests
-from time import sleep
-from frappe.utils import now, add_to_date, now_datetime, cstr
+from frappe.utils import (
+    now,
+    add_to_date,
+    now_datetime,
+    cstr,
+    time_diff_in_seconds,
+)
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
-
-
-def make_token_request(doc, url, headers, payload, fields):
-    for i in range(3):
-        try:
-            r = requests.request("POST", url, headers=headers, data=payload, timeout=5)
-            r.raise_for_status()
-            frappe.logger().debug({"webhook_success": r.text})
-            if json.loads(r.text):
-                add_log(
-                    request_type="Token",
-                    request_url=url,
-                    request_header=headers,
-                    request_body=payload,
-                    response_data=json.loads(r.text),
-                    status_code=r.status_code,
-                )
-
-            if json.loads(r.text)["token_type"] == "bearer":
-                token = json.loads(r.text)["access_token"]
-                expired = json.loads(r.text)["expires_in"]
-                expiry_date = add_to_date(now(), seconds=(expired - 1000))
-                doc.update({fields["token"]: token, fields["expiry"]: expiry_date})
-
-                doc.db_update()
-                frappe.db.commit()
-                return token
-            else:
-                add_log(
-                    request_type="Token",
-                    request_url=url,
-                    request_header=headers,
-                    request_body=payload,
-                    status_code=r.status_code,
-                )
-                frappe.throw(json.loads(r.text))
-
-        except Exception as e:
-            frappe.logger().debug({"webhook_error": e, "try": i + 1})
-            sleep(3 * i + 1)
-            if i != 2:
-                continue
-            else:
-                raise e
+from hms_tz.nhif.api.nhif_client import nhif_request
+
+
+# service => (url field, token path, token field, expiry field)
+token_services = {
+    "nhifservice": (
+        "nhifservice_url",
+        "/nhifservice/Token",
+        "nhifservice_token",
+        "nhifservice_expiry",
+    ),
+    "claimsserver": (
+        "claimsserver_url",
+        "/claimsserver/Token",
+        "claimsserver_token",
+        "claimsserver_expiry",
+    ),
+    "nhifform": (
+        "nhifform_url",
+        "/formposting/Token",
+        "nhifform_token",
+        "nhifform_expiry",
+    ),
+}
+
+# tokens expiring within this many seconds are renewed by the scheduler
+token_refresh_margin = 900
+# how long a process may hold the refresh lock, and how long others wait for it
+token_lock_timeout = 60
+
+
+def make_token_request(url, headers, payload):
+    r = nhif_request("POST", url, "Token", headers=headers, data=payload)
+    r.raise_for_status()
+    frappe.logger().debug({"webhook_success": r.text})
+    data = json.loads(r.text)
+    if data:
+        add_log(
+            request_type="Token",
+            request_url=url,
+            request_header=headers,
+            request_body=payload,
+            response_data=data,
+            status_code=r.status_code,
+        )
+
+    if data["token_type"] == "bearer":
+        token = data["access_token"]
+        expired = data["expires_in"]
+        expiry_date = add_to_date(now(), seconds=(expired - 1000))
+        return token, expiry_date
+    else:
+        add_log(
+            request_type="Token",
+            request_url=url,
+            request_header=headers,
+            request_body=payload,
+            status_code=r.status_code,
+        )
+        frappe.throw(data)
+
+
+def get_token_cache_key(company, service):
+    return "nhif_token:{0}:{1}".format(company, service)
+
+
+def get_cached_token(company, service, min_ttl=0):
+    cached = frappe.cache().get_value(get_token_cache_key(company, service))
+    if cached and time_diff_in_seconds(cached.get("expiry"), now_datetime()) > min_ttl:
+        return cached
+
+
+def set_cached_token(company, service, token, expiry):
+    expires_in_sec = int(time_diff_in_seconds(expiry, now_datetime()))
+    if expires_in_sec <= 0:
+        return
+    frappe.cache().set_value(
+        get_token_cache_key(company, service),
+        {"token": token, "expiry": cstr(expiry)},
+        expires_in_sec=expires_in_sec,
+    )
+
+
+def get_token(company, service, min_ttl=0):
+    """Return a token for the company and NHIF service valid for at least `min_ttl` seconds.
+
+    Tokens are shared by all workers through redis. When a token has to be
+    renewed only one process calls NHIF, the others wait on the lock and pick
+    up the token it stored.
+    """
+    cached = get_cached_token(company, service, min_ttl)
+    if cached:
+        return cached.get("token")
+
+    url_field, token_path, token_field, expiry_field = token_services[service]
+    cache = frappe.cache()
+    lock = cache.lock(
+        cache.make_key("nhif_token_lock:{0}:{1}".format(company, service)),
+        timeout=token_lock_timeout,
+        blocking_timeout=token_lock_timeout,
+    )
+    with lock:
+        cached = get_cached_token(company, service, min_ttl)
+        if cached:
+            return cached.get("token")
+
+        # the token persisted on the settings survives a redis flush
+        setting_doc = frappe.get_doc("Company NHIF Settings", company)
+        expiry = setting_doc.get(expiry_field)
+        if expiry and time_diff_in_seconds(expiry, now_datetime()) > min_ttl:
+            set_cached_token(company, service, setting_doc.get(token_field), expiry)
+            return setting_doc.get(token_field)
+
+        username = setting_doc.username
+        password = get_decrypted_password("Company NHIF Settings", company, "password")
+        payload = "grant_type=password&username={0}&password={1}".format(
+            username, password
+        )
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        url = cstr(setting_doc.get(url_field)) + token_path
+
+        token, expiry = make_token_request(url, headers, payload)
+        set_cached_token(company, service, token, expiry)
+
+    frappe.enqueue(
+        method=persist_token,
+        queue="short",
+        company=company,
+        token_field=token_field,
+        expiry_field=expiry_field,
+        token=token,
+        expiry=expiry,
+    )
+    return token
+
+
+def persist_token(company, token_field, expiry_field, token, expiry):
+    frappe.db.set_value(
+        "Company NHIF Settings",
+        company,
+        {token_field: token, expiry_field: expiry},
+        update_modified=False,
+    )
+    frappe.db.commit()
 
 
 def get_nhifservice_token(company):
-    setting_doc = frappe.get_cached_doc("Company NHIF Settings", company)
-    if (
-        setting_doc.nhifservice_expiry
-        and setting_doc.nhifservice_expiry > now_datetime()
-    ):
-        return setting_doc.nhifservice_token
-
-    username = setting_doc.username
-    password = get_decrypted_password("Company NHIF Settings", company, "password")
-    payload = "grant_type=password&username={0}&password={1}".format(username, password)
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    url = str(setting_doc.nhifservice_url) + "/nhifservice/Token"
-
-    nhifservice_fields = {
-        "token": "nhifservice_token",
-        "expiry": "nhifservice_expiry",
-    }
-
-    return make_token_request(setting_doc, url, headers, payload, nhifservice_fields)
+    return get_token(company, "nhifservice")
 
 
 def get_claimsservice_token(company):
-    setting_doc = frappe.get_cached_doc("Company NHIF Settings", company)
-    if (
-        setting_doc.claimsserver_expiry
-        and setting_doc.claimsserver_expiry > now_datetime()
-    ):
-        return setting_doc.claimsserver_token
-
-    username = setting_doc.username
-    password = get_decrypted_password("Company NHIF Settings", company, "password")
-    payload = "grant_type=password&username={0}&password={1}".format(username, password)
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    url = str(setting_doc.claimsserver_url) + "/claimsserver/Token"
-
-    claimserver_fields = {
-        "token": "claimsserver_token",
-        "expiry": "claimsserver_expiry",
-    }
-
-    return make_token_request(setting_doc, url, headers, payload, claimserver_fields)
+    return get_token(company, "claimsserver")
 
 
 def get_formservice_token(company):
-    company_nhif_doc = frappe.get_cached_doc("Company NHIF Settings", company)
-    if not company_nhif_doc.enable:
+    if not frappe.get_cached_value("Company NHIF Settings", company, "enable"):
         frappe.throw(_("Company {0} not enabled for NHIF Integration".format(company)))
 
-    if (
-        company_nhif_doc.nhifform_expiry
-        and company_nhif_doc.nhifform_expiry > now_datetime()
-    ):
-        return company_nhif_doc.nhifform_token
-
-    username = company_nhif_doc.username
-    password = get_decrypted_password("Company NHIF Settings", company, "password")
-    payload = "grant_type=password&username={0}&password={1}".format(username, password)
-
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    url = cstr(company_nhif_doc.nhifform_url) + "/formposting/Token"
+    return get_token(company, "nhifform")
 
-    nhifform_fields = {
-        "token": "nhifform_token",
-        "expiry": "nhifform_expiry",
-    }
 
-    return make_token_request(company_nhif_doc, url, headers, payload, nhifform_fields)
+def refresh_nhif_tokens():
+    """Renew tokens that are about to expire so requests never wait on NHIF for one"""
+    for company in frappe.get_all(
+        "Company NHIF Settings", filters={"enable": 1}, pluck="name"
+    ):
+        setting_doc = frappe.get_cached_doc("Company NHIF Settings", company)
+        for service, fields in token_services.items():
+            if not setting_doc.get(fields[0]):
+                continue
+            try:
+                get_token(company, service, min_ttl=token_refresh_margin)
+            except Exception:
+                frappe.log_error(
+                    frappe.get_traceback(),
+                    str("Failed to refresh NHIF {0} token for {1}".format(service, company)),
+                )
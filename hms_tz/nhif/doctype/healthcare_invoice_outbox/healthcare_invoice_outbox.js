@@ -0,0 +1,18 @@
+// Copyright (c) 2026, Aakvatech and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Healthcare Invoice Outbox', {
+	refresh: function (frm) {
+		if (frm.doc.status == "Failed") {
+			frm.add_custom_button(__("Retry"), function () {
+				frappe.call({
+					method: "hms_tz.nhif.doctype.healthcare_invoice_outbox.healthcare_invoice_outbox.retry_outbox_entries",
+					args: { names: [frm.doc.name] },
+					callback: function () {
+						frm.reload_doc();
+					}
+				});
+			});
+		}
+	}
+});
@@ -0,0 +1,321 @@
+# Copyright (c) 2026, Aakvatech and contributors
+# For license information, please see license.txt
+
+import json
+import time
+import frappe
+from itertools import groupby
+from redis.exceptions import LockNotOwnedError
+from frappe.utils import now, nowdate, now_datetime, add_days, add_to_date
+from frappe.model.document import Document
+from hms_tz.nhif.api.healthcare_utils import (
+    create_individual_lab_test,
+    create_individual_radiology_examination,
+    create_individual_procedure_prescription,
+    create_therapy_plan,
+)
+
+
+lrp_doctypes = [
+    "Lab Prescription",
+    "Radiology Procedure Prescription",
+    "Procedure Prescription",
+]
+outbox_doctypes = lrp_doctypes + ["Therapy Plan Detail"]
+
+outbox_batch_size = 100
+max_attempts = 8
+# seconds before the first retry, doubled after every failed attempt
+retry_delay = 30
+max_retry_delay = 3600
+lock_timeout = 600
+# a run stops in time to release its lock, the next job continues the queue
+max_run_seconds = 480
+# days of submitted invoices the hourly sweep looks back
+sweep_days = 2
+
+
+class HealthcareInvoiceOutbox(Document):
+    pass
+
+
+def add_outbox_entries(doc):
+    """Queue the Lab Tests, Radiology Examinations, Clinical Procedures and Therapy
+    Plans of a submitted Sales Invoice, they are created right after commit.
+    """
+    items = [
+        frappe._dict(
+            sales_invoice=doc.name,
+            sales_invoice_item=item.name,
+            reference_dt=item.reference_dt,
+            reference_dn=item.reference_dn,
+        )
+        for item in doc.items
+        if item.reference_dt in outbox_doctypes
+        and item.reference_dn
+        and not item.hms_tz_is_lrp_item_created
+    ]
+    insert_outbox_entries(items)
+
+
+def insert_outbox_entries(items):
+    if not items:
+        return
+
+    time_stamp = now()
+    user = frappe.session.user
+    values = [
+        (
+            frappe.generate_hash(length=10),
+            item.sales_invoice,
+            item.sales_invoice_item,
+            item.reference_dt,
+            item.reference_dn,
+            "Pending",
+            0,
+            time_stamp,
+            time_stamp,
+            time_stamp,
+            user,
+            user,
+        )
+        for item in items
+    ]
+    frappe.db.sql(
+        """
+        INSERT INTO `tabHealthcare Invoice Outbox`
+        (
+            `name`, `sales_invoice`, `sales_invoice_item`, `reference_dt`,
+            `reference_dn`, `status`, `attempts`, `next_attempt_on`,
+            `creation`, `modified`, `modified_by`, `owner`
+        )
+        VALUES {}
+        """.format(
+            ", ".join(["%s"] * len(values))
+        ),
+        tuple(values),
+    )
+    frappe.enqueue(
+        method=process_outbox,
+        queue="short",
+        enqueue_after_commit=True,
+    )
+
+
+def get_due_entries(limit):
+    return frappe.get_all(
+        "Healthcare Invoice Outbox",
+        filters={"status": "Pending", "next_attempt_on": ["<=", now()]},
+        fields=[
+            "name",
+            "sales_invoice",
+            "sales_invoice_item",
+            "reference_dt",
+            "reference_dn",
+            "attempts",
+        ],
+        order_by="sales_invoice asc, creation asc",
+        limit=limit,
+    )
+
+
+def process_outbox():
+    """Create the healthcare documents of queued invoice items, runs after every
+    invoice submit and every minute for retries.
+    """
+    cache = frappe.cache()
+    lock = cache.lock(cache.make_key("healthcare_invoice_outbox"), timeout=lock_timeout)
+    if not lock.acquire(blocking=False):
+        return
+
+    deadline = time.monotonic() + max_run_seconds
+    try:
+        while True:
+            if time.monotonic() > deadline:
+                frappe.enqueue(method=process_outbox, queue="short")
+                break
+
+            entries = get_due_entries(outbox_batch_size)
+            if not entries:
+                break
+
+            submitted = set(
+                frappe.get_all(
+                    "Sales Invoice",
+                    filters={
+                        "name": ["in", list({entry.sales_invoice for entry in entries})],
+                        "docstatus": 1,
+                    },
+                    pluck="name",
+                )
+            )
+            for sales_invoice, rows in groupby(entries, key=lambda e: e.sales_invoice):
+                rows = list(rows)
+                # the invoice was cancelled before its documents were created
+                if sales_invoice not in submitted:
+                    set_entries_status(rows, "Cancelled")
+                    frappe.db.commit()
+                    continue
+
+                for entry in rows:
+                    if entry.reference_dt in lrp_doctypes:
+                        run_handler([entry], create_lrp_docs)
+
+                # therapies of an invoice go on one plan per encounter
+                therapies = [
+                    entry
+                    for entry in rows
+                    if entry.reference_dt == "Therapy Plan Detail"
+                ]
+                if therapies:
+                    run_handler(therapies, create_therapy_docs)
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            pass
+
+
+def run_handler(entries, handler):
+    try:
+        handler(entries)
+        set_entries_status(entries, "Done")
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        set_entries_failed(entries, frappe.get_traceback())
+        frappe.db.commit()
+
+
+def create_lrp_docs(entries):
+    for entry in entries:
+        child = frappe.get_doc(entry.reference_dt, entry.reference_dn)
+        patient_encounter_doc = frappe.get_doc("Patient Encounter", child.parent)
+        if child.doctype == "Lab Prescription":
+            create_individual_lab_test(patient_encounter_doc, child)
+        elif child.doctype == "Radiology Procedure Prescription":
+            create_individual_radiology_examination(patient_encounter_doc, child)
+        elif child.doctype == "Procedure Prescription":
+            create_individual_procedure_prescription(patient_encounter_doc, child)
+
+        child.invoiced = 1
+        child.sales_invoice_number = entry.sales_invoice
+        child.save(ignore_permissions=True)
+
+        frappe.db.set_value(
+            "Sales Invoice Item",
+            entry.sales_invoice_item,
+            "hms_tz_is_lrp_item_created",
+            1,
+            update_modified=False,
+        )
+
+
+def create_therapy_docs(entries):
+    items = [
+        frappe.get_doc("Sales Invoice Item", entry.sales_invoice_item)
+        for entry in entries
+    ]
+    create_therapy_plan(invoice_therapy_dict=items)
+
+
+def set_entries_status(entries, status, error=None):
+    frappe.db.sql(
+        """
+        UPDATE `tabHealthcare Invoice Outbox`
+        SET `status` = %(status)s, `error` = %(error)s, `modified` = %(modified)s
+        WHERE `name` IN %(names)s
+        """,
+        {
+            "status": status,
+            "error": error,
+            "modified": now(),
+            "names": tuple(entry.name for entry in entries),
+        },
+    )
+
+
+def set_entries_failed(entries, error):
+    """Schedule a retry with exponential backoff, or move the entries to Failed
+    once they used up their attempts.
+    """
+    attempts = max(entry.attempts for entry in entries) + 1
+    if attempts >= max_attempts:
+        set_entries_status(entries, "Failed", error)
+        frappe.log_error(
+            error,
+            str(
+                "Healthcare documents of Sales Invoice {0} failed".format(
+                    entries[0].sales_invoice
+                )
+            ),
+        )
+        return
+
+    delay = min(retry_delay * (2 ** (attempts - 1)), max_retry_delay)
+    frappe.db.sql(
+        """
+        UPDATE `tabHealthcare Invoice Outbox`
+        SET `attempts` = %(attempts)s, `next_attempt_on` = %(next_attempt_on)s,
+            `error` = %(error)s, `modified` = %(modified)s
+        WHERE `name` IN %(names)s
+        """,
+        {
+            "attempts": attempts,
+            "next_attempt_on": add_to_date(now_datetime(), seconds=delay),
+            "error": error,
+            "modified": now(),
+            "names": tuple(entry.name for entry in entries),
+        },
+    )
+
+
+def requeue_uncreated_items():
+    """Queue items of recently submitted invoices that have no outbox entry and no
+    created documents, runs every hour as a safety net
+    """
+    items = frappe.db.sql(
+        """
+        SELECT sii.parent AS sales_invoice, sii.name AS sales_invoice_item,
+            sii.reference_dt, sii.reference_dn
+        FROM `tabSales Invoice Item` sii
+        INNER JOIN `tabSales Invoice` si ON si.name = sii.parent
+        WHERE si.docstatus = 1
+            AND si.is_return = 0
+            AND IFNULL(si.patient, '') != ''
+            AND si.posting_date >= %(from_date)s
+            AND sii.hms_tz_is_lrp_item_created = 0
+            AND sii.reference_dt IN %(doctypes)s
+            AND IFNULL(sii.reference_dn, '') != ''
+            AND NOT EXISTS (
+                SELECT 1 FROM `tabHealthcare Invoice Outbox` hio
+                WHERE hio.sales_invoice_item = sii.name
+            )
+        ORDER BY si.name
+        """,
+        {
+            "from_date": add_days(nowdate(), -sweep_days),
+            "doctypes": tuple(outbox_doctypes),
+        },
+        as_dict=1,
+    )
+    insert_outbox_entries(items)
+
+
+@frappe.whitelist()
+def retry_outbox_entries(names):
+    """Put failed entries back in the queue"""
+    frappe.only_for("System Manager")
+    if isinstance(names, str):
+        names = json.loads(names)
+
+    frappe.db.sql(
+        """
+        UPDATE `tabHealthcare Invoice Outbox`
+        SET `status` = 'Pending', `attempts` = 0, `next_attempt_on` = %(now)s,
+            `modified` = %(now)s
+        WHERE `name` IN %(names)s AND `status` = 'Failed'
+        """,
+        {"now": now(), "names": tuple(names)},
+    )
+    frappe.enqueue(method=process_outbox, queue="short", enqueue_after_commit=True)
@@ -0,0 +1,8 @@
+# Copyright (c) 2026, Aakvatech and Contributors
+# See license.txt
+
+# import frappe
+import unittest
+
+class TestHealthcareInvoiceOutbox(unittest.TestCase):
+	pass
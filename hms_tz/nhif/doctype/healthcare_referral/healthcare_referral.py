@@ -3,10 +3,10 @@
 
 import json
 import frappe
-import requests
 from frappe.utils import now_datetime
 from frappe.model.document import Document
 from hms_tz.nhif.api.token import get_nhifservice_token
+from hms_tz.nhif.api.nhif_client import nhif_request
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
 
 
@@ -79,7 +79,7 @@ def validate_required_fields(doc):
 
 
 def make_referral_request(doc, url, headers, payload):
-    r = requests.request("POST", url, headers=headers, data=payload, timeout=30)
+    r = nhif_request("POST", url, "GetReferralNo", headers=headers, data=payload)
     data = json.loads(r.text)
 
     if r.status_code != 200:
@@ -3,110 +3,313 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
+import time
 import frappe
+from redis.exceptions import LockNotOwnedError
+from frappe.utils import now_datetime, add_to_date
 from frappe.model.document import Document
+from hms_tz.nhif.api.hl7 import (
+    parse_hl7,
+    get_message_header,
+    get_profile_results,
+    get_numeric_results,
+)
+
+
+message_queue_key = "lab_machine_message_queue"
+# names taken from the queue stay here until their batch is applied
+message_processing_key = "lab_machine_message_processing"
+# messages applied together, results of one Lab Test are saved once per batch
+message_batch_size = 200
+profile_cache_key = "lab_machine_profiles"
+lock_timeout = 600
+# a run stops in time to release its lock, the next job continues the queue
+max_run_seconds = 480
+# unprocessed messages in this window are queued again when the queue is empty
+sweep_minutes = (2, 24 * 60)
+
+
+def on_doctype_update():
+    frappe.db.add_index("Lab Machine Message", ["processed", "creation"])
 
 
 class LabMachineMessage(Document):
     def validate(self):
         self.set_missing_fields()
-        self.update_lab_test()
 
-    def after_insert(self):
-        self.update_lab_test()
+    def on_update(self):
+        queue_message(self.name)
 
     def set_missing_fields(self):
         if not self.message:
             return
-        msg_lines = self.message.splitlines()
-        self.machine_make = msg_lines[0].split("|")[2]
-        self.machine_model = msg_lines[0].split("|")[3]
-        self.lab_test_name = msg_lines[3].split("|")[3]
-        self.sample_collection = self.get_sample_collection(msg_lines)
-
-    def get_sample_collection(self, msg_lines):
-        sample_collection = ""
-        for line in msg_lines:
-            if line.startswith("OBR"):
-                fields = line.split("|")
-                if fields[2]:
-                    sample_collection = fields[2]
-                elif fields[3]:
-                    sample_collection = fields[3]
+        header = get_message_header(parse_hl7(self.message))
+        self.machine_make = header.machine_make
+        self.machine_model = header.machine_model
+        self.lab_test_name = header.lab_test_name
+        self.sample_collection = None
+        if header.sample_collection and frappe.db.exists(
+            "Sample Collection", header.sample_collection
+        ):
+            self.sample_collection = header.sample_collection
+
+
+def receive_message(message, machine_id=None):
+    """Store an HL7 message received from an analyzer, its results are applied
+    to the Lab Tests in the background
+    """
+    doc = frappe.new_doc("Lab Machine Message")
+    doc.date_and_time = now_datetime()
+    doc.machine_id = machine_id
+    doc.message = message
+    doc.insert(ignore_permissions=True)
+    return doc.name
+
+
+def queue_message(name):
+    def push():
+        cache = frappe.cache()
+        cache.rpush(message_queue_key, name)
+        # a running job picks up messages pushed while it works
+        if cache.llen(message_queue_key) == 1:
+            frappe.enqueue(method=process_lab_machine_messages, queue="short")
+
+    frappe.db.after_commit.add(push)
+
+
+def take_messages(count):
+    """Move up to `count` names from the queue to the processing list, names left
+    there by a run that was killed come first
+    """
+    cache = frappe.cache()
+    queue_key = cache.make_key(message_queue_key)
+    processing_key = cache.make_key(message_processing_key)
+
+    names = cache.lrange(message_processing_key, 0, -1)
+    if not names:
+        pipe = cache.pipeline()
+        for i in range(count):
+            pipe.rpoplpush(queue_key, processing_key)
+        names = [name for name in pipe.execute() if name]
+    return [frappe.safe_decode(name) for name in names]
+
+
+def requeue_unprocessed_messages():
+    """Queue messages that were stored but never applied, e.g. when the push after
+    commit failed, returns how many were found
+    """
+    cache = frappe.cache()
+    if cache.llen(message_queue_key) or cache.llen(message_processing_key):
+        return 0
+
+    now = now_datetime()
+    names = frappe.get_all(
+        "Lab Machine Message",
+        filters={
+            "processed": 0,
+            "creation": [
+                "between",
+                [
+                    add_to_date(now, minutes=-sweep_minutes[1]),
+                    add_to_date(now, minutes=-sweep_minutes[0]),
+                ],
+            ],
+        },
+        order_by="creation asc",
+        limit=message_batch_size * 5,
+        pluck="name",
+    )
+    if names:
+        pipe = cache.pipeline()
+        pipe.rpush(cache.make_key(message_queue_key), *names)
+        pipe.execute()
+    return len(names)
+
+
+def process_lab_machine_messages():
+    """Apply queued Lab Machine Messages to their Lab Tests, runs after new
+    messages and every minute
+    """
+    cache = frappe.cache()
+    lock = cache.lock(
+        cache.make_key("lab_machine_message_process"), timeout=lock_timeout
+    )
+    if not lock.acquire(blocking=False):
+        return
+
+    deadline = time.monotonic() + max_run_seconds
+    try:
+        while True:
+            if time.monotonic() > deadline:
+                frappe.enqueue(method=process_lab_machine_messages, queue="short")
+                break
+
+            names = take_messages(message_batch_size)
+            if not names and not requeue_unprocessed_messages():
                 break
+            if names:
+                apply_message_batch(names)
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            pass
+
+
+def apply_message_batch(names):
+    try:
+        apply_messages(names)
+    except Exception:
+        frappe.db.rollback()
+        # find the messages that fail on their own, the others are applied
+        for name in names:
+            try:
+                apply_messages([name])
+            except Exception:
+                frappe.db.rollback()
+                frappe.log_error(
+                    frappe.get_traceback(),
+                    "Lab Machine Message {0} not applied".format(name),
+                )
 
-        if sample_collection:
-            sample_collection_exists = frappe.db.exists(
-                "Sample Collection", sample_collection
+    frappe.db.sql(
+        """
+        UPDATE `tabLab Machine Message` SET `processed` = 1
+        WHERE `name` IN %(names)s
+        """,
+        {"names": tuple(names)},
+    )
+    frappe.db.commit()
+    frappe.cache().delete_value(message_processing_key)
+
+
+def apply_messages(names):
+    """Collect the results of the messages per Lab Test, later messages winning,
+    and save every draft Lab Test once
+    """
+    messages = frappe.get_all(
+        "Lab Machine Message",
+        filters={"name": ["in", names]},
+        fields=[
+            "name",
+            "message",
+            "machine_make",
+            "machine_model",
+            "lab_test_name",
+            "sample_collection",
+        ],
+        order_by="creation asc",
+    )
+    sample_lab_tests = get_sample_collection_lab_tests(
+        {message.sample_collection for message in messages if message.sample_collection}
+    )
+
+    results_by_lab_test = {}
+    message_lab_tests = {}
+    for message in messages:
+        if not message.message:
+            continue
+        parsed = parse_hl7(message.message)
+
+        profile = get_machine_profile(message.machine_make, message.machine_model)
+        if profile and message.lab_test_name:
+            lab_test = (profile.lab_test_prefix or "") + message.lab_test_name
+            results_by_lab_test.setdefault(lab_test, {}).update(
+                get_profile_results(parsed, profile.obx_nm_start, profile.obx_nm_end)
             )
-            if sample_collection_exists:
-                return sample_collection
+            message_lab_tests[message.name] = lab_test
 
-    def update_lab_test(self):
-        if not self.message:
-            return
-        if self.machine_model and self.machine_make and self.lab_test_name:
-            profile_name = self.machine_model + "-" + self.machine_make
-            profile_exists = frappe.db.exists("Lab Machine Profile", profile_name)
-            if profile_exists:
-                profile = frappe.get_doc("Lab Machine Profile", profile_name)
-
-                lab_test_name = profile.lab_test_prefix + self.lab_test_name
-                lab_test_exists = frappe.db.exists("Lab Test", lab_test_name)
-                if not lab_test_exists:
-                    return
-
-                lab_test = frappe.get_doc("Lab Test", lab_test_name)
-                if lab_test.docstatus != 0:
-                    return
-
-                msg_lines = self.message.splitlines()
-                for line in msg_lines[profile.obx_nm_start : profile.obx_nm_end]:
-                    if "^" in line:
-                        test_name = line.split("|")[3].split("^")[1].replace("*", "")
-                    else:
-                        test_name = line.split("|")[3].replace("*", "")
-                    test_result = line.split("|")[5]
-                    lab_test_row = ""
-                    for row in lab_test.normal_test_items:
-                        if row.lab_test_name == test_name:
-                            lab_test_row = row
-                            break
-                    if lab_test_row:
-                        lab_test_row.result_value = test_result
-
-                self.lab_test = lab_test_name
-                lab_test.save(ignore_permissions=True)
-                frappe.db.commit()
-
-        if self.sample_collection:
-            sample_collection_doc = frappe.get_cached_doc(
-                "Sample Collection", self.sample_collection
+        if message.sample_collection:
+            results = get_numeric_results(parsed)
+            for lab_test in sample_lab_tests.get(message.sample_collection, []):
+                results_by_lab_test.setdefault(lab_test, {}).update(results)
+
+    if not results_by_lab_test:
+        return
+
+    draft_lab_tests = set(
+        frappe.get_all(
+            "Lab Test",
+            filters={"name": ["in", list(results_by_lab_test)], "docstatus": 0},
+            pluck="name",
+        )
+    )
+    for lab_test, results in results_by_lab_test.items():
+        if lab_test in draft_lab_tests:
+            update_lab_test(lab_test, results)
+
+    for message_name, lab_test in message_lab_tests.items():
+        if lab_test in draft_lab_tests:
+            frappe.db.set_value(
+                "Lab Machine Message",
+                message_name,
+                "lab_test",
+                lab_test,
+                update_modified=False,
+            )
+    frappe.db.commit()
+
+
+def update_lab_test(lab_test, results):
+    try:
+        doc = frappe.get_doc("Lab Test", lab_test)
+        rows = {}
+        for row in doc.normal_test_items:
+            rows.setdefault(row.lab_test_name, row)
+
+        changed = False
+        for test_name, value in results.items():
+            row = rows.get(test_name)
+            if row and row.result_value != value:
+                row.result_value = value
+                changed = True
+
+        if changed:
+            doc.save(ignore_permissions=True)
+            frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(
+            frappe.get_traceback(),
+            "Lab Machine results not applied to Lab Test {0}".format(lab_test),
+        )
+
+
+def get_sample_collection_lab_tests(sample_collections):
+    if not sample_collections:
+        return {}
+    lab_tests = {}
+    for row in frappe.get_all(
+        "Lab Test",
+        filters={"sample": ["in", list(sample_collections)], "docstatus": 0},
+        fields=["name", "sample"],
+    ):
+        lab_tests.setdefault(row.sample, []).append(row.name)
+    return lab_tests
+
+
+def get_machine_profile(machine_make, machine_model):
+    """Lab Machine Profile of an analyzer, cached in redis until a profile changes"""
+    if not machine_make or not machine_model:
+        return None
+
+    key = machine_model + "-" + machine_make
+    profile = frappe.cache().hget(profile_cache_key, key)
+    if profile is None:
+        profile = {}
+        for name in (key, machine_make + "-" + machine_model):
+            profile = frappe.db.get_value(
+                "Lab Machine Profile",
+                name,
+                ["name", "lab_test_prefix", "obx_nm_start", "obx_nm_end"],
+                as_dict=True,
             )
-            ## try to upodate each lab test in the sample collection
-            for lab_test in sample_collection_doc.lab_tests:
-                lab_test_doc = frappe.get_cached_doc("Lab Test", lab_test.lab_test)
-                if lab_test_doc.docstatus != 0:
-                    continue
-                msg_lines = self.message.splitlines()
-                for line in msg_lines:
-                    if line.startswith("OBX"):
-                        fields = line.split("|")
-                        if fields[2] == "NM":
-                            test_name = None
-                            if "^" in line:
-                                test_name = (
-                                    line.split("|")[3].split("^")[1].replace("*", "")
-                                )
-                            else:
-                                test_name = line.split("|")[4].replace("*", "")
-                            test_result = fields[5]
-                            lab_test_row = ""
-                            for row in lab_test_doc.normal_test_items:
-                                if row.lab_test_name == test_name:
-                                    lab_test_row = row
-                                    break
-                            if lab_test_row:
-                                lab_test_row.result_value = test_result
-                lab_test_doc.save(ignore_permissions=True)
-                frappe.db.commit()
+            if profile:
+                break
+        profile = profile or {}
+        frappe.cache().hset(profile_cache_key, key, profile)
+    return frappe._dict(profile) if profile else None
+
+
+def clear_machine_profiles():
+    frappe.cache().delete_value(profile_cache_key)
@@ -3,9 +3,119 @@
 # See license.txt
 from __future__ import unicode_literals
 
-# import frappe
 import unittest
+from hms_tz.nhif.api.hl7 import (
+    parse_hl7,
+    get_message_header,
+    get_profile_results,
+    get_numeric_results,
+    build_ack,
+)
+from hms_tz.nhif.api.mllp import (
+    MLLPFrameReader,
+    frame,
+    start_local_server,
+    send_messages,
+)
+
+
+sample_message = "\r".join(
+    [
+        "MSH|^~\\&|Mindray|BC-5380|||20260101101500||ORU^R01|MSG0001|P|2.3.1",
+        "PID|1||HLC-PAT-2026-00001",
+        "OBR|1|HLC-SC-2026-00001||CBC",
+        "OBX|1|NM|6690-2^WBC*^LN||7.5|10*3/uL|4.0-10.0|N|||F",
+        "OBX|2|NM|789-8^RBC^LN||4.80|10*6/uL|3.50-5.50|N|||F",
+        "OBX|3|ST|^Remark^LN||Normal||||||F",
+    ]
+)
 
 
 class TestLabMachineMessage(unittest.TestCase):
-    pass
+    def test_parse_hl7(self):
+        parsed = parse_hl7(sample_message)
+        self.assertEqual(len(parsed.segments), 6)
+        self.assertEqual(parsed.msh[9], "MSG0001")
+        self.assertEqual(parsed.obr[2], "HLC-SC-2026-00001")
+        self.assertEqual(len(parsed.obx), 3)
+
+    def test_message_header(self):
+        header = get_message_header(parse_hl7(sample_message))
+        self.assertEqual(header.machine_make, "Mindray")
+        self.assertEqual(header.machine_model, "BC-5380")
+        self.assertEqual(header.lab_test_name, "6690-2^WBC*^LN")
+        self.assertEqual(header.sample_collection, "HLC-SC-2026-00001")
+        self.assertEqual(header.control_id, "MSG0001")
+
+    def test_results(self):
+        parsed = parse_hl7(sample_message)
+        self.assertEqual(get_numeric_results(parsed), {"WBC": "7.5", "RBC": "4.80"})
+        self.assertEqual(
+            get_profile_results(parsed, 3, 6),
+            {"WBC": "7.5", "RBC": "4.80", "Remark": "Normal"},
+        )
+
+    def test_build_ack(self):
+        ack = parse_hl7(build_ack(sample_message, "AE", "no site"))
+        self.assertEqual(ack.msh[2], "")
+        self.assertEqual(ack.msh[4], "Mindray")
+        self.assertEqual(ack.msh[5], "BC-5380")
+        self.assertEqual(ack.msh[8], "ACK")
+        self.assertEqual(ack.segments[1], ["MSA", "AE", "MSG0001", "no site"])
+
+    def test_frame_reader(self):
+        data = frame(sample_message) + frame("MSH|second")
+        reader = MLLPFrameReader()
+        messages = []
+        # frames split across reads at every byte
+        for i in range(len(data)):
+            messages.extend(reader.feed(data[i : i + 1]))
+        self.assertEqual(
+            messages, [sample_message.encode(), "MSH|second".encode()]
+        )
+        self.assertEqual(reader.feed(b"noise without frames"), [])
+
+    def test_local_server_round_trip(self):
+        received = []
+
+        def handle_message(message, machine_id):
+            if "FAIL" in message:
+                raise Exception("rejected")
+            received.append((message, machine_id))
+
+        server = start_local_server(handle_message)
+        try:
+            host, port = server.server_address
+            acks = send_messages(
+                host, port, [sample_message, "MSH|^~\\&|FAIL||||||ORU|MSG0002"]
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(received, [(sample_message, "127.0.0.1")])
+        self.assertEqual(len(acks), 2)
+        self.assertEqual(parse_hl7(acks[0]).segments[1][:3], ["MSA", "AA", "MSG0001"])
+        self.assertEqual(
+            parse_hl7(acks[1]).segments[1], ["MSA", "AE", "MSG0002", "rejected"]
+        )
+
+    def test_local_server_rejects_unlisted_peer(self):
+        received = []
+        server = start_local_server(
+            lambda message, machine_id: received.append(message),
+            allowed_hosts={"10.0.0.5"},
+        )
+        try:
+            host, port = server.server_address
+            try:
+                acks = send_messages(host, port, [sample_message])
+            except ConnectionError:
+                # the peer may see a reset instead of a clean close
+                acks = []
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(received, [])
+        self.assertEqual(acks, [])
@@ -6,7 +6,14 @@ from __future__ import unicode_literals
 
 # import frappe
 from frappe.model.document import Document
+from hms_tz.nhif.doctype.lab_machine_message.lab_machine_message import (
+    clear_machine_profiles,
+)
 
 
 class LabMachineProfile(Document):
-    pass
+    def on_update(self):
+        clear_machine_profiles()
+
+    def on_trash(self):
+        clear_machine_profiles()
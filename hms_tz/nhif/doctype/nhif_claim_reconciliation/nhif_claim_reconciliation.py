@@ -3,10 +3,10 @@
 
 import frappe
 import json
-import requests
 from frappe.utils import nowdate, flt
 from frappe.model.document import Document
 from hms_tz.nhif.api.token import get_claimsservice_token
+from hms_tz.nhif.api.nhif_client import nhif_request
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
 
 class NHIFClaimReconciliation(Document):
@@ -54,7 +54,7 @@ def get_submitted_claims(self):
 
 def make_request(url, headers, payload):
 	try:
-		response = requests.get(url, headers=headers)
+		response = nhif_request("GET", url, "GetSubmittedClaims", headers=headers)
 		if response.status_code == 200:
 			data = json.loads(response.text)
 			add_log(
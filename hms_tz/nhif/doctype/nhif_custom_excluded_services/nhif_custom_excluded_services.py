@@ -42,3 +42,14 @@ def get_custom_excluded_services(company, item_code):
     )
     if custom_excluded_services:
         return custom_excluded_services[0].excludedforproducts
+
+
+def get_custom_excluded_services_map(company):
+    custom_excluded_services_map = {}
+    for row in frappe.get_all(
+        "NHIF Custom Excluded Services",
+        filters={"company": company},
+        fields=["itemcode", "excludedforproducts"],
+    ):
+        custom_excluded_services_map.setdefault(row.itemcode, row.excludedforproducts)
+    return custom_excluded_services_map
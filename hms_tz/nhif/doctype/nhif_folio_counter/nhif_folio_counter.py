@@ -1,8 +1,74 @@
 # Copyright (c) 2022, Aakvatech and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
+from frappe.utils import cint, now
 from frappe.model.document import Document
+from frappe.model.naming import make_autoname
 
 class NHIFFolioCounter(Document):
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique(
+		"NHIF Folio Counter",
+		["company", "claim_year", "claim_month"],
+		constraint_name="unique_claim_period",
+	)
+
+
+def allocate_folio_numbers(company, claim_year, claim_month, count=1):
+	"""Reserve `count` consecutive folio numbers of a claim period with one atomic
+	upsert of its counter, the numbers are returned in order.
+
+	The counter row stays locked until the caller's transaction ends, and the
+	numbers are given back if it is rolled back, so reserve them in the
+	transaction of the claims that use them.
+	"""
+	count = cint(count) or 1
+	values = {
+		"company": company,
+		"claim_year": cint(claim_year),
+		"claim_month": cint(claim_month),
+		"count": count,
+		"now": now(),
+		"user": frappe.session.user,
+	}
+	# a name is only generated for the first claim of a period
+	values["name"] = frappe.db.get_value(
+		"NHIF Folio Counter",
+		{
+			"company": company,
+			"claim_year": values["claim_year"],
+			"claim_month": values["claim_month"],
+		},
+		"name",
+	) or make_autoname(frappe.get_meta("NHIF Folio Counter").autoname)
+
+	# a concurrent first insert of the period lands on the unique key
+	frappe.db.sql(
+		"""
+		INSERT INTO `tabNHIF Folio Counter`
+		(
+			`name`, `company`, `claim_year`, `claim_month`, `folio_no`,
+			`posting_date`, `creation`, `modified`, `modified_by`, `owner`
+		)
+		VALUES (
+			%(name)s, %(company)s, %(claim_year)s, %(claim_month)s,
+			LAST_INSERT_ID(%(count)s), %(now)s, %(now)s, %(now)s, %(user)s, %(user)s
+		)
+		ON DUPLICATE KEY UPDATE
+			`folio_no` = LAST_INSERT_ID(IFNULL(`folio_no`, 0) + %(count)s),
+			`posting_date` = %(now)s, `modified` = %(now)s
+		""",
+		values,
+	)
+
+	last_folio_no = cint(frappe.db.sql("SELECT LAST_INSERT_ID()")[0][0])
+	return list(range(last_folio_no - count + 1, last_folio_no + 1))
+
+
+def get_next_folio_no(company, claim_year, claim_month):
+	"""Next folio number of a claim period, reserved in the caller's transaction"""
+	return allocate_folio_numbers(company, claim_year, claim_month)[0]
@@ -8,8 +8,8 @@ from frappe import _
 from frappe.model.document import Document
 import uuid
 from hms_tz.nhif.api.token import get_claimsservice_token
+from hms_tz.nhif.api.nhif_client import nhif_request
 import json
-import requests
 from frappe.utils.background_jobs import enqueue
 from frappe.utils import (
     getdate,
@@ -19,9 +19,10 @@ from frappe.utils import (
     get_datetime,
     time_diff_in_seconds,
     now_datetime,
-    cint,
     get_url_to_form,
     get_time,
+    add_days,
+    cint,
 )
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
 from hms_tz.nhif.api.healthcare_utils import (
@@ -29,13 +30,18 @@ from hms_tz.nhif.api.healthcare_utils import (
     to_base64,
     get_approval_number_from_LRPMT,
 )
-import os
+import io
+import hashlib
 from frappe.utils.pdf import get_pdf
 from PyPDF2 import PdfFileWriter
+from hms_tz.nhif.doctype.nhif_folio_counter.nhif_folio_counter import (
+    get_next_folio_no,
+)
 from hms_tz.nhif.doctype.nhif_tracking_claim_change.nhif_tracking_claim_change import (
     track_changes_of_claim_items,
 )
 from frappe.query_builder import DocType
+from redis.exceptions import LockNotOwnedError
 
 
 pa = DocType("Patient Appointment")
@@ -70,6 +76,15 @@ class NHIFPatientClaim(Document):
                 pa.name == self.patient_appointment
             ).run()
 
+    def on_update(self):
+        if self.docstatus == 0 and not self.flags.skip_claim_pdf_prerender:
+            enqueue(
+                method=prerender_claim_pdf,
+                queue="short",
+                claim=self.name,
+                enqueue_after_commit=True,
+            )
+
     def on_trash(self):
         # check if claim number exist in appointment record
         nhif_patient_claim = frappe.get_value(
@@ -423,53 +438,19 @@ class NHIFPatientClaim(Document):
         childs_map = get_child_map()
         self.nhif_patient_claim_item = []
         self.clinical_notes = ""
+        encounter_data = get_claim_encounter_data(
+            [encounter.name for encounter in self.patient_encounters], childs_map
+        )
         if not inpatient_record:
             for encounter in self.patient_encounters:
-                encounter_doc = frappe.get_doc("Patient Encounter", encounter.name)
+                encounter_doc = encounter_data.encounters[encounter.name]
 
                 self.set_clinical_notes(encounter_doc)
 
-                for child in childs_map:
-                    for row in encounter_doc.get(child.get("table")):
-                        if row.prescribe or row.is_cancelled:
-                            continue
-
-                        item_code = frappe.get_value(
-                            child.get("doctype"), row.get(child.get("item")), "item"
-                        )
-
-                        delivered_quantity = 0
-                        if row.get("doctype") == "Drug Prescription":
-                            delivered_quantity = (row.get("quantity") or 0) - (
-                                row.get("quantity_returned") or 0
-                            )
-                        elif row.get("doctype") == "Therapy Plan Detail":
-                            delivered_quantity = (row.get("no_of_sessions") or 0) - (
-                                row.get("sessions_cancelled") or 0
-                            )
-                        else:
-                            delivered_quantity = 1
-
-                        new_row = self.append("nhif_patient_claim_item", {})
-                        new_row.item_name = row.get(child.get("item_name"))
-                        new_row.item_code = get_item_refcode(item_code)
-                        new_row.item_quantity = delivered_quantity or 1
-                        new_row.unit_price = row.get("amount")
-                        new_row.amount_claimed = (
-                            new_row.unit_price * new_row.item_quantity
-                        )
-                        new_row.approval_ref_no = get_approval_number_from_LRPMT(
-                            child["ref_doctype"], row.get(child["ref_docname"])
-                        )
-
-                        new_row.status = get_LRPMT_status(encounter.name, row, child)
-                        new_row.patient_encounter = encounter.name
-                        new_row.ref_doctype = row.doctype
-                        new_row.ref_docname = row.name
-                        new_row.folio_item_id = str(uuid.uuid1())
-                        new_row.folio_id = self.folio_id
-                        new_row.date_created = row.modified.strftime("%Y-%m-%d")
-                        new_row.item_crt_by = encounter_doc.practitioner
+                for values in get_claim_items_values(
+                    encounter_doc, childs_map, encounter_data, "item_name"
+                ):
+                    self.append_claim_item(values)
         else:
             dates = []
             occupancy_list = []
@@ -478,6 +459,11 @@ class NHIFPatientClaim(Document):
             admission_encounter_doc = frappe.get_doc(
                 "Patient Encounter", record_doc.admission_encounter
             )
+            encounter_data.ref_codes.update(
+                get_item_refcodes(
+                    [row.consultation_item for row in record_doc.inpatient_consultancy]
+                )
+            )
             for occupancy in record_doc.inpatient_occupancies:
                 if not occupancy.is_confirmed:
                     continue
@@ -521,7 +507,7 @@ class NHIFPatientClaim(Document):
                 )
                 new_row = self.append("nhif_patient_claim_item", {})
                 new_row.item_name = occupancy.service_unit
-                new_row.item_code = get_item_refcode(item_code)
+                new_row.item_code = get_item_refcode(item_code, encounter_data.ref_codes)
                 new_row.item_quantity = 1
                 new_row.unit_price = item_rate
                 new_row.amount_claimed = new_row.unit_price * new_row.item_quantity
@@ -549,7 +535,9 @@ class NHIFPatientClaim(Document):
                             item_code = row_item.consultation_item
                             new_row = self.append("nhif_patient_claim_item", {})
                             new_row.item_name = row_item.consultation_item
-                            new_row.item_code = get_item_refcode(item_code)
+                            new_row.item_code = get_item_refcode(
+                                item_code, encounter_data.ref_codes
+                            )
                             new_row.item_quantity = 1
                             new_row.unit_price = row_item.rate
                             new_row.amount_claimed = row_item.rate
@@ -569,7 +557,7 @@ class NHIFPatientClaim(Document):
                 for encounter in self.patient_encounters:
                     if str(encounter.encounter_date) != checkin_date:
                         continue
-                    encounter_doc = frappe.get_doc("Patient Encounter", encounter.name)
+                    encounter_doc = encounter_data.encounters[encounter.name]
 
                     # allow clinical notes to be added to the claim even if the service is not chargeable and encounters will be ignored
                     self.set_clinical_notes(encounter_doc)
@@ -577,53 +565,10 @@ class NHIFPatientClaim(Document):
                     if not occupancy.is_service_chargeable:
                         continue
 
-                    for child in childs_map:
-                        for row in encounter_doc.get(child.get("table")):
-                            if row.prescribe or row.is_cancelled:
-                                continue
-                            
-                            item_code = frappe.get_value(
-                                child.get("doctype"),
-                                row.get(child.get("item")),
-                                "item",
-                            )
-
-                            delivered_quantity = 0
-                            if row.get("doctype") == "Drug Prescription":
-                                delivered_quantity = (row.get("quantity") or 0) - (
-                                    row.get("quantity_returned") or 0
-                                )
-                            elif row.get("doctype") == "Therapy Plan Detail":
-                                delivered_quantity = (row.get("no_of_sessions") or 0) - (
-                                    row.get("sessions_cancelled") or 0
-                                )
-                            else:
-                                delivered_quantity = 1
-
-                            new_row = self.append("nhif_patient_claim_item", {})
-                            new_row.item_name = row.get(child.get("item"))
-                            new_row.item_code = get_item_refcode(item_code)
-                            new_row.item_quantity = delivered_quantity or 1
-                            new_row.unit_price = row.get("amount")
-                            new_row.amount_claimed = (
-                                new_row.unit_price * new_row.item_quantity
-                            )
-                            new_row.approval_ref_no = get_approval_number_from_LRPMT(
-                                child["ref_doctype"],
-                                row.get(child["ref_docname"]),
-                            )
-
-                            new_row.status = get_LRPMT_status(
-                                encounter.name, row, child
-                            )
-
-                            new_row.patient_encounter = encounter.name
-                            new_row.ref_doctype = row.doctype
-                            new_row.ref_docname = row.name
-                            new_row.folio_item_id = str(uuid.uuid1())
-                            new_row.folio_id = self.folio_id
-                            new_row.date_created = row.modified.strftime("%Y-%m-%d")
-                            new_row.item_crt_by = encounter_doc.practitioner
+                    for values in get_claim_items_values(
+                        encounter_doc, childs_map, encounter_data, "item"
+                    ):
+                        self.append_claim_item(values)
 
         patient_appointment_list = []
         if not self.hms_tz_claim_appointment_list:
@@ -681,6 +626,12 @@ class NHIFPatientClaim(Document):
                 new_row.idx = appointment_idx
                 appointment_idx += 1
 
+    def append_claim_item(self, values):
+        new_row = self.append("nhif_patient_claim_item", values)
+        new_row.folio_item_id = str(uuid.uuid1())
+        new_row.folio_id = self.folio_id
+        return new_row
+
     def get_final_patient_encounter(self):
         # rock 173
         appointment = None
@@ -788,7 +739,12 @@ class NHIFPatientClaim(Document):
         url = str(claimsserver_url) + "/claimsserver/api/v1/Claims/SubmitFolios"
         r = None
         try:
-            r = requests.post(url, headers=headers, data=json_data, timeout=300)
+            # read by the auto submission scheduler to tell NHIF errors from ours
+            self.flags.nhif_request_sent = True
+            r = nhif_request(
+                "POST", url, "SubmitFolios", headers=headers, data=json_data
+            )
+            self.flags.nhif_status_code = r.status_code
 
             if r.status_code != 200:
                 if str(r) and r.status_code == 500 and "A claim with Similar" in r.text:
@@ -925,38 +881,7 @@ class NHIFPatientClaim(Document):
         self.validate_multiple_appointments_per_authorization_no("before_insert")
 
     def after_insert(self):
-        folio_counter = frappe.get_all(
-            "NHIF Folio Counter",
-            filters={
-                "company": self.company,
-                "claim_year": self.claim_year,
-                "claim_month": self.claim_month,
-            },
-            fields=["name"],
-            page_length=1,
-        )
-
-        folio_no = 1
-        if not folio_counter:
-            new_folio_doc = frappe.get_doc(
-                {
-                    "doctype": "NHIF Folio Counter",
-                    "company": self.company,
-                    "claim_year": self.claim_year,
-                    "claim_month": self.claim_month,
-                    "posting_date": now_datetime(),
-                    "folio_no": folio_no,
-                }
-            ).insert(ignore_permissions=True)
-            new_folio_doc.reload()
-        else:
-            folio_doc = frappe.get_doc("NHIF Folio Counter", folio_counter[0].name)
-            folio_no = cint(folio_doc.folio_no) + 1
-
-            folio_doc.folio_no += 1
-            folio_doc.posting_date = now_datetime()
-            folio_doc.save(ignore_permissions=True)
-        frappe.set_value(self.doctype, self.name, "folio_no", folio_no)
+        folio_no = get_next_folio_no(self.company, self.claim_year, self.claim_month)
 
         items = []
         for row in self.nhif_patient_claim_item:
@@ -972,10 +897,14 @@ class NHIFPatientClaim(Document):
                 new_row[fieldname] = None
             items.append(new_row)
 
+        values = {"folio_no": folio_no}
         if len(items) > 0:
-            frappe.set_value(
-                self.doctype, self.name, "original_nhif_patient_claim_item", items
-            )
+            values["original_nhif_patient_claim_item"] = items
+        doc = frappe.get_doc(self.doctype, self.name)
+        doc.update(values)
+        # on_update of the insert already queued the pre-render
+        doc.flags.skip_claim_pdf_prerender = True
+        doc.save()
 
         self.reload()
 
@@ -1099,20 +1028,32 @@ def validate_hold_card_status(
         frappe.throw(msg)
 
 
-def get_item_refcode(item_code):
-    code_list = frappe.get_all(
-        "Item Customer Detail",
-        filters={"parent": item_code, "customer_name": "NHIF"},
-        fields=["ref_code"],
-    )
-    if len(code_list) == 0:
-        frappe.throw(_(f"Item {item_code} has not NHIF Code Reference"))
-    ref_code = code_list[0].ref_code
+def get_item_refcode(item_code, ref_codes=None):
+    """Return the NHIF code of an item, from `ref_codes` when it was prefetched"""
+    if ref_codes is None:
+        ref_codes = get_item_refcodes([item_code])
+    elif item_code not in ref_codes:
+        ref_codes.update(get_item_refcodes([item_code]))
+    ref_code = ref_codes.get(item_code)
     if not ref_code:
         frappe.throw(_(f"Item {item_code} has not NHIF Code Reference"))
     return ref_code
 
 
+def get_item_refcodes(item_codes):
+    ref_codes = {}
+    if not item_codes:
+        return ref_codes
+    for row in frappe.get_all(
+        "Item Customer Detail",
+        filters={"parent": ["in", list(set(item_codes))], "customer_name": "NHIF"},
+        fields=["parent", "ref_code"],
+        order_by="idx",
+    ):
+        ref_codes.setdefault(row.parent, row.ref_code)
+    return ref_codes
+
+
 def generate_pdf(doc):
     file_list = frappe.get_all(
         "File",
@@ -1186,16 +1127,45 @@ def download_multi_pdf(doctype, name, print_format=None, no_letterhead=0):
 
 
 def read_multi_pdf(output):
-    fname = os.path.join("/tmp", "frappe-pdf-{0}.pdf".format(frappe.generate_hash()))
-    output.write(open(fname, "wb"))
+    buffer = io.BytesIO()
+    output.write(buffer)
+    return buffer.getvalue()
 
-    with open(fname, "rb") as fileobj:
-        filedata = fileobj.read()
 
-    return filedata
+def get_claim_print_format(doctype):
+    default_print_format = frappe.db.get_value(
+        "Property Setter",
+        dict(property="default_print_format", doc_type=doctype),
+        "value",
+    )
+    return default_print_format or "NHIF Form 2A & B"
+
+
+def get_claim_content_hash(doc, print_format):
+    """Hash of everything the claim form is rendered from: header fields,
+    diseases, items and the print format itself.
+    """
+    data = doc.as_dict(no_default_fields=True)
+    for fieldname in ("claim_file_hash", "_comments", "_assign", "_liked_by"):
+        data.pop(fieldname, None)
+    data["name"] = doc.name
+    data["print_format"] = print_format
+    data["print_format_modified"] = frappe.db.get_value(
+        "Print Format", print_format, "modified"
+    )
+    return hashlib.sha256(frappe.safe_encode(frappe.as_json(data))).hexdigest()
 
 
 def get_claim_pdf_file(doc):
+    """Return the claim form as base64, rendered again only when the content
+    hash of the claim changed since the stored pdf was made.
+    """
+    doctype = doc.doctype
+    docname = doc.name
+    print_format = get_claim_print_format(doctype)
+    content_hash = get_claim_content_hash(doc, print_format)
+    filename = "{name}-claim".format(name=docname.replace(" ", "-").replace("/", "-"))
+
     file_list = frappe.get_all(
         "File",
         filters={
@@ -1203,27 +1173,18 @@ def get_claim_pdf_file(doc):
             "file_name": str(doc.name + "-claim.pdf"),
         },
     )
-    if file_list:
-        for file in file_list:
-            frappe.delete_doc("File", file.name, ignore_permissions=True)
-
-    doctype = doc.doctype
-    docname = doc.name
-    default_print_format = frappe.db.get_value(
-        "Property Setter",
-        dict(property="default_print_format", doc_type=doctype),
-        "value",
-    )
-    if default_print_format:
-        print_format = default_print_format
-    else:
-        print_format = "NHIF Form 2A & B"
-
-    # print_format = "NHIF Form 2A & B"
+    if file_list and doc.get("claim_file_hash") == content_hash:
+        try:
+            pdf = frappe.get_doc("File", file_list[0].name).get_content()
+            if pdf:
+                return to_base64(pdf)
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), "Stored claim pdf not readable")
 
-    html = frappe.get_print(doctype, docname, print_format, doc=None, no_letterhead=1)
+    for file in file_list:
+        frappe.delete_doc("File", file.name, ignore_permissions=True)
 
-    filename = "{name}-claim".format(name=docname.replace(" ", "-").replace("/", "-"))
+    html = frappe.get_print(doctype, docname, print_format, doc=doc, no_letterhead=1)
     pdf = get_pdf(html)
     if pdf:
         ret = frappe.get_doc(
@@ -1242,12 +1203,40 @@ def get_claim_pdf_file(doc):
         ret.db_update()
         if not ret.name:
             frappe.throw("ret name not exist")
+
+        doc.claim_file_hash = content_hash
+        frappe.db.set_value(
+            doctype, docname, "claim_file_hash", content_hash, update_modified=False
+        )
         base64_data = to_base64(pdf)
         return base64_data
     else:
         frappe.throw(_("Failed to generate pdf"))
 
 
+def prerender_claim_pdf(claim):
+    """Render the claim form after a save, so submitting finds it ready"""
+    cache = frappe.cache()
+    lock = cache.lock(cache.make_key("nhif_claim_pdf:" + claim), timeout=600)
+    if not lock.acquire(blocking=False):
+        return
+
+    try:
+        if not frappe.db.exists("NHIF Patient Claim", {"name": claim, "docstatus": 0}):
+            return
+        doc = frappe.get_doc("NHIF Patient Claim", claim)
+        get_claim_pdf_file(doc)
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "Claim pdf pre-render failed")
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            pass
+
+
 def get_child_map():
     childs_map = [
         {
@@ -1299,21 +1288,24 @@ def get_child_map():
     return childs_map
 
 
-def get_LRPMT_status(encounter_no, row, child):
+def get_LRPMT_status(encounter_no, row, child, lab_workflow_states=None):
     status = None
     if child["doctype"] == "Therapy Type" or row.get(child["ref_docname"]):
         status = "Submitted"
 
     elif child["doctype"] == "Lab Test Template" and not row.get(child["ref_docname"]):
-        lab_workflow_state = frappe.get_value(
-            "Lab Test",
-            {
-                "ref_docname": encounter_no,
-                "ref_doctype": "Patient Encounter",
-                "hms_tz_ref_childname": row.name,
-            },
-            "workflow_state",
-        )
+        if lab_workflow_states is not None:
+            lab_workflow_state = lab_workflow_states.get((encounter_no, row.name))
+        else:
+            lab_workflow_state = frappe.get_value(
+                "Lab Test",
+                {
+                    "ref_docname": encounter_no,
+                    "ref_doctype": "Patient Encounter",
+                    "hms_tz_ref_childname": row.name,
+                },
+                "workflow_state",
+            )
         if lab_workflow_state and lab_workflow_state != "Lab Test Requested":
             status = "Submitted"
         else:
@@ -1324,6 +1316,310 @@ def get_LRPMT_status(encounter_no, row, child):
     return status
 
 
+def get_claim_encounter_data(encounter_names, childs_map):
+    """Load everything needed to build the claim items of the encounters.
+
+    A fixed number of queries is used whatever the number of encounters and
+    rows: the encounters, their child tables, the template items, NHIF codes,
+    approval numbers and lab test workflow states.
+    """
+    data = frappe._dict(
+        encounters={},
+        template_items={},
+        ref_codes={},
+        approval_numbers={},
+        lab_workflow_states={},
+    )
+    if not encounter_names:
+        return data
+
+    for encounter in frappe.get_all(
+        "Patient Encounter",
+        filters={"name": ["in", encounter_names]},
+        fields=[
+            "name",
+            "practitioner",
+            "practitioner_name",
+            "encounter_date",
+            "encounter_time",
+            "examination_detail",
+            "insurance_subscription",
+            "insurance_company",
+        ],
+    ):
+        for child in childs_map:
+            encounter[child["table"]] = []
+        data.encounters[encounter.name] = encounter
+
+    meta = frappe.get_meta("Patient Encounter")
+    templates = {}
+    ref_docnames = {}
+    lab_rows = []
+    for child in childs_map:
+        child_doctype = meta.get_field(child["table"]).options
+        for row in frappe.get_all(
+            child_doctype,
+            filters={
+                "parent": ["in", encounter_names],
+                "parenttype": "Patient Encounter",
+                "parentfield": child["table"],
+            },
+            fields=["*"],
+            order_by="parent, idx",
+        ):
+            row.doctype = child_doctype
+            data.encounters[row.parent][child["table"]].append(row)
+            if row.prescribe or row.is_cancelled:
+                continue
+
+            templates.setdefault(child["doctype"], set()).add(row.get(child["item"]))
+            if child["ref_doctype"] and row.get(child["ref_docname"]):
+                ref_docnames.setdefault(child["ref_doctype"], set()).add(
+                    row.get(child["ref_docname"])
+                )
+            elif child["doctype"] == "Lab Test Template":
+                lab_rows.append(row.name)
+
+    for template_doctype, names in templates.items():
+        for template in frappe.get_all(
+            template_doctype,
+            filters={"name": ["in", list(names)]},
+            fields=["name", "item"],
+        ):
+            data.template_items[(template_doctype, template.name)] = template.item
+
+    for ref_doctype, names in ref_docnames.items():
+        for ref_doc in frappe.get_all(
+            ref_doctype,
+            filters={"name": ["in", list(names)]},
+            fields=["name", "approval_number"],
+        ):
+            data.approval_numbers[(ref_doctype, ref_doc.name)] = ref_doc.approval_number
+
+    if lab_rows:
+        for lab in frappe.get_all(
+            "Lab Test",
+            filters={
+                "ref_doctype": "Patient Encounter",
+                "ref_docname": ["in", encounter_names],
+                "hms_tz_ref_childname": ["in", lab_rows],
+            },
+            fields=["ref_docname", "hms_tz_ref_childname", "workflow_state"],
+        ):
+            data.lab_workflow_states.setdefault(
+                (lab.ref_docname, lab.hms_tz_ref_childname), lab.workflow_state
+            )
+
+    data.ref_codes = get_item_refcodes(list(set(data.template_items.values())))
+    return data
+
+
+def get_claim_items_values(encounter_doc, childs_map, data, item_name_field):
+    """Build the claim item values of one encounter from prefetched `data`"""
+    items = []
+    for child in childs_map:
+        for row in encounter_doc.get(child.get("table")):
+            if row.prescribe or row.is_cancelled:
+                continue
+
+            item_code = data.template_items.get(
+                (child.get("doctype"), row.get(child.get("item")))
+            )
+
+            delivered_quantity = 0
+            if row.get("doctype") == "Drug Prescription":
+                delivered_quantity = (row.get("quantity") or 0) - (
+                    row.get("quantity_returned") or 0
+                )
+            elif row.get("doctype") == "Therapy Plan Detail":
+                delivered_quantity = (row.get("no_of_sessions") or 0) - (
+                    row.get("sessions_cancelled") or 0
+                )
+            else:
+                delivered_quantity = 1
+
+            item_quantity = delivered_quantity or 1
+            approval_ref_no = None
+            if child["ref_doctype"] and row.get(child["ref_docname"]):
+                approval_ref_no = data.approval_numbers.get(
+                    (child["ref_doctype"], row.get(child["ref_docname"]))
+                )
+
+            items.append(
+                {
+                    "item_name": row.get(child.get(item_name_field)),
+                    "item_code": get_item_refcode(item_code, data.ref_codes),
+                    "item_quantity": item_quantity,
+                    "unit_price": row.get("amount"),
+                    "amount_claimed": row.get("amount") * item_quantity,
+                    "approval_ref_no": approval_ref_no,
+                    "status": get_LRPMT_status(
+                        encounter_doc.name, row, child, data.lab_workflow_states
+                    ),
+                    "patient_encounter": encounter_doc.name,
+                    "ref_doctype": row.doctype,
+                    "ref_docname": row.name,
+                    "date_created": row.modified.strftime("%Y-%m-%d"),
+                    "item_crt_by": encounter_doc.practitioner,
+                }
+            )
+    return items
+
+
+def count_queries(method, *args, **kwargs):
+    """Run `method` and return (result, seconds, queries sent through frappe.db.sql)"""
+    from time import perf_counter
+
+    queries = [0]
+    sql = frappe.db.sql
+
+    def counting_sql(*sql_args, **sql_kwargs):
+        queries[0] += 1
+        return sql(*sql_args, **sql_kwargs)
+
+    frappe.db.sql = counting_sql
+    try:
+        start = perf_counter()
+        result = method(*args, **kwargs)
+        elapsed = perf_counter() - start
+    finally:
+        del frappe.db.sql
+    return result, elapsed, queries[0]
+
+
+def make_benchmark_admission(days, rows_per_table, childs_map):
+    """Insert a synthetic inpatient stay of `days` encounters, with prescription rows
+    on templates that have NHIF codes and a Lab Test per lab row. Rows go straight
+    to the database, the caller rolls them back.
+    """
+    templates = {}
+    for child in childs_map:
+        templates[child["table"]] = frappe.db.sql(
+            """
+            SELECT t.name
+            FROM `tab{0}` t
+            INNER JOIN `tabItem Customer Detail` icd
+                ON icd.parent = t.item AND icd.customer_name = 'NHIF'
+            GROUP BY t.name
+            LIMIT %s
+            """.format(
+                child["doctype"]
+            ),
+            rows_per_table,
+            pluck=True,
+        )
+
+    run = frappe.generate_hash(length=6)
+    encounter_names = []
+    for day in range(days):
+        encounter = frappe.get_doc(
+            {
+                "doctype": "Patient Encounter",
+                "name": "BENCH-{0}-ENC-{1}".format(run, day),
+                "patient": "BENCH-{0}-PATIENT".format(run),
+                "practitioner": "BENCH-{0}-PRACTITIONER".format(run),
+                "encounter_date": add_days(nowdate(), day - days),
+                "docstatus": 1,
+            }
+        )
+        for child in childs_map:
+            for template in templates[child["table"]]:
+                encounter.append(
+                    child["table"],
+                    {
+                        child["item"]: template,
+                        child["item_name"]: template,
+                        "amount": 1000,
+                        "quantity": 2,
+                        "no_of_sessions": 2,
+                    },
+                )
+        encounter.db_insert()
+        for row in encounter.get_all_children():
+            row.name = frappe.generate_hash(length=10)
+            row.db_insert()
+            if row.doctype == "Lab Prescription":
+                frappe.get_doc(
+                    {
+                        "doctype": "Lab Test",
+                        "name": "BENCH-{0}-LAB-{1}".format(run, row.name),
+                        "template": row.lab_test_code,
+                        "patient": encounter.patient,
+                        "ref_doctype": "Patient Encounter",
+                        "ref_docname": encounter.name,
+                        "hms_tz_ref_childname": row.name,
+                        "workflow_state": "Lab Test Requested",
+                    }
+                ).db_insert()
+        encounter_names.append(encounter.name)
+    return encounter_names
+
+
+def build_claim_items_per_row(encounter_names, childs_map):
+    """The claim item assembly as it was before the prefetch, one lookup per row"""
+    items = []
+    for name in encounter_names:
+        encounter_doc = frappe.get_doc("Patient Encounter", name)
+        for child in childs_map:
+            for row in encounter_doc.get(child.get("table")):
+                if row.prescribe or row.is_cancelled:
+                    continue
+                item_code = frappe.get_value(
+                    child.get("doctype"), row.get(child.get("item")), "item"
+                )
+                items.append(
+                    {
+                        "item_code": get_item_refcode(item_code),
+                        "approval_ref_no": get_approval_number_from_LRPMT(
+                            child["ref_doctype"], row.get(child["ref_docname"])
+                        ),
+                        "status": get_LRPMT_status(name, row, child),
+                    }
+                )
+    return items
+
+
+def build_claim_items_prefetched(encounter_names, childs_map):
+    data = get_claim_encounter_data(encounter_names, childs_map)
+    items = []
+    for name in encounter_names:
+        items.extend(
+            get_claim_items_values(data.encounters[name], childs_map, data, "item_name")
+        )
+    return items
+
+
+def benchmark_claim_items(days=30, rows_per_table=5):
+    """Measure claim item assembly for a synthetic inpatient stay of `days` encounters,
+    per row lookups against the prefetched build, with queries counted at frappe.db.sql.
+
+    The admission is inserted and rolled back in the current transaction, run with
+    `bench --site <site> execute hms_tz.nhif.doctype.nhif_patient_claim.nhif_patient_claim.benchmark_claim_items`
+    """
+    childs_map = get_child_map()
+    try:
+        encounter_names = make_benchmark_admission(
+            cint(days), cint(rows_per_table), childs_map
+        )
+        result = {"days": len(encounter_names)}
+        for label, method in (
+            ("per_row", build_claim_items_per_row),
+            ("prefetched", build_claim_items_prefetched),
+        ):
+            # a first run warms the meta and document caches
+            method(encounter_names, childs_map)
+            items, elapsed, queries = count_queries(
+                method, encounter_names, childs_map
+            )
+            result["items"] = len(items)
+            result[label] = {"seconds": round(elapsed, 4), "queries": queries}
+    finally:
+        frappe.db.rollback()
+
+    frappe.logger("hms_tz").info({"benchmark_claim_items": result})
+    return result
+
+
 @frappe.whitelist()
 def reconcile_repeated_items(claim_no):
     def reconcile_items(claim_items):
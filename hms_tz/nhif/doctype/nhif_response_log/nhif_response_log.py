@@ -3,12 +3,39 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
+import io
+import os
+import json
+import gzip
+import time
+import hashlib
 import frappe
+from redis.exceptions import LockNotOwnedError
+from frappe.utils import now, cint
 from frappe.model.document import Document
 
 
+log_queue_key = "nhif_response_log_queue"
+# entries flushed per insert statement
+log_batch_size = 200
+# entries failing on their own this often are moved to the dead-letter list
+max_log_attempts = 3
+log_dead_letter_key = "nhif_response_log_dead_letter"
+max_dead_letters = 10000
+lock_timeout = 300
+# a flush stops in time to release its lock, the next run continues the queue
+max_flush_seconds = 240
+# bodies larger than this many characters are moved to the payload store
+payload_threshold = 64 * 1024
+payload_folder = "nhif_payloads"
+payload_chunk_size = 64 * 1024
+
+
 class NHIFResponseLog(Document):
-    pass
+    def on_trash(self):
+        hashes = {self.request_body_payload, self.response_data_payload} - {None, ""}
+        if hashes:
+            frappe.db.after_commit.add(lambda: delete_unreferenced_payloads(hashes))
 
 
 def add_log(
@@ -18,15 +45,342 @@ def add_log(
     request_body=None,
     response_data=None,
     status_code=None,
+    queue=True,
 ):
+    """Record an NHIF request and its response.
+
+    By default the entry is pushed to a redis queue and written later by
+    `flush_log_queue`, so the caller only pays for the push and its
+    transaction is left alone. Pass `queue=False` when the log row has to be
+    readable right away, it is then inserted in the caller's transaction.
+    """
+    entry = {
+        "request_type": str(request_type),
+        "request_url": str(request_url),
+        "request_header": str(request_header) or "",
+        "request_body": str(request_body) or "",
+        "response_data": str(response_data) or "",
+        "user_id": frappe.session.user,
+        "status_code": status_code or "",
+        "timestamp": now(),
+    }
+
+    if queue:
+        try:
+            push_log_entry(entry)
+            return
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), "NHIF Response Log queue failed")
+
+    move_large_bodies(entry)
     doc = frappe.new_doc("NHIF Response Log")
-    doc.request_type = str(request_type)
-    doc.request_url = str(request_url)
-    doc.request_header = str(request_header) or ""
-    doc.request_body = str(request_body) or ""
-    doc.response_data = str(response_data) or ""
-    doc.user_id = frappe.session.user
-    doc.status_code = status_code or ""
+    doc.update(entry)
     doc.save(ignore_permissions=True)
-    frappe.db.commit()
     return doc.name
+
+
+def move_large_bodies(entry):
+    """Move bodies over the threshold to the payload store, done by the flush so
+    the request that logs them does not gzip and write them
+    """
+    threshold = cint(frappe.conf.get("nhif_payload_threshold") or payload_threshold)
+    for field in ("request_body", "response_data"):
+        if threshold and len(entry.get(field) or "") > threshold:
+            entry[field + "_payload"] = store_payload(entry[field])
+            entry[field] = ""
+
+
+def push_log_entry(entry):
+    cache = frappe.cache()
+    cache.rpush(log_queue_key, json.dumps(entry))
+    if cache.llen(log_queue_key) >= log_batch_size:
+        frappe.enqueue(
+            method=flush_log_queue,
+            queue="short",
+            enqueue_after_commit=True,
+        )
+
+
+def pop_log_entries(count):
+    cache = frappe.cache()
+    key = cache.make_key(log_queue_key)
+    pipe = cache.pipeline()
+    pipe.lrange(key, 0, count - 1)
+    pipe.ltrim(key, count, -1)
+    entries = pipe.execute()[0]
+    return [json.loads(frappe.safe_decode(entry)) for entry in entries]
+
+
+def flush_log_queue():
+    """Write queued NHIF Response Logs in batches, runs every minute"""
+    from hms_tz.nhif.api.healthcare_utils import get_naming_series_names
+
+    cache = frappe.cache()
+    lock = cache.lock(cache.make_key("nhif_response_log_flush"), timeout=lock_timeout)
+    if not lock.acquire(blocking=False):
+        return
+
+    deadline = time.monotonic() + max_flush_seconds
+    try:
+        naming_series = frappe.get_meta("NHIF Response Log").get_field(
+            "naming_series"
+        ).options.split("\n")[0]
+        while time.monotonic() < deadline:
+            entries = pop_log_entries(log_batch_size)
+            if not entries:
+                break
+
+            names = get_naming_series_names(naming_series, len(entries))
+            frappe.db.commit()
+            time_stamp = now()
+            try:
+                rows = []
+                for name, entry in zip(names, entries):
+                    move_large_bodies(entry)
+                    rows.append(get_log_row(name, naming_series, entry, time_stamp))
+                insert_log_rows(rows)
+                frappe.db.commit()
+            except Exception:
+                frappe.db.rollback()
+                insert_log_rows_one_by_one(names, naming_series, entries, time_stamp)
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            pass
+
+
+def get_log_row(name, naming_series, entry, time_stamp):
+    return (
+        name,
+        naming_series,
+        entry.get("timestamp") or time_stamp,
+        entry.get("request_type"),
+        entry.get("request_url"),
+        entry.get("user_id"),
+        entry.get("request_body"),
+        entry.get("response_data"),
+        entry.get("request_header"),
+        entry.get("status_code"),
+        entry.get("request_body_payload"),
+        entry.get("response_data_payload"),
+        entry.get("timestamp") or time_stamp,
+        time_stamp,
+        entry.get("user_id"),
+        entry.get("user_id"),
+    )
+
+
+def insert_log_rows_one_by_one(names, naming_series, entries, time_stamp):
+    """Insert the rows of a failed batch one at a time, an entry that fails again
+    goes back to the queue until it used up its attempts, then to the dead-letter
+    list so it cannot hold up the queue
+    """
+    cache = frappe.cache()
+    for name, entry in zip(names, entries):
+        try:
+            move_large_bodies(entry)
+            insert_log_rows([get_log_row(name, naming_series, entry, time_stamp)])
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            entry["attempts"] = cint(entry.get("attempts")) + 1
+            if entry["attempts"] < max_log_attempts:
+                cache.rpush(log_queue_key, json.dumps(entry))
+                continue
+
+            entry["error"] = frappe.get_traceback()
+            pipe = cache.pipeline()
+            pipe.rpush(cache.make_key(log_dead_letter_key), json.dumps(entry))
+            pipe.ltrim(cache.make_key(log_dead_letter_key), -max_dead_letters, -1)
+            pipe.execute()
+            frappe.log_error(
+                entry["error"],
+                "NHIF Response Log not written: {0}".format(
+                    entry.get("request_type")
+                )[:140],
+            )
+            frappe.db.commit()
+
+
+def requeue_dead_log_entries():
+    """Move dead-letter entries back to the queue once their cause is fixed, e.g.
+    bench --site <site> execute hms_tz.nhif.doctype.nhif_response_log.nhif_response_log.requeue_dead_log_entries
+    """
+    cache = frappe.cache()
+    key = cache.make_key(log_dead_letter_key)
+    pipe = cache.pipeline()
+    pipe.lrange(key, 0, -1)
+    pipe.delete(key)
+    entries = pipe.execute()[0]
+    for entry in entries:
+        entry = json.loads(frappe.safe_decode(entry))
+        entry.pop("attempts", None)
+        entry.pop("error", None)
+        cache.rpush(log_queue_key, json.dumps(entry))
+    return len(entries)
+
+
+def insert_log_rows(insert_data):
+    frappe.db.sql(
+        """
+        INSERT INTO `tabNHIF Response Log`
+        (
+            `name`, `naming_series`, `timestamp`, `request_type`, `request_url`,
+            `user_id`, `request_body`, `response_data`, `request_header`,
+            `status_code`, `request_body_payload`, `response_data_payload`,
+            `creation`, `modified`, `modified_by`, `owner`
+        )
+        VALUES {}
+        """.format(
+            ", ".join(["%s"] * len(insert_data))
+        ),
+        tuple(insert_data),
+    )
+
+
+def get_payload_path(content_hash):
+    return frappe.get_site_path(
+        "private", "files", payload_folder, content_hash[:2], content_hash + ".json.gz"
+    )
+
+
+def store_payload(content):
+    """Gzip `content` into the private payload store and return its sha256 reference.
+
+    Payloads are content addressed, storing the same body twice keeps one file.
+    """
+    data = frappe.safe_encode(content)
+    content_hash = hashlib.sha256(data).hexdigest()
+    path = get_payload_path(content_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + "." + frappe.generate_hash(length=8)
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    return content_hash
+
+
+def get_referenced_payloads(hashes):
+    if not hashes:
+        return set()
+    referenced = set()
+    for field in ("request_body_payload", "response_data_payload"):
+        referenced.update(
+            frappe.get_all(
+                "NHIF Response Log",
+                filters={field: ["in", list(hashes)]},
+                pluck=field,
+            )
+        )
+    return referenced
+
+
+def delete_unreferenced_payloads(hashes):
+    """Remove the payload files of `hashes` that no log row points to anymore"""
+    referenced = get_referenced_payloads(hashes)
+    for content_hash in set(hashes) - referenced:
+        path = get_payload_path(content_hash)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def delete_orphaned_payloads():
+    """Remove payload files no log references, e.g. after logs were cleared in bulk,
+    runs daily. Files younger than a day are kept, their log may still be queued.
+    """
+    root = frappe.get_site_path("private", "files", payload_folder)
+    if not os.path.isdir(root):
+        return
+
+    min_mtime = time.time() - 24 * 60 * 60
+    hashes = []
+    for folder, _dirs, files in os.walk(root):
+        for file_name in files:
+            if not file_name.endswith(".json.gz"):
+                continue
+            if os.path.getmtime(os.path.join(folder, file_name)) > min_mtime:
+                continue
+            hashes.append(file_name[: -len(".json.gz")])
+
+    for i in range(0, len(hashes), 500):
+        delete_unreferenced_payloads(hashes[i : i + 500])
+
+
+def open_payload(content_hash):
+    """Open a stored payload for reading as text, decompressing as it is read"""
+    return gzip.open(get_payload_path(content_hash), "rt", encoding="utf-8")
+
+
+def get_log_body(log_name, field="response_data"):
+    """Return a file like object over the request body or response data of a log"""
+    body, content_hash = frappe.db.get_value(
+        "NHIF Response Log", log_name, [field, field + "_payload"]
+    )
+    if content_hash:
+        return open_payload(content_hash)
+    return io.StringIO(body or "")
+
+
+def iter_json_array(stream, key):
+    """Yield the items of the top level array `key` of a JSON object read from `stream`.
+
+    Items are decoded one at a time from fixed size chunks, so the whole
+    payload never has to be held as one string.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+
+    def read_more():
+        chunk = stream.read(payload_chunk_size)
+        return chunk, not chunk
+
+    marker = '"{0}"'.format(key)
+    while True:
+        index = buffer.find(marker)
+        if index >= 0:
+            buffer = buffer[index + len(marker):]
+            break
+        if eof:
+            return
+        # keep a tail in case the marker is split over two chunks
+        buffer = buffer[-len(marker):]
+        chunk, eof = read_more()
+        buffer += chunk
+
+    while "[" not in buffer:
+        if eof:
+            return
+        chunk, eof = read_more()
+        buffer += chunk
+    buffer = buffer[buffer.index("[") + 1:]
+
+    while True:
+        buffer = buffer.lstrip(" \t\r\n,")
+        if not buffer:
+            if eof:
+                return
+            chunk, eof = read_more()
+            buffer += chunk
+            continue
+        if buffer[0] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except ValueError:
+            if eof:
+                raise
+            chunk, eof = read_more()
+            buffer += chunk
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
+def iter_log_records(log_name, key):
+    """Yield the records of `key` (e.g. PricePackage) from the response of a log"""
+    with get_log_body(log_name) as stream:
+        for record in iter_json_array(stream, key):
+            yield record
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Aakvatech and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Patient Prescription History', {
+	// refresh: function(frm) {
+
+	// }
+});
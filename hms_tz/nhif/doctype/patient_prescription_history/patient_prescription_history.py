@@ -0,0 +1,283 @@
+# Copyright (c) 2026, Aakvatech and contributors
+# For license information, please see license.txt
+
+import hashlib
+import frappe
+from frappe.utils import getdate, now, flt, create_batch
+from frappe.model.document import Document
+
+
+# source doctype => (reference doctype, template field) for ordered services
+ordered_sources = {
+    "Lab Test": ("Lab Test Template", "template"),
+    "Radiology Examination": (
+        "Radiology Examination Template",
+        "radiology_examination_template",
+    ),
+    "Clinical Procedure": ("Clinical Procedure Template", "procedure_template"),
+}
+
+
+class PatientPrescriptionHistory(Document):
+    pass
+
+
+def get_history_name(patient, reference_doctype, template):
+    key = "\n".join([patient, reference_doctype, template])
+    return hashlib.sha1(frappe.safe_encode(key)).hexdigest()
+
+
+def get_prescription_history(patient, keys):
+    """Return {(reference_doctype, template): row} for the last time each key was
+    dispensed or ordered for the patient, with one query.
+
+    Medication is indexed by its Item, with reference doctype "Item".
+    """
+    names = {
+        get_history_name(patient, reference_doctype, template)
+        for reference_doctype, template in keys
+        if template
+    }
+    if not names:
+        return {}
+
+    rows = frappe.get_all(
+        "Patient Prescription History",
+        filters={"name": ["in", list(names)]},
+        fields=["reference_doctype", "template", "last_date", "last_qty", "uom"],
+    )
+    return {(row.reference_doctype, row.template): row for row in rows}
+
+
+def upsert_history(rows):
+    """Insert or update history rows, an existing row is only replaced by a newer date"""
+    time_stamp = now()
+    user = frappe.session.user
+    for batch in create_batch(rows, 500):
+        values = []
+        for row in batch:
+            values.append(
+                (
+                    get_history_name(
+                        row["patient"], row["reference_doctype"], row["template"]
+                    ),
+                    row["patient"],
+                    row["reference_doctype"],
+                    row["template"],
+                    getdate(row["last_date"]),
+                    flt(row.get("last_qty")),
+                    row.get("uom") or "",
+                    row.get("source_doctype") or "",
+                    row.get("source_name") or "",
+                    time_stamp,
+                    time_stamp,
+                    user,
+                    user,
+                )
+            )
+
+        # last_date must be assigned last, the other columns compare against the old value
+        frappe.db.sql(
+            """
+            INSERT INTO `tabPatient Prescription History`
+            (
+                `name`, `patient`, `reference_doctype`, `template`, `last_date`,
+                `last_qty`, `uom`, `source_doctype`, `source_name`,
+                `creation`, `modified`, `modified_by`, `owner`
+            )
+            VALUES {}
+            ON DUPLICATE KEY UPDATE
+                `last_qty` = IF(VALUES(`last_date`) >= `last_date`, VALUES(`last_qty`), `last_qty`),
+                `uom` = IF(VALUES(`last_date`) >= `last_date`, VALUES(`uom`), `uom`),
+                `source_doctype` = IF(VALUES(`last_date`) >= `last_date`, VALUES(`source_doctype`), `source_doctype`),
+                `source_name` = IF(VALUES(`last_date`) >= `last_date`, VALUES(`source_name`), `source_name`),
+                `modified` = VALUES(`modified`),
+                `last_date` = GREATEST(`last_date`, VALUES(`last_date`))
+            """.format(
+                ", ".join(["%s"] * len(values))
+            ),
+            tuple(values),
+        )
+
+
+def get_history_source_rows(reference_doctype, patient=None, templates=None):
+    """Compute history rows of `reference_doctype` from the source documents"""
+    values = {"patient": patient, "templates": tuple(templates or [])}
+
+    if reference_doctype == "Item":
+        conditions = ""
+        if patient:
+            conditions += " AND dn.patient = %(patient)s"
+        if templates:
+            conditions += " AND dni.item_code IN %(templates)s"
+        # the latest single note wins, as when notes are upserted one by one on submit
+        return frappe.db.sql(
+            """
+            SELECT notes.patient, notes.item_code AS template,
+                MAX(notes.posting_date) AS last_date,
+                SUBSTRING_INDEX(GROUP_CONCAT(notes.qty ORDER BY notes.posting_date DESC, notes.creation DESC), ',', 1) AS last_qty,
+                SUBSTRING_INDEX(GROUP_CONCAT(notes.uom ORDER BY notes.posting_date DESC, notes.creation DESC), ',', 1) AS uom,
+                'Delivery Note' AS source_doctype,
+                SUBSTRING_INDEX(GROUP_CONCAT(notes.name ORDER BY notes.posting_date DESC, notes.creation DESC), ',', 1) AS source_name
+            FROM (
+                SELECT dn.name, dn.patient, dn.posting_date, dn.creation, dni.item_code,
+                    SUM(dni.stock_qty) AS qty, MAX(dni.stock_uom) AS uom
+                FROM `tabDelivery Note` dn
+                INNER JOIN `tabDelivery Note Item` dni ON dni.parent = dn.name
+                WHERE dn.docstatus = 1 AND IFNULL(dn.patient, '') != '' {0}
+                GROUP BY dn.name, dni.item_code
+            ) notes
+            GROUP BY notes.patient, notes.item_code
+            """.format(
+                conditions
+            ),
+            values,
+            as_dict=1,
+        )
+
+    if reference_doctype == "Therapy Type":
+        conditions = ""
+        if patient:
+            conditions += " AND tp.patient = %(patient)s"
+        if templates:
+            conditions += " AND tpd.therapy_type IN %(templates)s"
+        return frappe.db.sql(
+            """
+            SELECT tp.patient, tpd.therapy_type AS template,
+                DATE(MAX(tpd.creation)) AS last_date,
+                SUBSTRING_INDEX(GROUP_CONCAT(tpd.no_of_sessions ORDER BY tpd.creation DESC), ',', 1) AS last_qty,
+                '' AS uom, 'Therapy Plan' AS source_doctype,
+                SUBSTRING_INDEX(GROUP_CONCAT(tp.name ORDER BY tpd.creation DESC), ',', 1) AS source_name
+            FROM `tabTherapy Plan Detail` tpd
+            INNER JOIN `tabTherapy Plan` tp ON tpd.parent = tp.name
+            WHERE IFNULL(tp.patient, '') != '' {0}
+            GROUP BY tp.patient, tpd.therapy_type
+            """.format(
+                conditions
+            ),
+            values,
+            as_dict=1,
+        )
+
+    source_doctype = next(
+        source
+        for source, (template_doctype, field) in ordered_sources.items()
+        if template_doctype == reference_doctype
+    )
+    field = ordered_sources[source_doctype][1]
+    conditions = ""
+    if patient:
+        conditions += " AND patient = %(patient)s"
+    if templates:
+        conditions += " AND `{0}` IN %(templates)s".format(field)
+    return frappe.db.sql(
+        """
+        SELECT patient, `{0}` AS template, DATE(MAX(creation)) AS last_date,
+            1 AS last_qty, '' AS uom, '{1}' AS source_doctype,
+            SUBSTRING_INDEX(GROUP_CONCAT(name ORDER BY creation DESC), ',', 1) AS source_name
+        FROM `tab{1}`
+        WHERE IFNULL(patient, '') != '' AND IFNULL(`{0}`, '') != '' {2}
+        GROUP BY patient, `{0}`
+        """.format(
+            field, source_doctype, conditions
+        ),
+        values,
+        as_dict=1,
+    )
+
+
+def rebuild_history(reference_doctype, patient=None, templates=None):
+    """Recompute history rows from the source documents, used after a cancel or delete"""
+    filters = {"reference_doctype": reference_doctype}
+    if patient:
+        filters["patient"] = patient
+    if templates:
+        filters["template"] = ["in", list(templates)]
+    frappe.db.delete("Patient Prescription History", filters)
+
+    rows = get_history_source_rows(reference_doctype, patient, templates)
+    for row in rows:
+        row["reference_doctype"] = reference_doctype
+    upsert_history(rows)
+
+
+def rebuild_all_history():
+    for reference_doctype in ["Item", "Therapy Type"] + [
+        template_doctype for template_doctype, field in ordered_sources.values()
+    ]:
+        rebuild_history(reference_doctype)
+
+
+def on_delivery_note_submit(doc, method):
+    if not doc.get("patient"):
+        return
+
+    items = {}
+    for item in doc.items:
+        row = items.setdefault(
+            item.item_code,
+            {
+                "patient": doc.patient,
+                "reference_doctype": "Item",
+                "template": item.item_code,
+                "last_date": doc.posting_date,
+                "last_qty": 0,
+                "uom": item.stock_uom,
+                "source_doctype": doc.doctype,
+                "source_name": doc.name,
+            },
+        )
+        row["last_qty"] += flt(item.stock_qty)
+    upsert_history(list(items.values()))
+
+
+def on_delivery_note_cancel(doc, method):
+    if not doc.get("patient"):
+        return
+    rebuild_history("Item", doc.patient, {item.item_code for item in doc.items})
+
+
+def on_ordered_service_insert(doc, method):
+    reference_doctype, field = ordered_sources[doc.doctype]
+    if not doc.get("patient") or not doc.get(field):
+        return
+    upsert_history(
+        [
+            {
+                "patient": doc.patient,
+                "reference_doctype": reference_doctype,
+                "template": doc.get(field),
+                "last_date": doc.creation,
+                "last_qty": 1,
+                "source_doctype": doc.doctype,
+                "source_name": doc.name,
+            }
+        ]
+    )
+
+
+def on_ordered_service_delete(doc, method):
+    reference_doctype, field = ordered_sources[doc.doctype]
+    if not doc.get("patient") or not doc.get(field):
+        return
+    rebuild_history(reference_doctype, doc.patient, [doc.get(field)])
+
+
+def on_therapy_plan_update(doc, method):
+    if not doc.get("patient"):
+        return
+    upsert_history(
+        [
+            {
+                "patient": doc.patient,
+                "reference_doctype": "Therapy Type",
+                "template": row.therapy_type,
+                "last_date": row.creation or doc.modified,
+                "last_qty": row.no_of_sessions,
+                "source_doctype": doc.doctype,
+                "source_name": doc.name,
+            }
+            for row in doc.get("therapy_plan_details") or []
+            if row.therapy_type
+        ]
+    )
@@ -7,45 +7,57 @@ import frappe
 from frappe.model.document import Document
 import json
 import datetime as dt
-from frappe.utils import getdate
+from frappe.utils import getdate, get_time, add_days, cint, now
+from hms_tz.nhif.api.healthcare_utils import get_naming_series_names
+
+
+# open ended events are materialized this many days ahead,
+# `extend_occurrence_horizon` moves the horizon every day
+occurrence_horizon_days = 365
+
+weekdays = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+
+# fields copied from the Practitioner Availability to each of its occurrences
+occurrence_fields = [
+    "availability_type",
+    "availability",
+    "practitioner",
+    "healthcare_practitioner_name",
+    "from_time",
+    "to_time",
+    "repeat_this_event",
+    "present",
+    "appointment_type",
+    "duration",
+    "service_unit",
+    "total_service_unit_capacity",
+    "color",
+    "out_patient_consulting_charge_item",
+    "op_consulting_charge",
+    "inpatient_visit_charge_item",
+    "inpatient_visit_charge",
+]
 
 
 class PractitionerAvailabilityDetail(Document):
     pass
 
 
-def create_practitioner_availability_detail(pa_doc, date):
-    """
-    return created doc in memory with the info from Practitioner Availability doc
-    """
-    from_time = dt.datetime.strptime(pa_doc.from_time, "%H:%M:%S").time()
-    from_date = dt.datetime.combine(getdate(date), from_time)
-
-    to_time = dt.datetime.strptime(pa_doc.to_time, "%H:%M:%S").time()
-    to_date = dt.datetime.combine(getdate(date), to_time)
-
-    doc = frappe.new_doc("Practitioner Availability Detail")
-    doc.practitioner_availability = pa_doc.name
-    doc.availability_type = pa_doc.availability_type
-    doc.availability = pa_doc.availability
-    doc.practitioner = pa_doc.practitioner
-    doc.healthcare_practitioner_name = pa_doc.healthcare_practitioner_name
-    doc.from_date = from_date
-    doc.from_time = pa_doc.from_time
-    doc.to_date = to_date
-    doc.to_time = pa_doc.to_time
-    doc.repeat_this_event = pa_doc.repeat_this_event
-    doc.present = pa_doc.present
-    doc.appointment_type = pa_doc.appointment_type
-    doc.duration = pa_doc.duration
-    doc.service_unit = pa_doc.service_unit
-    doc.total_service_unit_capacity = pa_doc.total_service_unit_capacity
-    doc.color = pa_doc.color
-    doc.out_patient_consulting_charge_item = pa_doc.out_patient_consulting_charge_item
-    doc.op_consulting_charge = pa_doc.op_consulting_charge
-    doc.inpatient_visit_charge_item = pa_doc.inpatient_visit_charge_item
-    doc.inpatient_visit_charge = pa_doc.inpatient_visit_charge
-    return doc
+def on_doctype_update():
+    frappe.db.add_index(
+        "Practitioner Availability Detail", ["practitioner", "from_date"]
+    )
+    frappe.db.add_index(
+        "Practitioner Availability Detail", ["practitioner_availability"]
+    )
 
 
 def delelte_all_related_practitioner_availability_detail(pa_doc):
@@ -56,6 +68,207 @@ def delelte_all_related_practitioner_availability_detail(pa_doc):
     )
 
 
+def get_occurrence_horizon():
+    return add_days(
+        getdate(),
+        cint(
+            frappe.conf.get("practitioner_availability_horizon")
+            or occurrence_horizon_days
+        ),
+    )
+
+
+def get_occurrence_dates(pa_doc, horizon=None):
+    """Dates a Practitioner Availability occurs on, up to its repeat till or the horizon"""
+    start = getdate(pa_doc.from_date)
+    if not cint(pa_doc.repeat_this_event):
+        return [start]
+
+    end = getdate(horizon or get_occurrence_horizon())
+    if pa_doc.repeat_till:
+        end = min(end, getdate(pa_doc.repeat_till))
+
+    dates = []
+    if pa_doc.repeat_on == "Every Day":
+        date = start
+        while date <= end:
+            if pa_doc.get(weekdays[date.weekday()]):
+                dates.append(date)
+            date = add_days(date, 1)
+
+    elif pa_doc.repeat_on == "Every Week":
+        date = start
+        while date <= end:
+            dates.append(date)
+            date = add_days(date, 7)
+
+    elif pa_doc.repeat_on in ("Every Month", "Every Year"):
+        step = 1 if pa_doc.repeat_on == "Every Month" else 12
+        months = 0
+        while True:
+            year, month = divmod(start.month - 1 + months, 12)
+            if dt.date(start.year + year, month + 1, 1) > end:
+                break
+            try:
+                dates.append(dt.date(start.year + year, month + 1, start.day))
+            except ValueError:
+                # months or years without the day of the start date are skipped
+                pass
+            months += step
+        dates = [date for date in dates if date <= end]
+
+    return dates
+
+
+def sync_availability_occurrences(pa_doc, horizon=None, update_existing=True):
+    """Bring the occurrences of a Practitioner Availability in line with it.
+
+    Only the dates that were added or dropped are inserted or deleted, the
+    kept occurrences get the event's fields with one update.
+    """
+    dates = set(get_occurrence_dates(pa_doc, horizon))
+    existing = {}
+    for row in frappe.get_all(
+        "Practitioner Availability Detail",
+        filters={"practitioner_availability": pa_doc.name},
+        fields=["name", "from_date"],
+    ):
+        existing.setdefault(getdate(row.from_date), []).append(row.name)
+
+    stale = []
+    for date, names in existing.items():
+        stale.extend(names if date not in dates else names[1:])
+    if stale:
+        frappe.db.delete("Practitioner Availability Detail", {"name": ["in", stale]})
+
+    if update_existing and any(date in dates for date in existing):
+        update_occurrences(pa_doc)
+    insert_occurrences(pa_doc, sorted(dates - set(existing)))
+
+
+def get_occurrence_values(pa_doc):
+    values = {field: pa_doc.get(field) for field in occurrence_fields}
+    for field in ("repeat_this_event", "present", "duration", "total_service_unit_capacity"):
+        values[field] = cint(values[field])
+    return values
+
+
+def update_occurrences(pa_doc):
+    values = get_occurrence_values(pa_doc)
+    values.update({"name": pa_doc.name, "modified": now()})
+    frappe.db.sql(
+        """
+        UPDATE `tabPractitioner Availability Detail`
+        SET {0},
+            `from_date` = TIMESTAMP(DATE(`from_date`), %(from_time)s),
+            `to_date` = TIMESTAMP(DATE(`from_date`), %(to_time)s),
+            `modified` = %(modified)s
+        WHERE `practitioner_availability` = %(name)s
+        """.format(
+            ", ".join(
+                "`{0}` = %({0})s".format(field) for field in occurrence_fields
+            )
+        ),
+        values,
+    )
+
+
+def insert_occurrences(pa_doc, dates):
+    if not dates:
+        return
+
+    values = get_occurrence_values(pa_doc)
+    from_time = get_time(pa_doc.from_time)
+    to_time = get_time(pa_doc.to_time)
+    names = get_naming_series_names(
+        frappe.get_meta("Practitioner Availability Detail").autoname, len(dates)
+    )
+    time_stamp = now()
+    user = frappe.session.user
+    rows = [
+        (
+            name,
+            pa_doc.name,
+            dt.datetime.combine(date, from_time),
+            dt.datetime.combine(date, to_time),
+            *[values[field] for field in occurrence_fields],
+            time_stamp,
+            time_stamp,
+            user,
+            user,
+        )
+        for name, date in zip(names, dates)
+    ]
+    frappe.db.sql(
+        """
+        INSERT INTO `tabPractitioner Availability Detail`
+        (
+            `name`, `practitioner_availability`, `from_date`, `to_date`, {0},
+            `creation`, `modified`, `modified_by`, `owner`
+        )
+        VALUES {1}
+        """.format(
+            ", ".join("`{0}`".format(field) for field in occurrence_fields),
+            ", ".join(["%s"] * len(rows)),
+        ),
+        tuple(rows),
+    )
+
+
+def get_occurrences(practitioner, from_date, to_date=None, present=None):
+    """Occurrences of the practitioner's events from `from_date` to `to_date`,
+    a range scan on the (practitioner, from_date) index.
+    """
+    conditions = ""
+    if present is not None:
+        conditions = " and present = %(present)s"
+    return frappe.db.sql(
+        """
+        select
+            practitioner_availability as name, availability, from_time, to_time,
+            from_date, to_date, duration, service_unit, repeat_this_event, present
+        from
+            `tabPractitioner Availability Detail`
+        where
+            practitioner = %(practitioner)s
+            and from_date >= %(from_date)s and from_date < %(to_date)s {0}
+        order by
+            from_date, from_time
+        """.format(
+            conditions
+        ),
+        {
+            "practitioner": practitioner,
+            "from_date": getdate(from_date),
+            "to_date": add_days(getdate(to_date or from_date), 1),
+            "present": cint(present),
+        },
+        as_dict=True,
+    )
+
+
+def extend_occurrence_horizon():
+    """Materialize the next day of open ended and long running events, runs daily"""
+    horizon = get_occurrence_horizon()
+    for name in frappe.get_all(
+        "Practitioner Availability",
+        filters={"repeat_this_event": 1},
+        or_filters=[
+            ["repeat_till", "is", "not set"],
+            ["repeat_till", ">=", add_days(horizon, -1)],
+        ],
+        pluck="name",
+    ):
+        pa_doc = frappe.get_doc("Practitioner Availability", name)
+        sync_availability_occurrences(pa_doc, horizon, update_existing=False)
+        frappe.db.commit()
+
+
+def rebuild_all_occurrences():
+    for name in frappe.get_all("Practitioner Availability", pluck="name"):
+        sync_availability_occurrences(frappe.get_doc("Practitioner Availability", name))
+
+
 @frappe.whitelist()
 def get_events(doctype, start, end, field_map, filters=None, fields=None):
 
@@ -5,9 +5,9 @@ from __future__ import unicode_literals
 import frappe
 from frappe import _
 from hms_tz.nhif.api.token import get_claimsservice_token
+from hms_tz.nhif.api.nhif_client import nhif_request
 from hms_tz.nhif.doctype.nhif_response_log.nhif_response_log import add_log
 import json
-import requests
 
 
 def execute(filters=None):
@@ -148,7 +148,7 @@ def get_nhif_data(filters):
     ) + "/claimsserver/api/v1/Claims/getSubmittedClaims?FacilityCode={0}&ClaimYear={1}&ClaimMonth={2}".format(
         facility_code, filters.ClaimYear, filters.ClaimMonth
     )
-    r = requests.get(url, headers=headers, timeout=300)
+    r = nhif_request("GET", url, "GetSubmittedClaims", headers=headers)
     if r.status_code != 200:
         add_log(
             request_type="getSubmittedClaims",
@@ -0,0 +1,9 @@
+import frappe
+from hms_tz.nhif.doctype.patient_prescription_history.patient_prescription_history import (
+    rebuild_all_history,
+)
+
+
+def execute():
+    frappe.reload_doc("nhif", "doctype", "patient_prescription_history")
+    rebuild_all_history()
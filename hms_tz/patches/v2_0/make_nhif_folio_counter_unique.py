@@ -0,0 +1,46 @@
+import frappe
+from hms_tz.nhif.doctype.nhif_folio_counter.nhif_folio_counter import (
+    on_doctype_update,
+)
+
+
+def execute():
+    frappe.reload_doc("nhif", "doctype", "nhif_folio_counter")
+
+    # keep one counter per claim period, at the highest folio number handed out
+    duplicates = frappe.db.sql(
+        """
+        SELECT company, claim_year, claim_month
+        FROM `tabNHIF Folio Counter`
+        GROUP BY company, claim_year, claim_month
+        HAVING COUNT(*) > 1
+        """,
+        as_dict=True,
+    )
+    for row in duplicates:
+        counters = frappe.get_all(
+            "NHIF Folio Counter",
+            filters=row,
+            fields=["name", "folio_no"],
+            order_by="folio_no desc",
+        )
+        frappe.db.delete(
+            "NHIF Folio Counter",
+            {"name": ["in", [counter.name for counter in counters[1:]]]},
+        )
+
+    frappe.db.sql(
+        """
+        UPDATE `tabNHIF Folio Counter` fc
+        INNER JOIN (
+            SELECT company, claim_year, claim_month, MAX(folio_no) AS folio_no
+            FROM `tabNHIF Patient Claim`
+            GROUP BY company, claim_year, claim_month
+        ) claims ON claims.company = fc.company
+            AND claims.claim_year = fc.claim_year
+            AND claims.claim_month = fc.claim_month
+        SET fc.folio_no = GREATEST(IFNULL(fc.folio_no, 0), claims.folio_no)
+        """
+    )
+
+    on_doctype_update()
@@ -0,0 +1,7 @@
+import frappe
+
+
+def execute():
+    """Messages stored before the background ingestion were applied when saved"""
+    frappe.reload_doc("nhif", "doctype", "lab_machine_message")
+    frappe.db.sql("UPDATE `tabLab Machine Message` SET `processed` = 1")
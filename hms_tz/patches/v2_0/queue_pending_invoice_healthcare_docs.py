@@ -0,0 +1,29 @@
+import frappe
+from frappe.utils import add_days, nowdate
+from hms_tz.nhif.doctype.healthcare_invoice_outbox.healthcare_invoice_outbox import (
+    add_outbox_entries,
+)
+
+
+def execute():
+    """Queue the items the old 10 minute sweep would still have picked up"""
+    frappe.reload_doc("nhif", "doctype", "healthcare_invoice_outbox")
+
+    invoices = frappe.db.sql(
+        """
+        SELECT DISTINCT si.name
+        FROM `tabSales Invoice` si
+        INNER JOIN `tabSales Invoice Item` sii ON sii.parent = si.name
+        WHERE si.docstatus = 1
+          AND si.is_return = 0
+          AND IFNULL(si.patient, '') != ''
+          AND si.posting_date >= %s
+          AND sii.hms_tz_is_lrp_item_created = 0
+          AND sii.reference_dt IN ('Lab Prescription', 'Radiology Procedure Prescription',
+            'Procedure Prescription', 'Therapy Plan Detail')
+        """,
+        add_days(nowdate(), -1),
+        pluck=True,
+    )
+    for name in invoices:
+        add_outbox_entries(frappe.get_doc("Sales Invoice", name))
@@ -0,0 +1,11 @@
+import frappe
+from hms_tz.nhif.doctype.practitioner_availability_detail.practitioner_availability_detail import (
+    on_doctype_update,
+    rebuild_all_occurrences,
+)
+
+
+def execute():
+    frappe.reload_doc("nhif", "doctype", "practitioner_availability_detail")
+    on_doctype_update()
+    rebuild_all_occurrences()